@@ -0,0 +1,101 @@
+import asyncio
+
+from pickle_storage.container import BaseStorageContainer
+from pickle_storage.executor import get_executor
+from pickle_storage.operations import CallableOperation
+from pickle_storage.config.tools import get_settings_config
+storage_settings = get_settings_config()
+
+__all__ = ['AsyncStorageContainer']
+
+# Polling interval bounds while waiting for a free executor slot, in seconds
+MIN_BACKOFF = 0.0005
+MAX_BACKOFF = 0.05
+
+class AsyncStorageContainer():
+    """ asyncio interface to a storage container.
+
+    Operations run on the shared executor like any other and are awaited
+    through their futures, so no thread is created per call. At most
+    ``concurrency`` operations are submitted at once. An operation is only
+    submitted once an executor slot is reserved for it; while other users
+    of the shared executor hold every slot, calls wait on the event loop.
+    Read cache and expiry lookups, which touch the disk, run on the executor
+    too.
+    Cancelling a call cancels its operation if it has not started running.
+
+    Attributes not defined here, such as contents() or exists(), are passed
+    through to the wrapped container. """
+
+    def __init__(self, container=None, concurrency=None):
+        if container is None:
+            container = BaseStorageContainer()
+        if concurrency is None:
+            concurrency = storage_settings.PICKLE_STORAGE_ASYNC_CONCURRENCY
+        if concurrency is None:
+            executor = get_executor()
+            concurrency = executor.max_workers + executor.max_queue_size
+        self.container = container
+        self.concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def __getattr__(self, name):
+        return getattr(self.container, name)
+
+    async def aread(self, path='', *args, **kwargs):
+        if (self.container.read_cache is None
+            and self.container.expiry is None):
+            # Only in-memory lookups are left, not worth an executor trip
+            hit, value, signature = self.container.cache_lookup(path)
+        else:
+            hit, value, signature = await self._run(CallableOperation,
+                self.container.cache_lookup, path) or (False, None, None)
+        if hit:
+            return value
+        value = await self._run(self.container.read_operation, path, *args,
+            **kwargs)
+        self.container.cache_store(path, signature, value)
+        return value
+
+    async def aread_many(self, keys, **kwargs):
+        """ Read several keys in one operation. Returns a BatchResult. """
+
+        keys = list(keys)
+        pending = self.container.buffered_values(keys)
+        result = await self._run(self.container.read_many_operation,
+            [key for key in keys if key not in pending], **kwargs)
+        result.update(pending)
+        return result
+
+    async def awrite(self, *args, **kwargs):
+        return await self._run(self.container.write, *args, wait=False,
+            **kwargs)
+
+    async def awrite_many(self, mapping, *args, **kwargs):
+        """ Write every key/value pair in mapping as one operation. Returns
+        a BatchResult. """
+
+        return await self._run(self.container.write_many, mapping, *args,
+            wait=False, **kwargs)
+
+    async def _run(self, start, *args, **kwargs):
+        """ Start an operation with start(*args, **kwargs) and wait for its
+        result. """
+
+        async with self._semaphore:
+            executor = get_executor()
+            backoff = MIN_BACKOFF
+            while not executor.reserve():
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+            try:
+                op = start(*args, **kwargs)
+            finally:
+                # Unused if start() did not need the executor
+                executor.unreserve()
+            try:
+                await asyncio.wrap_future(op.future)
+            except asyncio.CancelledError:
+                op.cancel()
+                raise
+            return op.join()
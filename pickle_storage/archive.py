@@ -0,0 +1,202 @@
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import tarfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from pickle_storage.compression import CODECS, codec_id, decompress
+from pickle_storage.errors import IntegrityError
+from pickle_storage.utils import atomic_write, write_to_log
+from pickle_storage.config.tools import get_settings_config
+storage_settings = get_settings_config()
+
+__all__ = ['create_snapshot', 'latest_snapshot', 'make_full_archive',
+    'restore_snapshot']
+
+ARCHIVE_DIRECTORY = '_archive'
+SNAPSHOT_MANIFEST = 'snapshot.json'
+LATEST_POINTER = 'LATEST'
+
+# Directories inside the working directory that never hold keys, or only hold
+# files derived from them
+EXCLUDED_DIRECTORIES = {ARCHIVE_DIRECTORY, '_image', '_meta', '.locks'}
+
+# shutil archive format -> codec used for snapshot blobs
+SNAPSHOT_CODECS = {'gztar': 'zlib', 'zip': 'zlib', 'bztar': 'bz2',
+    'xztar': 'lzma', 'tar': None}
+
+def stored_files(working_dir_path):
+    """ Every file making up the store in working_dir_path, keyed by its path
+    relative to it. Archives, metadata and unfinished writes are left out. """
+
+    files = {}
+    for path in working_dir_path.rglob("*"):
+        relative = path.relative_to(working_dir_path)
+        if relative.parts[0] in EXCLUDED_DIRECTORIES or not path.is_file():
+            continue
+        if path.name.startswith('.') and path.suffix == '.tmp':
+            continue
+        files[relative.as_posix()] = path
+    return files
+
+def make_full_archive(target, compression_format, working_dir_path):
+    """ Archive every stored file, leaving out previous archives. Returns
+    the archive's path, including its extension. """
+
+    files = stored_files(working_dir_path)
+    if compression_format == 'zip':
+        archive_path = pathlib.Path(f"{target}.zip")
+        archive_path.parent.mkdir(parents=True, exist_ok=True)
+        with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, path in sorted(files.items()):
+                archive.write(path, name)
+        return archive_path
+
+    extension, mode = {'gztar': ('.tar.gz', 'w:gz'),
+        'bztar': ('.tar.bz2', 'w:bz2'), 'xztar': ('.tar.xz', 'w:xz'),
+        'tar': ('.tar', 'w')}[compression_format]
+    archive_path = pathlib.Path(f"{target}{extension}")
+    archive_path.parent.mkdir(parents=True, exist_ok=True)
+    with tarfile.open(archive_path, mode) as archive:
+        for name, path in sorted(files.items()):
+            archive.add(path, name)
+    return archive_path
+
+def latest_snapshot(archive_root):
+    """ Path of the most recent complete snapshot under archive_root. """
+
+    try:
+        name = archive_root.joinpath(LATEST_POINTER).read_text().strip()
+    except FileNotFoundError:
+        return None
+    path = archive_root.joinpath(name)
+    if not path.joinpath(SNAPSHOT_MANIFEST).exists():
+        return None
+    return path
+
+def load_snapshot_manifest(snapshot_path):
+    with open(snapshot_path.joinpath(SNAPSHOT_MANIFEST)) as f:
+        return json.load(f)
+
+def create_snapshot(working_dir_path, archive_root=None, name=None,
+    compression_format='gztar', workers=None, full=False):
+    """ Snapshot the store into a new directory under archive_root.
+
+    Only files whose size or mtime changed since the latest snapshot are
+    read; each is stored as a compressed blob named by its sha256, compressed
+    in parallel across workers threads, unless this or an earlier snapshot
+    already holds a blob with the same digest. The snapshot's manifest lists
+    every file, pointing unchanged ones at the blob held by an earlier
+    snapshot, so any snapshot can be restored on its own together with the
+    snapshots it refers to. Unless full, blobs are only reused from the
+    snapshots the latest one refers to. Returns the snapshot's path. """
+
+    working_dir_path = pathlib.Path(working_dir_path)
+    if archive_root is None:
+        archive_root = working_dir_path.joinpath(ARCHIVE_DIRECTORY)
+    archive_root = pathlib.Path(archive_root)
+    if name is None:
+        name = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    snapshot_path = archive_root.joinpath(name)
+    snapshot_path.mkdir(parents=True)
+
+    codec = SNAPSHOT_CODECS.get(compression_format, 'zlib')
+    previous = {} if full else _previous_files(archive_root)
+    files = {}
+    changed = {}
+    for relative, path in stored_files(working_dir_path).items():
+        stat = path.stat()
+        entry = previous.get(relative)
+        if entry and (entry['size'], entry['mtime_ns']) == (stat.st_size,
+            stat.st_mtime_ns):
+            files[relative] = entry
+        else:
+            changed[relative] = path
+
+    # Digest -> the entry of a blob already held by an earlier snapshot
+    known_blobs = {entry['blob']: entry for entry in previous.values()}
+    written_blobs = set()
+    blob_lock = threading.Lock()
+
+    def store(relative, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            content = f.read()
+        blob = hashlib.sha256(content).hexdigest()
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'blob': blob, 'snapshot': name, 'codec': codec}
+        known = known_blobs.get(blob)
+        if known is not None:
+            entry.update(snapshot=known['snapshot'], codec=known['codec'])
+            return relative, entry
+        with blob_lock:
+            is_new = blob not in written_blobs
+            written_blobs.add(blob)
+        if is_new:
+            if codec:
+                content = CODECS[codec_id(codec)][1].compress(content)
+            atomic_write(snapshot_path.joinpath(blob), [content])
+        return relative, entry
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = [pool.submit(store, relative, path)
+            for relative, path in changed.items()]
+        for future in futures:
+            try:
+                relative, entry = future.result()
+                files[relative] = entry
+            except FileNotFoundError:
+                continue # Removed while the snapshot was being taken
+
+    base = latest_snapshot(archive_root)
+    manifest = {'name': name, 'created': datetime.datetime.now().isoformat(),
+        'base': base.name if base and not full else None, 'files': files}
+    atomic_write(snapshot_path.joinpath(SNAPSHOT_MANIFEST),
+        [json.dumps(manifest, indent=1).encode()])
+    atomic_write(archive_root.joinpath(LATEST_POINTER), [name.encode()])
+    return snapshot_path
+
+def restore_snapshot(snapshot_path, target=None):
+    """ Recreate the store captured by snapshot_path in target, which
+    defaults to the working directory, removing files the snapshot does not
+    include. Blobs are read from whichever snapshot beside snapshot_path
+    holds them and verified against their sha256. Returns the number of
+    files restored. """
+
+    snapshot_path = pathlib.Path(snapshot_path)
+    if target is None:
+        target = storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY
+    target = pathlib.Path(target)
+    manifest = load_snapshot_manifest(snapshot_path)
+
+    for relative, entry in manifest['files'].items():
+        blob_path = snapshot_path.parent.joinpath(entry['snapshot'],
+            entry['blob'])
+        content = decompress(codec_id(entry['codec']), blob_path.read_bytes())
+        if hashlib.sha256(content).hexdigest() != entry['blob']:
+            raise IntegrityError(f'Archived copy of "{relative}" is corrupt.')
+        path = target.joinpath(relative)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(path, [content])
+        # Keeps the restored file from counting as changed in the next snapshot
+        os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+
+    for relative, path in stored_files(target).items():
+        if relative not in manifest['files']:
+            path.unlink()
+    return len(manifest['files'])
+
+def _previous_files(archive_root):
+    snapshot_path = latest_snapshot(archive_root)
+    if snapshot_path is None:
+        return {}
+    try:
+        return load_snapshot_manifest(snapshot_path)['files']
+    except (OSError, ValueError):
+        write_to_log(f'Ignoring unreadable snapshot "{snapshot_path}".',
+            level='warning')
+        return {}
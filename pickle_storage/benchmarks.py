@@ -0,0 +1,336 @@
+""" Throughput and latency benchmarks.
+
+Run every scenario and print the results as JSON::
+
+    python -m pickle_storage.benchmarks --output bench_output.json
+
+Pass --baseline with an earlier output file to compare against it; the
+command exits with status 1 if any scenario's throughput dropped, or its p99
+latency rose, by more than --tolerance. Each run uses a fresh temporary
+working directory and fixed random payloads, so results are comparable
+between runs on the same machine. """
+
+import argparse
+import collections
+import json
+import os
+import pathlib
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from pickle_storage.container import BaseStorageContainer
+from pickle_storage.mixins import HMACMixin
+from pickle_storage.snapshot import SnapshotStorageContainer
+from pickle_storage.utils import db_relative_path
+from pickle_storage.config.tools import get_settings_config
+storage_settings = get_settings_config()
+
+__all__ = ['SCENARIOS', 'compare', 'run_benchmarks', 'summarise']
+
+SMALL_PAYLOAD = 256
+LARGE_PAYLOAD = 1024 * 1024
+HMAC_PAYLOADS = {'1k': 1024, '64k': 64 * 1024, '1m': 1024 * 1024}
+
+# name -> (description, function(context)). Functions return each measured
+# operation's latency, plus the wall time they took for scenarios running
+# operations concurrently; otherwise throughput is based on the sum of the
+# latencies, leaving out setup.
+SCENARIOS = collections.OrderedDict()
+
+BenchmarkContext = collections.namedtuple('BenchmarkContext',
+    ['storage', 'iterations', 'keys', 'archive_mb', 'random'])
+
+def scenario(name, description):
+    def register(fn):
+        SCENARIOS[name] = (description, fn)
+        return fn
+    return register
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - start
+
+def payload(context, size):
+    return context.random.randbytes(size)
+
+def small_record(context, i):
+    return {'id': i, 'name': f'user_{i}', 'tags': ['a', 'b', 'c'],
+        'blob': payload(context, SMALL_PAYLOAD)}
+
+@scenario('write_small_sync', 'write(wait=True) of a small record')
+def write_small_sync(context):
+    records = [small_record(context, i) for i in range(context.iterations)]
+    return [timed(context.storage.write, f'small_{i}', record, wait=True)
+        for i, record in enumerate(records)]
+
+@scenario('write_small_async', 'write(wait=False) of a small record, '
+    'latency from submission to completion')
+def write_small_async(context):
+    records = [small_record(context, i) for i in range(context.iterations)]
+    latencies = []
+    lock = threading.Lock()
+
+    def finished(start):
+        def callback(op):
+            with lock:
+                latencies.append(time.perf_counter() - start)
+        return callback
+
+    ops = []
+    began = time.perf_counter()
+    for i, record in enumerate(records):
+        start = time.perf_counter()
+        op = context.storage.write(f'async_{i}', record)
+        op.add_done_callback(finished(start))
+        ops.append(op)
+    for op in ops:
+        op.join()
+    return latencies, time.perf_counter() - began
+
+@scenario('write_large_sync', 'write(wait=True) of 1 MiB of bytes')
+def write_large_sync(context):
+    blob = payload(context, LARGE_PAYLOAD)
+    return [timed(context.storage.write, f'large_{i}', blob, wait=True)
+        for i in range(max(context.iterations // 10, 5))]
+
+@scenario('read_small', 'read() of a small record')
+def read_small(context):
+    context.storage.write_many({f'small_{i}': small_record(context, i)
+        for i in range(context.iterations)}, wait=True)
+    return [timed(context.storage.read, f'small_{i}')
+        for i in range(context.iterations)]
+
+@scenario('read_large', 'read() of 1 MiB of bytes')
+def read_large(context):
+    count = max(context.iterations // 10, 5)
+    blob = payload(context, LARGE_PAYLOAD)
+    for i in range(count):
+        context.storage.write(f'large_{i}', blob, wait=True)
+    return [timed(context.storage.read, f'large_{i}') for i in range(count)]
+
+@scenario('snapshot_read', 'read() of a small record from a snapshot image')
+def snapshot_read(context):
+    context.storage.write_many({f'small_{i}': small_record(context, i)
+        for i in range(context.iterations)}, wait=True)
+    context.storage.build_image()
+    snapshot = SnapshotStorageContainer(
+        working_dir_path=context.storage.working_dir_path,
+        refresh_interval=None)
+    return [timed(snapshot.read, f'small_{i}')
+        for i in range(context.iterations)]
+
+@scenario('read_write_race', 'read() latency with 4 readers racing a writer '
+    'over the same 16 keys')
+def read_write_race(context):
+    keys = [f'race_{i}' for i in range(16)]
+    context.storage.write_many({key: small_record(context, i)
+        for i, key in enumerate(keys)}, wait=True)
+    records = [small_record(context, i) for i in range(context.iterations)]
+    latencies = []
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def writer():
+        for i, record in enumerate(records):
+            context.storage.write(keys[i % len(keys)], record, wait=True)
+        stop.set()
+
+    def reader(offset):
+        own = []
+        i = offset
+        while not stop.is_set() or len(own) < context.iterations // 4:
+            own.append(timed(context.storage.read, keys[i % len(keys)]))
+            i += 1
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=writer)] + [
+        threading.Thread(target=reader, args=(i,)) for i in range(4)]
+    began = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - began
+
+@scenario('contents', 'contents() over --keys keys')
+def contents(context):
+    context.storage.write_many({f'key_{i}': i + 1
+        for i in range(context.keys)}, wait=True)
+    return [timed(context.storage.contents) for i in range(10)]
+
+@scenario('archive', 'archive() of --archive-mb MiB of data')
+def archive(context):
+    blob = payload(context, LARGE_PAYLOAD)
+    for i in range(context.archive_mb):
+        context.storage.write(f'archived_{i}', blob, wait=True)
+    target = context.storage.working_dir_path.joinpath('_archive')
+    return [timed(context.storage.archive, target=target.joinpath(str(i)),
+        compression_format='gztar') for i in range(3)]
+
+@scenario('resolve_path', 'db_relative_path() of a recently used key')
+def resolve_path(context):
+    names = [f'key_{i % 100}' for i in range(context.iterations * 10)]
+    return [timed(db_relative_path, name) for name in names]
+
+def _hmac_scenario(label, size, algorithm='sha256'):
+    name = f'hmac_{label}' if algorithm == 'sha256' else f'{algorithm}_{label}'
+
+    @scenario(name, f'{algorithm} keyed digest of {size} bytes')
+    def hmac_digest(context):
+        signer = HMACMixin()
+        signer.hashing_algorithm = algorithm
+        data = payload(context, size)
+        return [timed(signer.hmac_digest, data)
+            for i in range(context.iterations)]
+
+for label, size in HMAC_PAYLOADS.items():
+    _hmac_scenario(label, size)
+_hmac_scenario('1m', HMAC_PAYLOADS['1m'], 'blake2b')
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+def summarise(latencies, elapsed, peak_memory):
+    """ Result of one scenario: throughput, latency percentiles in
+    milliseconds and peak traced memory in bytes. """
+
+    ordered = sorted(latencies)
+    return {
+        'ops': len(ordered),
+        'seconds': elapsed,
+        'ops_per_sec': len(ordered) / elapsed if elapsed else None,
+        'p50_ms': percentile(ordered, 0.5) * 1000 if ordered else None,
+        'p99_ms': percentile(ordered, 0.99) * 1000 if ordered else None,
+        'peak_memory_bytes': peak_memory,
+    }
+
+def run_benchmarks(names=None, iterations=200, keys=1000, archive_mb=16,
+    seed=0, memory=True):
+    """ Run the named scenarios (default all) and return their results.
+
+    Each scenario runs twice in its own empty store: once timed, and once
+    under tracemalloc, which would otherwise skew the timings, to find its
+    peak memory use. """
+
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'iterations': iterations,
+            'keys': keys,
+            'archive_mb': archive_mb,
+            'seed': seed,
+        },
+        'scenarios': {},
+    }
+
+    original_dir = storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY
+    temp_dir = tempfile.mkdtemp(prefix='pickle_storage_bench_')
+    try:
+        for name in names or SCENARIOS:
+            description, fn = SCENARIOS[name]
+            latencies, elapsed = _run_scenario(fn, temp_dir, iterations, keys,
+                archive_mb, seed)
+            peak_memory = None
+            if memory:
+                tracemalloc.start()
+                try:
+                    _run_scenario(fn, temp_dir, iterations, keys, archive_mb,
+                        seed)
+                    peak_memory = tracemalloc.get_traced_memory()[1]
+                finally:
+                    tracemalloc.stop()
+            results['scenarios'][name] = dict(summarise(latencies, elapsed,
+                peak_memory), description=description)
+    finally:
+        storage_settings.update_setting('PICKLE_STORAGE_WORKING_DIRECTORY',
+            original_dir)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return results
+
+def _run_scenario(fn, temp_dir, iterations, keys, archive_mb, seed):
+    working_dir = pathlib.Path(temp_dir, 'store')
+    shutil.rmtree(working_dir, ignore_errors=True)
+    storage_settings.update_setting('PICKLE_STORAGE_WORKING_DIRECTORY',
+        str(working_dir))
+    storage = BaseStorageContainer(working_dir_path=working_dir)
+    context = BenchmarkContext(storage, iterations, keys, archive_mb,
+        random.Random(seed))
+    latencies = fn(context)
+    if isinstance(latencies, tuple):
+        return latencies
+    return latencies, sum(latencies)
+
+def compare(results, baseline, tolerance=0.2):
+    """ Compare results with baseline, both as returned by
+    run_benchmarks(). Returns a {scenario: change} mapping, change holding
+    the relative change in throughput and p99 latency and whether either
+    is a regression beyond tolerance. """
+
+    changes = {}
+    for name, result in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        change = {'regression': False}
+        for metric, worse_when in (('ops_per_sec', -1), ('p99_ms', 1)):
+            if not result.get(metric) or not previous.get(metric):
+                continue
+            relative = result[metric] / previous[metric] - 1
+            change[metric] = relative
+            if relative * worse_when > tolerance:
+                change['regression'] = True
+        changes[name] = change
+    return changes
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pickle_storage.benchmarks',
+        description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scenarios', help='Comma separated names, out of: '
+        + ', '.join(SCENARIOS))
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--keys', type=int, default=1000)
+    parser.add_argument('--archive-mb', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true',
+        help='Skip the tracemalloc pass')
+    parser.add_argument('--output', help='Also write the results here')
+    parser.add_argument('--baseline', help='Results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    names = args.scenarios.split(',') if args.scenarios else None
+    results = run_benchmarks(names, args.iterations, args.keys,
+        args.archive_mb, args.seed, memory=not args.no_memory)
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['comparison'] = compare(results, json.load(f),
+                args.tolerance)
+        if any(change['regression']
+            for change in results['comparison'].values()):
+            status = 1
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        pathlib.Path(args.output).write_text(output + '\n')
+    print(output)
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
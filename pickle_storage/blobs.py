@@ -0,0 +1,161 @@
+""" Content-addressed blobs for deduplicated writes.
+
+With PICKLE_STORAGE_DEDUP, a secure write stores its framed payload once as
+a blob named by the sha256 of its header and body, under _blobs/, and the
+key file only holds a small signed reference to it (a frame flagged
+FLAG_REFERENCE whose payload is the blob's digest). Blobs are laid out like
+framed files, with the sha256 in place of the HMAC, so a blob is verified
+against the digest its signed reference names. Writing a value whose blob
+already exists writes the reference alone.
+
+Blobs are never changed once written. Ones no key refers to any more are
+removed by collect_garbage(), which counts references by scanning key
+files. """
+
+import collections
+import hashlib
+import hmac
+import os
+import pathlib
+import time
+
+from pickle_storage.errors import IntegrityError
+from pickle_storage.fileformat import (DIGEST_SIZE, FLAG_REFERENCE, HEADER,
+    MAGIC, pack_frame, unpack_frame)
+from pickle_storage.utils import atomic_write, key_files
+from pickle_storage.config.tools import get_settings_config
+storage_settings = get_settings_config()
+
+__all__ = ['BLOB_DIRECTORY', 'blob_digest', 'blob_path', 'collect_garbage',
+    'pack_reference', 'read_reference', 'reference_counts', 'verify_blob',
+    'write_blob']
+
+BLOB_DIRECTORY = '_blobs'
+
+# Blobs are hashed in slices of this many bytes
+BLOB_CHUNK_SIZE = 1024 * 1024
+
+def blob_digest(parts):
+    """ sha256 digest of the bytes-like parts, in order. """
+
+    digest = hashlib.sha256()
+    for part in parts:
+        if len(part) <= BLOB_CHUNK_SIZE:
+            digest.update(part)
+            continue
+        with memoryview(part) as view:
+            for offset in range(0, len(view), BLOB_CHUNK_SIZE):
+                digest.update(view[offset:offset + BLOB_CHUNK_SIZE])
+    return digest.digest()
+
+def blob_path(digest, working_dir_path=None):
+    """ Path of the blob with the given digest, one directory per first hex
+    byte so no directory grows too large. """
+
+    if working_dir_path is None:
+        working_dir_path = storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY
+    name = digest.hex()
+    return pathlib.Path(working_dir_path, BLOB_DIRECTORY, name[:2], name)
+
+def write_blob(header, body, durability='none', working_dir_path=None):
+    """ Store the framed file header + body as a blob unless it already
+    exists. Returns (digest, bytes written), writing nothing when the blob
+    was already there; its mtime is refreshed instead so that garbage
+    collection running at the same time leaves it alone. """
+
+    digest = blob_digest([header] + body)
+    path = blob_path(digest, working_dir_path)
+    try:
+        os.utime(path)
+        return digest, 0
+    except FileNotFoundError:
+        pass
+    stat = atomic_write(path, [header, digest] + body, durability)
+    return digest, stat.st_size
+
+def verify_blob(view, digest):
+    """ Unpack the blob in view, checking it against the digest its
+    reference names. Returns its Frame. Raises IntegrityError. """
+
+    frame = unpack_frame(view)
+    if not hmac.compare_digest(frame.digest, digest) or not \
+        hmac.compare_digest(blob_digest(frame.signed), digest):
+        raise IntegrityError(f'Blob "{digest.hex()}" does not match its '
+            'digest.')
+    return frame
+
+def pack_reference(digest, algorithm='sha256'):
+    """ Header and body of a reference to the blob digest, to be signed with
+    algorithm like any other framed file. """
+
+    return pack_frame(digest, flags=FLAG_REFERENCE, algorithm=algorithm)
+
+def read_reference(path):
+    """ Digest of the blob the key file at path refers to, or None if it
+    holds its value itself. Does not verify the reference's signature. """
+
+    with open(path, 'rb') as f:
+        head = f.read(HEADER.size + DIGEST_SIZE + DIGEST_SIZE + 1)
+    if (len(head) != HEADER.size + DIGEST_SIZE * 2 or head[:4] != MAGIC
+        or not head[5] & FLAG_REFERENCE):
+        return None
+    return head[HEADER.size + DIGEST_SIZE:]
+
+def reference_counts(working_dir_path, suffix=None, depth=None):
+    """ Number of key files referring to each blob digest. """
+
+    if suffix is None:
+        suffix = storage_settings.PICKLE_STORAGE_SUFFIX
+    if depth is None:
+        depth = storage_settings.PICKLE_STORAGE_SHARD_DEPTH
+    counts = collections.Counter()
+    for path in key_files(working_dir_path, suffix, depth):
+        try:
+            digest = read_reference(path)
+        except FileNotFoundError:
+            continue
+        if digest is not None:
+            counts[digest] += 1
+    return counts
+
+def collect_garbage(working_dir_path, grace=None):
+    """ Remove blobs that no key refers to. Blobs written or reused less than
+    grace seconds ago (PICKLE_STORAGE_DEDUP_GC_GRACE by default) are kept,
+    since their references may still be on their way. Returns the number of
+    blobs removed.
+
+    Writers reusing a blob refresh its mtime. So that one doing so during
+    the scan is never missed, even without locking, a blob is moved aside
+    before it is removed and its mtime checked again: a writer that came
+    before the move shows in it, and one that came after found no blob and
+    wrote it again. """
+
+    if grace is None:
+        grace = storage_settings.PICKLE_STORAGE_DEDUP_GC_GRACE
+    working_dir_path = pathlib.Path(working_dir_path)
+    referenced = reference_counts(working_dir_path)
+    cutoff = time.time_ns() - int(grace * 1e9)
+    removed = 0
+    for path in working_dir_path.joinpath(BLOB_DIRECTORY).glob('*/*'):
+        if path.name.startswith('.'): # Unfinished write
+            continue
+        try:
+            digest = bytes.fromhex(path.name)
+        except ValueError:
+            continue
+        if digest in referenced:
+            continue
+        doomed = path.with_name(f".{path.name}.gc")
+        try:
+            if path.stat().st_mtime_ns > cutoff:
+                continue
+            os.replace(path, doomed)
+        except FileNotFoundError:
+            continue
+        if doomed.stat().st_mtime_ns > cutoff:
+            # Reused meanwhile; any copy written since is identical
+            os.replace(doomed, path)
+            continue
+        doomed.unlink()
+        removed += 1
+    return removed
@@ -0,0 +1,83 @@
+import collections
+import os
+import threading
+
+__all__ = ['ReadCache', 'file_signature']
+
+def file_signature(path):
+    """ Cheap identity of a file's current contents. Atomic replacement,
+    rewrites and truncation all change at least one of the fields. """
+
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+class ReadCache():
+    """ LRU cache of decoded objects, keyed by path and bounded both by entry
+    count and by the combined on-disk size of the cached files.
+
+    Entries are only returned while the file signature they were stored with
+    still matches, so hits skip HMAC verification and unpickling but never
+    return data older than what is on disk. Cached objects are shared between
+    callers and should be treated as read-only. """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, path, signature):
+        """ Return (True, value) on a hit and (False, None) otherwise. """
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry[0] != signature:
+                if entry is not None:
+                    self._remove(path)
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(path)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, path, signature, value, size=None):
+        if size is None:
+            size = signature[1]
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if path in self._entries:
+                self._remove(path)
+            self._entries[path] = (signature, value, size)
+            self.current_bytes += size
+            while (len(self._entries) > self.max_entries
+                or self.current_bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, path):
+        with self._lock:
+            if path in self._entries:
+                self._remove(path)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        return {'entries': len(self._entries), 'bytes': self.current_bytes,
+            'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions}
+
+    def _remove(self, path):
+        signature, value, size = self._entries.pop(path)
+        self.current_bytes -= size
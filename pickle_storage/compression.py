@@ -0,0 +1,49 @@
+import bz2
+import lzma
+import zlib
+
+from pickle_storage.errors import ConfigError, IntegrityError
+
+__all__ = ['CODECS', 'CODEC_RAW', 'codec_id', 'compress', 'decompress']
+
+CODEC_RAW = 0
+
+# Identifier stored in the file header: (name, module). Identifiers must never
+# be reused, since existing files refer to them.
+CODECS = {
+    1: ('zlib', zlib),
+    2: ('bz2', bz2),
+    3: ('lzma', lzma),
+}
+
+def codec_id(name):
+    """ Header identifier for a codec name, CODEC_RAW for None. """
+
+    if not name:
+        return CODEC_RAW
+    for identifier, (codec_name, module) in CODECS.items():
+        if codec_name == name:
+            return identifier
+    raise ConfigError(f'Unknown compression codec "{name}".')
+
+def compress(name, data, threshold=0):
+    """ Compress data with the named codec. Returns (codec identifier, data);
+    data shorter than threshold, or that does not shrink, is left raw. """
+
+    identifier = codec_id(name)
+    if identifier == CODEC_RAW or len(data) < threshold:
+        return CODEC_RAW, data
+
+    compressed = CODECS[identifier][1].compress(data)
+    if len(compressed) >= len(data):
+        return CODEC_RAW, data
+    return identifier, compressed
+
+def decompress(identifier, data):
+    if identifier == CODEC_RAW:
+        return data
+    try:
+        module = CODECS[identifier][1]
+    except KeyError:
+        raise IntegrityError(f'Unknown compression codec {identifier}.')
+    return module.decompress(data)
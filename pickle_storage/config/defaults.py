@@ -2,5 +2,137 @@ from pathlib import Path
 
 PICKLE_STORAGE_SUFFIX = '.psf'
 PICKLE_STORAGE_WORKING_DIRECTORY = 'data_dir'
+# Or 'pickle_storage.segments.SegmentStorageContainer' for a log-structured store,
+# or 'pickle_storage.snapshot.SnapshotStorageContainer' to read from snapshot
+# images only
 PICKLE_STORAGE_CONTAINER_CLASS = 'pickle_storage.container.BaseStorageContainer'
-PICKLE_STORAGE_SIGNING_KEY_FILENAME = 'pssk'
\ No newline at end of file
+PICKLE_STORAGE_SIGNING_KEY_FILENAME = 'pssk'
+
+# Shared executor used to run storage operations
+PICKLE_STORAGE_MAX_WORKERS = 8
+PICKLE_STORAGE_MAX_QUEUE_SIZE = 256
+PICKLE_STORAGE_SUBMIT_TIMEOUT = None # Seconds, None blocks until a slot frees up
+
+# Retired signing keys still accepted when verifying reads, in addition to
+# those BaseStorageContainer.rotate_signing_key() records in the store
+PICKLE_STORAGE_RETIRED_SIGNING_KEY_FILENAMES = []
+
+# In-process cache of decoded reads, validated against file stat. Set
+# PICKLE_STORAGE_READ_CACHE_MAX_ENTRIES to 0 to disable it.
+PICKLE_STORAGE_READ_CACHE_MAX_ENTRIES = 0
+PICKLE_STORAGE_READ_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Durability of writes: 'none', 'file' (fsync data) or 'directory' (fsync data
+# and the directory entry). Writes are always atomic.
+PICKLE_STORAGE_DURABILITY = 'none'
+
+# Files of at least this many bytes are memory-mapped when read. None disables.
+PICKLE_STORAGE_MMAP_THRESHOLD = 16 * 1024 * 1024
+
+# Store large pickle buffers out-of-band (protocol 5) so they can be mapped
+# rather than copied on read.
+PICKLE_STORAGE_OUT_OF_BAND = False
+PICKLE_STORAGE_OUT_OF_BAND_THRESHOLD = 64 * 1024
+
+# Pickle protocol and compression of stored payloads. Payloads smaller than
+# the threshold are stored uncompressed.
+PICKLE_STORAGE_PICKLE_PROTOCOL = 4
+PICKLE_STORAGE_COMPRESSION = None # 'zlib', 'bz2' or 'lzma'
+PICKLE_STORAGE_COMPRESSION_THRESHOLD = 1024
+
+# pickle_storage.segments.SegmentStorageContainer: size at which a new segment
+# is started, and how often (seconds, None disables) segments whose live
+# records fall below the compaction ratio of their size are rewritten.
+PICKLE_STORAGE_SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+PICKLE_STORAGE_SEGMENT_COMPACTION_RATIO = 0.5
+PICKLE_STORAGE_SEGMENT_COMPACTION_INTERVAL = 60
+
+# Spread keys over nested shard directories picked by a hash of the key, so
+# no single directory grows too large. Depth 0 keeps every key in the working
+# directory itself. Use BaseStorageContainer.migrate_layout(), passing the
+# previous values, after changing either setting for an existing store.
+PICKLE_STORAGE_SHARD_DEPTH = 0
+PICKLE_STORAGE_SHARD_FANOUT = 256
+
+# Coordinate processes sharing the working directory with fcntl locks: readers
+# lock keys shared and writers exclusive, and clear()/archive() lock the whole
+# store. Keys share LOCK_STRIPES lock files. Waiting longer than LOCK_TIMEOUT
+# seconds (None waits forever) raises LockTimeout.
+PICKLE_STORAGE_LOCKING = False
+PICKLE_STORAGE_LOCK_STRIPES = 1024
+PICKLE_STORAGE_LOCK_TIMEOUT = 10.0
+
+# Hold plain writes in memory and write them in batches, so a key rewritten
+# many times between flushes is only written once. Buffered values are flushed
+# every INTERVAL seconds, once MAX_PENDING keys are waiting and at exit, and
+# are lost if the process dies first. Reads see buffered values.
+PICKLE_STORAGE_WRITE_BEHIND = False
+PICKLE_STORAGE_WRITE_BEHIND_INTERVAL = 1.0
+PICKLE_STORAGE_WRITE_BEHIND_MAX_PENDING = 1000
+
+# Keep an in-memory manifest of stored keys so contents() and exists() do not
+# touch the filesystem. Only writes made through this process are tracked.
+PICKLE_STORAGE_MANIFEST = False
+
+# Make archive() write incremental snapshots rather than full archive files
+PICKLE_STORAGE_ARCHIVE_INCREMENTAL = False
+
+# Operations an AsyncStorageContainer keeps in flight at once, None to use the
+# executor's capacity (MAX_WORKERS + MAX_QUEUE_SIZE)
+PICKLE_STORAGE_ASYNC_CONCURRENCY = None
+
+# Where operation metrics are sent: import path of a
+# pickle_storage.metrics.MetricsSink subclass, or None to discard them
+PICKLE_STORAGE_METRICS_SINK = 'pickle_storage.metrics.MemorySink'
+
+# Buckets a new pickle_storage.mapping.PersistentDict spreads its fields over,
+# and the fields per bucket aimed for when it is given an expected_size. The
+# bucket count cannot change once the collection exists.
+PICKLE_STORAGE_PERSISTENT_DICT_BUCKETS = 256
+PICKLE_STORAGE_PERSISTENT_DICT_BUCKET_SIZE = 1024
+
+# Store each distinct value once, as a content-addressed blob under _blobs/,
+# with key files holding signed references to it. Writing a value that is
+# already stored only writes the reference. BaseStorageContainer.
+# collect_garbage() removes blobs no key refers to, other than ones written in
+# the last DEDUP_GC_GRACE seconds.
+PICKLE_STORAGE_DEDUP = False
+PICKLE_STORAGE_DEDUP_GC_GRACE = 60.0
+
+# Keyed digest signing new files: 'sha256' (HMAC), or 'blake2b' or 'blake2s'
+# in their native keyed modes, faster on CPUs without SHA instructions (compare
+# the hmac_1m and blake2b_1m benchmarks). Each file records its algorithm, so
+# changing this leaves existing files readable.
+PICKLE_STORAGE_DIGEST_ALGORITHM = 'sha256'
+
+# Processes BaseStorageContainer.verify() checks files with, None for one per
+# CPU
+PICKLE_STORAGE_VERIFY_WORKERS = None
+
+# pickle_storage.snapshot.SnapshotStorageContainer: check every entry of an
+# image against its digest when opening it, not just the signed index (entries
+# are already verified when the image is built), and how often (seconds, None
+# disables) reads look for a newer image.
+PICKLE_STORAGE_SNAPSHOT_VERIFY = False
+PICKLE_STORAGE_SNAPSHOT_REFRESH_INTERVAL = 1.0
+
+# Keys written with a TTL read as missing once it runs out. Each process reads
+# other processes' TTLs from the on-disk expiry index at most every
+# EXPIRY_REFRESH_INTERVAL seconds.
+PICKLE_STORAGE_EXPIRY_REFRESH_INTERVAL = 1.0
+
+# Budget of the store: once it holds more than MAX_BYTES bytes or MAX_ENTRIES
+# keys (None for no limit), keys are evicted least recently ('lru') or least
+# frequently ('lfu') used first. Use is tracked by each process separately;
+# the size of the store is rescanned every USAGE_RELOAD_INTERVAL seconds
+# (None for only once) to count other processes' writes.
+PICKLE_STORAGE_MAX_BYTES = None
+PICKLE_STORAGE_MAX_ENTRIES = None
+PICKLE_STORAGE_EVICTION_POLICY = 'lru'
+PICKLE_STORAGE_USAGE_RELOAD_INTERVAL = 10.0
+
+# Expired keys are deleted, and keys evicted, by a background sweep every
+# SWEEP_INTERVAL seconds (None disables it), at most SWEEP_BATCH of each
+# per sweep.
+PICKLE_STORAGE_SWEEP_INTERVAL = 1.0
+PICKLE_STORAGE_SWEEP_BATCH = 1000
@@ -1,13 +1,15 @@
 import logging
 import os
+import threading
 import pathlib
 import functools
 import importlib
 
 from pickle_storage.errors import ConfigError
-from pickle_storage.utils import write_to_log, import_class
+from pickle_storage.utils import write_to_log, import_class, clear_path_cache
 
-__all__ = ['ConfigObject', 'import_class']
+__all__ = ['ConfigObject', 'import_class', 'get_settings_config',
+    'storage_settings']
 
 class ConfigObject():
     """ Respresents the current settings specified for the pickle_storage package. """
@@ -19,12 +21,17 @@ class ConfigObject():
             - required_modules (list): List of modules that need to be imported before
             we can safely import the user_defined_settings module, which ight depend on them. 
         """
-        required_modules = ['pickle_storage.config.defaults'] + required_modules
-        for m in required_modules:
+        self.required_modules = ['pickle_storage.config.defaults'] + required_modules
+        self.user_defined_settings = user_defined_settings
+        self.load()
+
+    def load(self):
+        """ Apply the default, required and user defined settings modules. """
+
+        for m in self.required_modules:
             self.apply_from_module(m)
         
         #Find default settings module
-        self.user_defined_settings = user_defined_settings
         settings_modules = []
         
 
@@ -61,10 +68,40 @@ class ConfigObject():
         instance = StorageClass()
         return instance
         
+    def invalidate(self):
+        """ Drop anything derived from the current settings values. """
+        clear_path_cache()
+
+    def reload(self):
+        """ Re-read all settings modules in place, so that existing references
+        to this object see the new values. """
+
+        self.load()
+        self.invalidate()
+
     def update_setting(self, setting_name, value):
         setattr(self, setting_name, value)
+        self.invalidate()
+
+_settings_config = None
+_settings_lock = threading.Lock()
 
-# storage_settings  = ConfigObject()
-# @functools.lru_cache
 def get_settings_config(required_modules=[]):
-    return ConfigObject(required_modules=required_modules)
\ No newline at end of file
+    """ Return the process-wide ConfigObject, creating it on first use. Any
+    required_modules not yet applied are applied to the shared object. """
+
+    global _settings_config
+    if _settings_config is None:
+        with _settings_lock:
+            if _settings_config is None:
+                _settings_config = ConfigObject(
+                    required_modules=list(required_modules))
+                return _settings_config
+
+    for m in required_modules:
+        if m not in _settings_config.required_modules:
+            _settings_config.required_modules.append(m)
+            _settings_config.apply_from_module(m)
+    return _settings_config
+
+storage_settings = get_settings_config()
\ No newline at end of file
@@ -1,11 +1,28 @@
+import contextlib
+import functools
+import os
 import pathlib
 import uuid
 import time
 import shutil
 import datetime
 
-from pickle_storage.utils import db_relative_path, write_to_log
-from pickle_storage.operations import Write, Read
+from pickle_storage.archive import (ARCHIVE_DIRECTORY, create_snapshot,
+    latest_snapshot, make_full_archive, restore_snapshot)
+from pickle_storage.blobs import collect_garbage
+from pickle_storage.cache import ReadCache, file_signature
+from pickle_storage.errors import DBOperationError, ForbiddenFileError
+from pickle_storage.eviction import ExpiryIndex, Sweeper, UsageTracker
+from pickle_storage.locks import LOCK_DIRECTORY, LockManager
+from pickle_storage.manifest import Manifest, paginate
+from pickle_storage.metrics import EVICTIONS, get_sink
+from pickle_storage.utils import (db_relative_path, key_files,
+    migrate_layout, write_to_log)
+from pickle_storage.operations import Write, Read, WriteMany, ReadMany
+from pickle_storage.writebehind import WriteBehindBuffer
+from pickle_storage.mixins import (HMACMixin, retired_key_ids,
+    save_retired_key_ids, signing_key_filenames)
+from pickle_storage.verify import verify_store
 from pickle_storage.config.tools import get_settings_config
 storage_settings = get_settings_config()
 
@@ -14,65 +31,641 @@ class BaseStorageContainer():
     def __init__(self, *args, **kwargs):
         self.working_dir_path = kwargs.get("working_dir_path", pathlib.Path(
             storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY))
-        self.signing_key_path = kwargs.get("signing_key_path", pathlib.Path(
+        self.signing_key_path = kwargs.get("signing_key_path", db_relative_path(
             storage_settings.PICKLE_STORAGE_SIGNING_KEY_FILENAME))
+        # Defaults are only built when not given, since some start threads
+        self.read_cache = kwargs["read_cache"] if "read_cache" in kwargs \
+            else self.create_read_cache()
+        self.compression = kwargs.get("compression", None)
+        self.manifest = kwargs["manifest"] if "manifest" in kwargs \
+            else self.create_manifest()
+        self.locks = kwargs["locks"] if "locks" in kwargs \
+            else self.create_locks()
+        self.write_buffer = kwargs["write_buffer"] \
+            if "write_buffer" in kwargs else self.create_write_buffer()
+        self.expiry = kwargs["expiry"] if "expiry" in kwargs \
+            else self.create_expiry()
+        self.usage = kwargs["usage"] if "usage" in kwargs \
+            else self.create_usage_tracker()
+        self.sweeper = None
         self.setup()
+        if self.usage is not None or (self.expiry is not None
+            and self.expiry.path.exists()):
+            self.start_sweeper()
 
     def archive(self, *args, target=None, compression_format="gztar",
-        time_format='%d_%m_%y_%H_%M_%S'):
+        time_format='%d_%m_%y_%H_%M_%S', incremental=None, workers=None):
+        """ Archive the store, leaving out previous archives.
+
+        By default a single archive file is written in compression_format.
+        With incremental (default PICKLE_STORAGE_ARCHIVE_INCREMENTAL), a
+        snapshot directory is written instead, holding only files changed
+        since the previous snapshot, compressed in parallel; see
+        pickle_storage.archive.create_snapshot. Restore one with
+        restore(). """
 
         # Specified format may not always be avaiable.
         format_options = [ x[0] for x in shutil.get_archive_formats()]
         if compression_format not in format_options:
             compression_format = format_options[0]
+        if incremental is None:
+            incremental = storage_settings.PICKLE_STORAGE_ARCHIVE_INCREMENTAL
+        self.flush()
+        # Expiry times are not archived, expired keys would come back to life
+        self.sweep()
 
         file_name = datetime.datetime.strftime(datetime.datetime.now(),
             time_format)
-        source = pathlib.Path(storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY)
+        archive_root = self.working_dir_path.joinpath(ARCHIVE_DIRECTORY)
+
+        if incremental:
+            with self.store_locked():
+                return create_snapshot(self.working_dir_path,
+                    target or archive_root,
+                    compression_format=compression_format, workers=workers)
 
         if not target:
-            target = pathlib.Path(
-                storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY,
-                '_archive', file_name)
+            target = archive_root.joinpath(file_name)
 
-        shutil.make_archive(target, compression_format, source)
+        with self.store_locked():
+            make_full_archive(target, compression_format,
+                self.working_dir_path)
         return target
 
+    def begin_write(self):
+        if self.manifest is not None:
+            self.manifest.begin_write()
+
+    def buffer_write(self, path, content, wait=False, buffered=None,
+        **kwargs):
+        """ Hold a write in the write buffer if one is enabled and the write
+        is a plain one that is not waited for. Returns its PendingWrite, or
+        None if it has to be written straight away, in which case any value
+        buffered for path has been flushed first. """
+
+        if self.write_buffer is None or buffered is False or not path:
+            return None
+
+        on_complete = kwargs.pop('on_complete', None)
+        resolved_path = db_relative_path(path)
+        if (not wait and not kwargs and content
+            and resolved_path.name not in signing_key_filenames()):
+            self.invalidate_cached(resolved_path)
+            if self.expiry is not None:
+                # The new value has no TTL
+                self.expiry.set_many({resolved_path.name: None})
+            return self.write_buffer.put(resolved_path, content, on_complete)
+        self.write_buffer.flush([resolved_path])
+        return None
+
+    def buffered_values(self, keys):
+        """ Values of keys that are waiting in the write buffer. """
+
+        pending = {}
+        if self.write_buffer is not None:
+            for key in keys:
+                hit, value = self.write_buffer.get(key)
+                if hit:
+                    pending[key] = value
+        return pending
+
+    def build_image(self, target=None):
+        """ Freeze the store into a snapshot image for
+        pickle_storage.snapshot.SnapshotStorageContainer to serve reads
+        from, replacing the previous image atomically. Returns its path. """
+
+        # Imported here, the snapshot module builds on this one
+        from pickle_storage.snapshot import build_image
+        self.flush()
+        # Expired keys are left out of the image
+        self.sweep()
+        with self.store_locked(exclusive=False):
+            return build_image(self.working_dir_path, target)
+
+    def cache_lookup(self, path):
+        """ Look path up in the write buffer, then the read cache. Returns
+        (hit, value, signature); pass signature to cache_store() along with
+        the value read on a miss. Expired keys are hits with no value. """
+
+        if path and self.is_expired(path):
+            return True, None, None
+        if self.usage is not None and path:
+            self.usage.record_read(db_relative_path(path).name)
+
+        if self.write_buffer is not None and path:
+            hit, value = self.write_buffer.get(path)
+            if hit:
+                return True, value, None
+
+        if self.read_cache is None or not path:
+            return False, None, None
+
+        resolved_path = db_relative_path(path)
+        try:
+            signature = file_signature(resolved_path)
+        except FileNotFoundError:
+            self.read_cache.invalidate(resolved_path)
+            return False, None, None
+
+        hit, value = self.read_cache.get(resolved_path, signature)
+        return hit, value, signature
+
+    def cache_store(self, path, signature, value):
+        if signature is not None and value is not None:
+            self.read_cache.put(db_relative_path(path), signature, value)
+
     def clear(self):
-        shutil.rmtree(self.working_dir_path)
-        self.setup()
+        if self.write_buffer is not None:
+            self.write_buffer.clear()
+        if self.read_cache is not None:
+            self.read_cache.clear()
+        if self.expiry is not None:
+            self.expiry.clear()
+        if self.usage is not None:
+            self.usage.clear()
+        with self.store_locked():
+            if self.locks is None:
+                shutil.rmtree(self.working_dir_path)
+            elif self.working_dir_path.exists():
+                # Other processes may be waiting on the lock files
+                for path in self.working_dir_path.iterdir():
+                    if path.name == LOCK_DIRECTORY:
+                        continue
+                    if path.is_dir():
+                        shutil.rmtree(path)
+                    else:
+                        path.unlink()
+            self.setup()
+            if self.manifest is not None:
+                # Saved later like any other change; the old one is gone
+                self.manifest.clear()
         return True
 
-    def contents(self):
-        signing_key_path_with_ext = "".join([
-            storage_settings.PICKLE_STORAGE_SIGNING_KEY_FILENAME,
-            storage_settings.PICKLE_STORAGE_SUFFIX])
-        return filter(lambda x: signing_key_path_with_ext not in str(x),
-            pathlib.Path(
-                storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY).glob("*.psf")
-        )
+    def close(self):
+        """ Stop sweeping in the background and flush the write buffer. """
+
+        if self.sweeper is not None:
+            self.sweeper.close()
+            self.sweeper = None
+        if self.write_buffer is not None:
+            self.write_buffer.close()
+
+    def collect_garbage(self, grace=None):
+        """ Remove deduplicated blobs (PICKLE_STORAGE_DEDUP) that no key
+        refers to any more, other than ones written in the last grace
+        seconds. Returns the number removed. """
+
+        self.flush()
+        with self.store_locked():
+            return collect_garbage(self.working_dir_path, grace)
+
+    def contents(self, prefix='', start_after=None, limit=None):
+        """ Paths of stored keys in name order, optionally only those whose
+        names start with prefix, after the key start_after, and at most
+        limit of them. """
+
+        if start_after is not None:
+            start_after = db_relative_path(start_after).name
+        # Expired keys are dropped before the page is cut
+        expiring = self.expiry is not None and len(self.expiry)
+        page_limit = None if expiring else limit
+        if self.manifest is not None:
+            names = self.manifest.names(prefix, start_after, page_limit)
+        else:
+            key_filenames = signing_key_filenames()
+            names = paginate(sorted(path.name for path in key_files(
+                self.working_dir_path, storage_settings.PICKLE_STORAGE_SUFFIX,
+                storage_settings.PICKLE_STORAGE_SHARD_DEPTH)
+                if path.name not in key_filenames), prefix, start_after,
+                page_limit)
+        if self.write_buffer is not None:
+            names = paginate(sorted(set(names).union(
+                self.write_buffer.names())), prefix, start_after, page_limit)
+        if expiring:
+            names = [name for name in names if not self.is_expired(name)]
+            names = names[:limit] if limit is not None else names
+        return [db_relative_path(name) for name in names]
+
+    def create_expiry(self):
+        """ Build the ExpiryIndex recording TTLs given to write(). """
+
+        return ExpiryIndex(self.working_dir_path)
+
+    def create_locks(self):
+        """ Build the LockManager described by the settings, if locking is
+        enabled. """
+
+        if not storage_settings.PICKLE_STORAGE_LOCKING:
+            return None
+        return LockManager(self.working_dir_path)
+
+    def create_manifest(self):
+        """ Build the Manifest described by the settings, if enabled. """
+
+        if not storage_settings.PICKLE_STORAGE_MANIFEST:
+            return None
+        return Manifest(self.working_dir_path)
+
+    def create_read_cache(self):
+        """ Build the ReadCache described by the settings, if enabled. """
+
+        max_entries = storage_settings.PICKLE_STORAGE_READ_CACHE_MAX_ENTRIES
+        if not max_entries:
+            return None
+        return ReadCache(max_entries=max_entries,
+            max_bytes=storage_settings.PICKLE_STORAGE_READ_CACHE_MAX_BYTES)
 
     def create_signing_key(self):
         """ Create the key used to validate data integrity on subsequent reads/writes. """
 
-        if not self.signing_key_path.exists():
-            Write(self.signing_key_path, uuid.uuid4().bytes, secure=False).join()
+        if self.signing_key_path.exists():
+            return
+        # Only one of several processes starting at once may create it
+        locked = contextlib.nullcontext()
+        if self.locks is not None:
+            locked = self.locks.keys([self.signing_key_path], exclusive=True,
+                store=False)
+        with locked:
+            if not self.signing_key_path.exists():
+                Write(self.signing_key_path, uuid.uuid4().bytes,
+                    secure=False).join()
+
+    def create_usage_tracker(self):
+        """ Build the UsageTracker described by the settings, if the store
+        has a byte or entry budget. """
+
+        max_bytes = storage_settings.PICKLE_STORAGE_MAX_BYTES
+        max_entries = storage_settings.PICKLE_STORAGE_MAX_ENTRIES
+        if max_bytes is None and max_entries is None:
+            return None
+        return UsageTracker(storage_settings.PICKLE_STORAGE_EVICTION_POLICY,
+            max_bytes=max_bytes, max_entries=max_entries)
+
+    def create_write_buffer(self):
+        """ Build the WriteBehindBuffer described by the settings, if
+        enabled. """
+
+        if not storage_settings.PICKLE_STORAGE_WRITE_BEHIND:
+            return None
+        return WriteBehindBuffer(self,
+            interval=storage_settings.PICKLE_STORAGE_WRITE_BEHIND_INTERVAL,
+            max_pending=storage_settings.PICKLE_STORAGE_WRITE_BEHIND_MAX_PENDING)
+
+    def delete(self, path, expired=False):
+        """ Remove the key at path, including any value of it waiting in
+        the write buffer. Returns whether there was one. With expired, the
+        key is only removed if, under its lock, its file still holds the
+        value whose TTL ran out; a buffered value is left alone. """
+
+        resolved_path = db_relative_path(path)
+        name = resolved_path.name
+        if name in signing_key_filenames():
+            raise ForbiddenFileError('Permission denied.')
+
+        deleted = False
+        if self.write_buffer is not None and not expired:
+            deleted = self.write_buffer.discard(resolved_path)
+        locked = contextlib.nullcontext()
+        if self.locks is not None:
+            locked = self.locks.keys([resolved_path], exclusive=True)
+        with locked:
+            if expired and not self.expired_file(resolved_path):
+                return False
+            try:
+                resolved_path.unlink()
+                deleted = True
+            except FileNotFoundError:
+                pass
+
+        self.invalidate_cached(resolved_path)
+        if self.manifest is not None:
+            self.manifest.discard(name)
+        if self.expiry is not None:
+            self.expiry.set_many({name: None})
+        if self.usage is not None:
+            self.usage.remove(name)
+        return deleted
+
+    def end_write(self, op=None):
+        """ Bring the read cache and manifest up to date once a write
+        started with begin_write() has finished. """
+
+        if op is not None:
+            self.invalidate_cached(*op.target_paths())
+        if self.manifest is not None:
+            self.manifest.end_write(op.manifest_entries if op else None)
+
+    def expired_file(self, path):
+        """ Whether the file at path holds the value whose TTL ran out,
+        rather than one written since. The expiry time of a file that was
+        replaced without one being recorded, by restore() for instance, is
+        dropped. """
+
+        try:
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            mtime = None
+        # Stat first: a record is always written before its file appears
+        self.expiry.refresh()
+        name = path.name
+        if not self.expiry.expired(name):
+            return False
+        if mtime is not None and mtime > self.expiry.recorded_at(name):
+            self.expiry.set_many({name: None})
+            return False
+        return True
 
     def exists(self, file_name):
+        if self.is_expired(file_name):
+            return False
+        if (self.write_buffer is not None
+            and self.write_buffer.get(file_name)[0]):
+            return True
+        if self.manifest is not None:
+            return db_relative_path(file_name).name in self.manifest
         return db_relative_path(file_name).exists()
 
-    def read(self, *args, **kwargs):
-        th = Read(*args, **kwargs)
-        return th.join()
+    def flush(self):
+        """ Write every value held in the write buffer to disk. Returns the
+        number of keys written. """
+
+        if self.write_buffer is None:
+            return 0
+        return self.write_buffer.flush()
+
+    def invalidate_cached(self, *paths):
+        """ Drop paths from the read cache. """
+
+        if self.read_cache is not None:
+            for path in paths:
+                self.read_cache.invalidate(db_relative_path(path))
+
+    def is_expired(self, path):
+        """ Whether the key at path outlived the TTL it was written with. """
+
+        return (self.expiry is not None
+            and self.expiry.expired(db_relative_path(path).name))
+
+    def migrate_layout(self, from_depth=0, from_fanout=None):
+        """ Move every key stored from_depth levels deep by from_fanout, the
+        previous shard settings, to where the current
+        PICKLE_STORAGE_SHARD_DEPTH and PICKLE_STORAGE_SHARD_FANOUT place it.
+        from_fanout defaults to the current fanout. Returns the number of
+        keys moved. Other processes must not use the store while it runs. """
+
+        self.flush()
+        with self.store_locked():
+            moved = migrate_layout(self.working_dir_path,
+                storage_settings.PICKLE_STORAGE_SUFFIX,
+                storage_settings.PICKLE_STORAGE_SHARD_DEPTH,
+                storage_settings.PICKLE_STORAGE_SHARD_FANOUT,
+                keep=signing_key_filenames(), from_depth=from_depth,
+                from_fanout=from_fanout)
+        if self.read_cache is not None:
+            self.read_cache.clear()
+        if self.manifest is not None:
+            self.manifest.rebuild()
+        return moved
+
+    def read(self, path='', *args, **kwargs):
+        hit, value, signature = self.cache_lookup(path)
+        if hit:
+            return value
+        value = self.read_operation(path, *args, **kwargs).join()
+        self.cache_store(path, signature, value)
+        return value
+
+    def read_many(self, keys, **kwargs):
+        """ Read several keys in one operation. Returns a BatchResult mapping
+        each key read to its value, with failures in its ``errors``. """
+
+        pending = self.buffered_values(keys)
+        result = self.read_many_operation([key for key in keys
+            if key not in pending], **kwargs).join()
+        result.update(pending)
+        return result
+
+    def read_many_operation(self, keys, **kwargs):
+        """ Start reading keys, bypassing the read cache. Returns the pending
+        operation handle. Expired keys are reported missing. """
+
+        expired = [key for key in keys if self.is_expired(key)]
+        if expired:
+            keys = [key for key in keys if key not in expired]
+        if self.usage is not None:
+            for key in keys:
+                self.usage.record_read(db_relative_path(key).name)
+        op = ReadMany(keys, locks=self.locks, **kwargs)
+        if expired:
+            op.add_done_callback(functools.partial(self.report_expired,
+                expired))
+        return op
+
+    def read_operation(self, path='', *args, **kwargs):
+        """ Start reading path, bypassing the read cache. Returns the pending
+        operation handle. """
+
+        return Read(path, *args, locks=self.locks, **kwargs)
+
+    def record_write(self, ttl, op):
+        """ Record the sizes of the keys op wrote; their expiry times were
+        recorded by op itself. """
+
+        # Every file written successfully has a manifest entry
+        key_filenames = signing_key_filenames()
+        entries = {name: entry for name, entry in op.manifest_entries.items()
+            if name not in key_filenames}
+        if not entries:
+            return
+        if ttl is not None:
+            self.start_sweeper()
+        if self.usage is not None:
+            for name, entry in entries.items():
+                self.usage.record_write(name, entry.size)
+            if self.usage.over_budget() and self.sweeper is not None:
+                self.sweeper.wake()
+
+    def report_expired(self, keys, op):
+        if op._return is not False:
+            for key in keys:
+                op._return.errors[key] = FileNotFoundError(key)
+
+    def restore(self, snapshot=None):
+        """ Replace the store's contents with a snapshot taken by
+        archive(incremental=True), by default the latest one. """
+
+        if snapshot is None:
+            snapshot = latest_snapshot(
+                self.working_dir_path.joinpath(ARCHIVE_DIRECTORY))
+            if snapshot is None:
+                raise DBOperationError('There is no snapshot to restore; '
+                    'take one with archive(incremental=True).')
+        if self.write_buffer is not None:
+            self.write_buffer.clear()
+        with self.store_locked():
+            count = restore_snapshot(snapshot, self.working_dir_path)
+        if self.read_cache is not None:
+            self.read_cache.clear()
+        if self.manifest is not None:
+            self.manifest.rebuild()
+        return count
+
+    def rotate_signing_key(self):
+        """ Retire the current signing key and create a new one. Returns the
+        name the old key was saved under. It is recorded in the store, so
+        every process keeps accepting it for reads until its file is
+        removed. """
+
+        retired_name = "{}_{}".format(
+            storage_settings.PICKLE_STORAGE_SIGNING_KEY_FILENAME,
+            time.time_ns())
+        with self.store_locked():
+            # Read while the key that signed the list is still active
+            recorded = [name for name in retired_key_ids() if name not in
+                storage_settings.PICKLE_STORAGE_RETIRED_SIGNING_KEY_FILENAMES]
+            # Not yet listed as a key, so db_relative_path would shard it
+            os.replace(self.signing_key_path, self.signing_key_path.with_name(
+                f"{retired_name}{storage_settings.PICKLE_STORAGE_SUFFIX}"))
+            self.create_signing_key()
+            save_retired_key_ids([retired_name] + recorded)
+        return retired_name
+
+    def start_sweeper(self):
+        """ Start sweeping in the background every
+        PICKLE_STORAGE_SWEEP_INTERVAL seconds, if it is not already. """
+
+        interval = storage_settings.PICKLE_STORAGE_SWEEP_INTERVAL
+        if self.sweeper is None and interval:
+            self.sweeper = Sweeper(self.sweep, interval,
+                storage_settings.PICKLE_STORAGE_SWEEP_BATCH)
 
     def setup(self):
         if not self.working_dir_path.exists():
             self.working_dir_path.mkdir(parents=True, exist_ok=True)
         self.create_signing_key()
 
-    def write(self, *args, wait=False, **kwargs):
+    def start_write(self, operation_class, *args, ttl=None, **kwargs):
+        """ Start a write operation, keeping the read cache, manifest,
+        expiry times and usage in step with it. """
+
+        kwargs.setdefault('locks', self.locks)
+        kwargs.setdefault('expiry', self.expiry)
+        self.begin_write()
+        try:
+            op = operation_class(*args, ttl=ttl, **kwargs)
+        except:
+            self.end_write()
+            raise
+        self.invalidate_cached(*op.target_paths())
+        op.add_done_callback(self.end_write)
+        if ttl is not None or self.usage is not None:
+            op.add_done_callback(functools.partial(self.record_write, ttl))
+        return op
+
+    def store_locked(self, exclusive=True):
+        """ Context manager holding the store-wide lock, if locking is
+        enabled, keeping other processes' operations out while it is held
+        exclusively. """
+
+        if self.locks is None:
+            return contextlib.nullcontext()
+        return self.locks.store(exclusive)
+
+    def sweep(self, limit=None):
+        """ Delete expired keys, then evict keys until the store is back
+        within its budget, at most limit of each. Runs in the background once
+        a key is written with a TTL or a budget is set. Returns the number of
+        keys removed. """
+
+        removed = 0
+        if self.expiry is not None:
+            for name in self.expiry.due(limit=limit):
+                if self.delete(name, expired=True):
+                    get_sink().increment(EVICTIONS,
+                        labels=(('reason', 'expired'),))
+                    removed += 1
+            self.expiry.compact()
+
+        if self.usage is not None:
+            if self.usage.load_due():
+                self.usage.load(self.stored_sizes())
+            reason = (('reason', self.usage.policy),)
+            for name in self.usage.victims(limit):
+                self.delete(name)
+                get_sink().increment(EVICTIONS, labels=reason)
+                removed += 1
+        return removed
+
+    def stored_sizes(self):
+        """ (name, size) of every stored key, least recently modified
+        first. """
+
+        key_filenames = signing_key_filenames()
+        stats = []
+        for path in key_files(self.working_dir_path,
+            storage_settings.PICKLE_STORAGE_SUFFIX,
+            storage_settings.PICKLE_STORAGE_SHARD_DEPTH):
+            if path.name in key_filenames:
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            stats.append((stat.st_mtime_ns, path.name, stat.st_size))
+        return [(name, size) for mtime, name, size in sorted(stats)]
+
+    def verify(self, workers=None):
+        """ Check the digest of every stored file, without unpickling
+        anything, across workers processes (default
+        PICKLE_STORAGE_VERIFY_WORKERS). Returns a
+        pickle_storage.verify.VerificationReport listing corrupt, truncated
+        and unsigned files, and references to missing blobs. """
+
+        self.flush()
+        keys = [signing_key.key
+            for signing_key in HMACMixin().verification_keys()]
+        with self.store_locked(exclusive=False):
+            return verify_store(self.working_dir_path, keys, workers,
+                exclude=signing_key_filenames())
+
+    def write(self, path='', content=None, *args, wait=False, buffered=None,
+        ttl=None, **kwargs):
+        """ Queue a Write on the shared executor. Returns the result when
+        wait is True, otherwise the pending operation handle. With ttl, the
+        key reads as missing ttl seconds after it is written, and is deleted
+        by the next sweep().
+
+        With a write buffer (PICKLE_STORAGE_WRITE_BEHIND), writes that are
+        not waited for are buffered instead; pass buffered=False to skip the
+        buffer, in which case an older buffered value may still be flushed
+        afterwards. """
+
+        if not args and ttl is None:
+            pending = self.buffer_write(path, content, wait=wait,
+                buffered=buffered, **kwargs)
+            if pending is not None:
+                return pending
+        if self.compression:
+            kwargs.setdefault('compression', self.compression)
+        op = self.start_write(Write, path, content, *args, ttl=ttl, **kwargs)
+        if wait:
+            return op.join()
+        return op
+
+    def write_many(self, mapping, *args, wait=False, buffered=None,
+        ttl=None, **kwargs):
+        """ Write every key/value pair in mapping as one operation. Pass
+        fsync=True to flush all written files to disk before completing, and
+        ttl to have every key expire like write() does.
+        With wait, returns a BatchResult mapping each key written to True,
+        with failures in its ``errors``. Buffered values of the same keys
+        are flushed first unless buffered is False. """
 
-        th = Write(*args, **kwargs)
+        if self.write_buffer is not None and buffered is not False:
+            self.write_buffer.flush(mapping)
+        if self.compression:
+            kwargs.setdefault('compression', self.compression)
+        op = self.start_write(WriteMany, mapping, *args, ttl=ttl, **kwargs)
         if wait:
-            return th.join()
-        return th
+            return op.join()
+        return op
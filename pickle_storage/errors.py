@@ -5,4 +5,13 @@ class DBOperationError(RuntimeError):
     pass
 
 class ForbiddenFileError(RuntimeError):
-    pass
\ No newline at end of file
+    pass
+
+class IntegrityError(DBOperationError):
+    pass
+
+class LockTimeout(DBOperationError):
+    pass
+
+class TruncatedFileError(IntegrityError):
+    pass
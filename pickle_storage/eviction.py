@@ -0,0 +1,433 @@
+""" Key expiry and size-bounded eviction.
+
+ExpiryIndex records when keys written with a TTL expire in an append-only
+log under _meta/, so finding expired keys never means scanning the store.
+UsageTracker keeps the size and use of every key in memory and picks keys to
+evict, least recently (LRU) or least frequently (LFU) used first, once the
+store is over its byte or entry budget. Sweeper runs a container's sweep() in
+the background. """
+
+import collections
+import contextlib
+import heapq
+import itertools
+import os
+import pathlib
+import struct
+import threading
+import time
+import weakref
+
+try:
+    import fcntl
+except ImportError: # Not available on Windows
+    fcntl = None
+
+from pickle_storage.manifest import META_DIRECTORY
+from pickle_storage.utils import atomic_write, log_errors
+from pickle_storage.config.tools import get_settings_config
+storage_settings = get_settings_config()
+
+__all__ = ['EVICTION_POLICIES', 'ExpiryIndex', 'Sweeper', 'UsageTracker']
+
+EXPIRY_FILENAME = 'expiry.log'
+EXPIRY_LOCK_FILENAME = 'expiry.lock'
+
+# expiry time (seconds since the epoch, 0 for none), time the record was
+# written, key name length
+EXPIRY_RECORD = struct.Struct('<ddH')
+
+EVICTION_POLICIES = ('lru', 'lfu')
+
+class ExpiryIndex():
+    """ Expiry time of every key written with a TTL.
+
+    Each change appends a record to _meta/expiry.log, which every process
+    using the store reads from where it last stopped, at most every
+    refresh_interval seconds. Writes record a key's expiry time after its new
+    file is written and before it is renamed into place, so a file modified
+    after its record was written was not written with that TTL. A key that looks expired is always checked
+    against the log again first, so a later write by another process that
+    removed its TTL is not missed. The log is rewritten with only current
+    records once most of its records are superseded; appends hold
+    _meta/expiry.lock shared and the rewrite holds it exclusively, so no
+    record is appended to a log that is being replaced. Without fcntl the
+    log is never rewritten. """
+
+    def __init__(self, working_dir_path, refresh_interval=None):
+        if refresh_interval is None:
+            refresh_interval = \
+                storage_settings.PICKLE_STORAGE_EXPIRY_REFRESH_INTERVAL
+        self.path = pathlib.Path(working_dir_path, META_DIRECTORY,
+            EXPIRY_FILENAME)
+        self.lock_path = self.path.with_name(EXPIRY_LOCK_FILENAME)
+        self.refresh_interval = refresh_interval
+        self._lock = threading.RLock()
+        self._reset()
+        self._refreshed = float('-inf') # Read the log on first use
+
+    def __len__(self):
+        self.refresh_if_due()
+        return len(self._expiries)
+
+    def clear(self):
+        """ Forget every expiry time. The log itself goes with the working
+        directory. """
+
+        with self._lock:
+            self._reset()
+
+    def compact(self, force=False):
+        """ Rewrite the log with only current records if most of its records
+        are superseded. Returns whether it was rewritten. """
+
+        if fcntl is None:
+            return False
+        self.refresh_if_due()
+        if not force and not self._superseded():
+            return False
+        with self._lock, self._log_locked(exclusive=True):
+            self.refresh()
+            if not force and not self._superseded():
+                return False
+            records = b''.join(self._pack(name, expires_at,
+                self._recorded[name])
+                for name, expires_at in self._expiries.items())
+            stat = atomic_write(self.path, [records])
+            self._identity = (stat.st_dev, stat.st_ino)
+            self._offset = len(records)
+            self._records = len(self._expiries)
+            self._heap = [(expires_at, name)
+                for name, expires_at in self._expiries.items()]
+            heapq.heapify(self._heap)
+        return True
+
+    def due(self, now=None, limit=None):
+        """ Names of keys expired by now, earliest first, at most limit of
+        them. """
+
+        if now is None:
+            now = time.time()
+        self.refresh_if_due()
+        names = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and (limit is None
+                or len(names) < limit):
+                expires_at, name = heapq.heappop(self._heap)
+                if self._expiries.get(name) == expires_at:
+                    names.append(name)
+            # Still expired until they are deleted
+            for name in names:
+                heapq.heappush(self._heap, (self._expiries[name], name))
+        return names
+
+    def expired(self, name, now=None):
+        """ Whether the key file name has expired. """
+
+        self.refresh_if_due()
+        expires_at = self._expiries.get(name)
+        if expires_at is None or expires_at > (now or time.time()):
+            return False
+        self.refresh()
+        expires_at = self._expiries.get(name)
+        return expires_at is not None and expires_at <= (now or time.time())
+
+    def expires_at(self, name):
+        self.refresh_if_due()
+        return self._expiries.get(name)
+
+    def recorded_at(self, name):
+        """ When the current expiry time of name was recorded, or None. """
+
+        self.refresh_if_due()
+        return self._recorded.get(name)
+
+    def refresh(self):
+        """ Read records appended to the log since it was last read, or all
+        of it if it was replaced. """
+
+        with self._lock:
+            self._refreshed = time.monotonic()
+            try:
+                f = open(self.path, 'rb')
+            except FileNotFoundError:
+                if self._identity is not None:
+                    self._reset()
+                return
+            with f:
+                stat = os.fstat(f.fileno())
+                if (stat.st_dev, stat.st_ino) != self._identity:
+                    self._reset()
+                    self._identity = (stat.st_dev, stat.st_ino)
+                if stat.st_size <= self._offset:
+                    return
+                f.seek(self._offset)
+                data = f.read()
+            self._offset += self._apply(data)
+
+    def refresh_if_due(self):
+        if time.monotonic() - self._refreshed >= self.refresh_interval:
+            self.refresh()
+
+    def set_many(self, expiries):
+        """ Record a {name: expiry time} mapping, None removing a key's
+        expiry time. Removals of keys without one are not recorded. """
+
+        with self._lock:
+            self.refresh_if_due()
+            now = time.time()
+            records = b''.join(self._pack(name, expires_at, now)
+                for name, expires_at in _changes(self._expiries, expiries))
+            if not records:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Appends of a few records land whole, even with several writers
+            with self._log_locked():
+                fd = os.open(self.path,
+                    os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+                try:
+                    os.write(fd, records)
+                finally:
+                    os.close(fd)
+            # Read back, in order with any other process's records
+            self.refresh()
+
+    def _apply(self, data):
+        """ Apply the whole records in data. Returns the number of bytes
+        they take up. """
+
+        position = 0
+        while position + EXPIRY_RECORD.size <= len(data):
+            expires_at, recorded_at, length = EXPIRY_RECORD.unpack_from(data,
+                position)
+            end = position + EXPIRY_RECORD.size + length
+            if end > len(data):
+                break # Still being appended
+            name = data[position + EXPIRY_RECORD.size:end].decode('utf-8')
+            if expires_at:
+                self._expiries[name] = expires_at
+                self._recorded[name] = recorded_at
+                heapq.heappush(self._heap, (expires_at, name))
+            else:
+                self._expiries.pop(name, None)
+                self._recorded.pop(name, None)
+            self._records += 1
+            position = end
+        return position
+
+    @contextlib.contextmanager
+    def _log_locked(self, exclusive=False):
+        if fcntl is None:
+            yield
+            return
+        try:
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+        except FileNotFoundError:
+            self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(fd)
+
+    def _pack(self, name, expires_at, recorded_at):
+        encoded = name.encode('utf-8')
+        return EXPIRY_RECORD.pack(expires_at or 0.0, recorded_at,
+            len(encoded)) + encoded
+
+    def _superseded(self):
+        return self._records > 2 * len(self._expiries) + 1024
+
+    def _reset(self):
+        self._expiries = {}
+        self._recorded = {}
+        self._heap = []
+        self._identity = None
+        self._offset = 0
+        self._records = 0
+
+def _changes(current, expiries):
+    for name, expires_at in expiries.items():
+        if expires_at is not None or name in current:
+            yield name, expires_at
+
+class UsageTracker():
+    """ Size and use of every key, in memory, to pick eviction victims once
+    the store holds more than max_bytes bytes or max_entries keys.
+
+    The stored keys and their sizes are loaded by load(), from a scan of the
+    store, on the first sweep and again every reload_interval seconds
+    (PICKLE_STORAGE_USAGE_RELOAD_INTERVAL), so that keys written by other
+    processes count towards the budget too. In between, reads and writes
+    made through this process keep it up to date. Uses are only seen by the
+    process making them. """
+
+    def __init__(self, policy='lru', max_bytes=None, max_entries=None,
+        reload_interval=None):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f'Unknown eviction policy "{policy}".')
+        if reload_interval is None:
+            reload_interval = \
+                storage_settings.PICKLE_STORAGE_USAGE_RELOAD_INTERVAL
+        self.policy = policy
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.reload_interval = reload_interval
+        self.loaded_at = None
+        self._lock = threading.Lock()
+        self._tick = itertools.count()
+        self.clear()
+
+    def __contains__(self, name):
+        return name in self._sizes
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def clear(self):
+        with self._lock:
+            # Least recently used first
+            self._sizes = collections.OrderedDict()
+            self._uses = collections.Counter()
+            self._heap = []
+            self.total_bytes = 0
+
+    def load(self, entries):
+        """ Track exactly the stored keys in entries, (name, size) pairs
+        least recently modified first. Keys not tracked yet count as used
+        less recently than the others; keys no longer stored are dropped. """
+
+        with self._lock:
+            stored = collections.OrderedDict(entries)
+            sizes = collections.OrderedDict()
+            for name, size in stored.items():
+                if name not in self._sizes:
+                    sizes[name] = size
+                    heapq.heappush(self._heap, (0, next(self._tick), name))
+            for name in self._sizes:
+                if name in stored:
+                    sizes[name] = stored[name]
+                else:
+                    self._uses.pop(name, None)
+            self._sizes = sizes
+            self.total_bytes = sum(sizes.values())
+            self.loaded_at = time.monotonic()
+
+    def load_due(self):
+        """ Whether the stored keys should be loaded again. """
+
+        return self.loaded_at is None or (self.reload_interval is not None
+            and time.monotonic() - self.loaded_at >= self.reload_interval)
+
+    def over_budget(self):
+        return ((self.max_bytes is not None
+            and self.total_bytes > self.max_bytes)
+            or (self.max_entries is not None
+            and len(self._sizes) > self.max_entries))
+
+    def record_read(self, name):
+        with self._lock:
+            if name in self._sizes:
+                self._use(name)
+
+    def record_write(self, name, size):
+        with self._lock:
+            self.total_bytes += size - self._sizes.get(name, 0)
+            self._sizes[name] = size
+            self._use(name)
+
+    def remove(self, name):
+        with self._lock:
+            size = self._sizes.pop(name, None)
+            if size is not None:
+                self.total_bytes -= size
+                self._uses.pop(name, None)
+
+    def victims(self, limit=None):
+        """ Names to evict, in order, until the store is within budget, at
+        most limit of them. They are expected to be removed. """
+
+        with self._lock:
+            excess_bytes = self.total_bytes - (self.max_bytes
+                if self.max_bytes is not None else self.total_bytes)
+            excess_entries = len(self._sizes) - (self.max_entries
+                if self.max_entries is not None else len(self._sizes))
+            names = []
+            candidates = self._candidates()
+            for name in candidates:
+                if ((excess_bytes <= 0 and excess_entries <= 0)
+                    or (limit is not None and len(names) >= limit)):
+                    break
+                names.append(name)
+                excess_bytes -= self._sizes[name]
+                excess_entries -= 1
+            candidates.close()
+            return names
+
+    def _candidates(self):
+        if self.policy == 'lru':
+            yield from self._sizes
+            return
+
+        # Heap entries are left behind by later uses; skip outdated ones
+        if len(self._heap) > 4 * len(self._sizes) + 1024:
+            self._heap = [(self._uses[name], next(self._tick), name)
+                for name in self._sizes]
+            heapq.heapify(self._heap)
+        popped = []
+        try:
+            while self._heap:
+                uses, tick, name = heapq.heappop(self._heap)
+                if name in self._sizes and self._uses[name] == uses:
+                    popped.append((uses, tick, name))
+                    yield name
+        finally:
+            for entry in popped:
+                heapq.heappush(self._heap, entry)
+
+    def _use(self, name):
+        if self.policy == 'lru':
+            self._sizes.move_to_end(name)
+        else:
+            self._uses[name] += 1
+            heapq.heappush(self._heap, (self._uses[name], next(self._tick),
+                name))
+
+class Sweeper():
+    """ Calls sweep(limit) every interval seconds, and as soon as wake() is
+    called, on a daemon thread. sweep must be a bound method; its object is
+    only weakly referenced, and the thread stops once it is gone. """
+
+    def __init__(self, sweep, interval, limit=None):
+        self.sweep = weakref.WeakMethod(sweep)
+        self.interval = interval
+        self.limit = limit
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        threading.Thread(target=self._sweep_loop, name='PickleStorageSweeper',
+            daemon=True).start()
+
+    def close(self):
+        self._closed.set()
+        self._wake.set()
+
+    def wake(self):
+        self._wake.set()
+
+    def _sweep_loop(self):
+        while not self._closed.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._closed.is_set():
+                break
+            sweep = self.sweep()
+            if sweep is None:
+                break
+            self._sweep_quietly(sweep)
+            del sweep
+
+    @log_errors
+    def _sweep_quietly(self, sweep):
+        sweep(self.limit)
@@ -0,0 +1,113 @@
+import atexit
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from pickle_storage.errors import DBOperationError
+from pickle_storage.config.tools import get_settings_config
+storage_settings = get_settings_config()
+
+__all__ = ['StorageExecutor', 'get_executor', 'shutdown_executor']
+
+class StorageExecutor():
+    """ Bounded thread pool shared by all storage operations.
+
+    At most ``max_workers`` operations run at once and at most
+    ``max_queue_size`` more may be waiting for a worker. Submitting beyond
+    that blocks the caller (backpressure) until a slot frees up, or raises
+    DBOperationError if ``submit_timeout`` elapses first. Callers that must
+    not block, like an event loop, take a slot with reserve() first.
+
+    Once the pool has shut down, as it has by the time atexit handlers run,
+    submitted functions run in the calling thread instead, so that writes
+    made at exit (such as flushing a WriteBehindBuffer) still land. """
+
+    def __init__(self, max_workers=None, max_queue_size=None,
+        submit_timeout=None):
+        if max_workers is None:
+            max_workers = storage_settings.PICKLE_STORAGE_MAX_WORKERS
+        if max_queue_size is None:
+            max_queue_size = storage_settings.PICKLE_STORAGE_MAX_QUEUE_SIZE
+        if submit_timeout is None:
+            submit_timeout = storage_settings.PICKLE_STORAGE_SUBMIT_TIMEOUT
+
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.submit_timeout = submit_timeout
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue_size)
+        self._reserved = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers,
+            thread_name_prefix='PickleStorage')
+
+    def submit(self, fn, *args, **kwargs):
+        """ Schedule fn on the pool, waiting for a free slot if necessary. """
+
+        if getattr(self._reserved, 'count', 0):
+            self._reserved.count -= 1
+        elif not self._slots.acquire(timeout=self.submit_timeout):
+            raise DBOperationError('Storage executor queue is full.')
+        try:
+            future = self._pool.submit(fn, *args, **kwargs)
+        except RuntimeError:
+            # Raised only once the pool, or the interpreter, is shut down
+            future = Future()
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                self._slots.release()
+            return future
+        except:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._release_slot)
+        return future
+
+    def reserve(self):
+        """ Take a slot for the next submit() made by this thread, without
+        waiting. Returns whether one was free. Give it back with unreserve()
+        if it ends up unused. """
+
+        if not self._slots.acquire(blocking=False):
+            return False
+        self._reserved.count = getattr(self._reserved, 'count', 0) + 1
+        return True
+
+    def unreserve(self):
+        """ Give back the slot this thread reserved, if submit() has not
+        used it. """
+
+        if getattr(self._reserved, 'count', 0):
+            self._reserved.count -= 1
+            self._slots.release()
+
+    def _release_slot(self, future):
+        self._slots.release()
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """ Return the process-wide StorageExecutor, creating it on first use. """
+
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = StorageExecutor()
+    return _executor
+
+@atexit.register
+def shutdown_executor(wait=True):
+    """ Let queued operations finish and discard the shared executor. """
+
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
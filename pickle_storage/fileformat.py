@@ -0,0 +1,118 @@
+""" Layout of framed storage files.
+
+Files written before framing was introduced hold ``digest + b'\\x00' +
+pickle`` and are still readable. Framed files start with a fixed header
+recording how the payload was pickled and compressed:
+
+    header | digest | buffer table | payload | padding | buffer | ...
+
+The digest covers every byte of the file except itself. Out-of-band pickle
+buffers follow the payload, each starting at a multiple of BUFFER_ALIGNMENT
+from the start of the file so they can be handed out as aligned views of a
+memory-mapped file.
+
+The digest is an HMAC-sha256 unless the header says otherwise: version 2
+headers name the keyed digest algorithm in the upper four bits of the flags
+byte, as an index into DIGEST_ALGORITHMS. sha256 files are still written as
+version 1, readable by older releases. """
+
+import collections
+import pickle
+import struct
+
+from pickle_storage.errors import IntegrityError, TruncatedFileError
+
+__all__ = ['MAGIC', 'FORMAT_VERSION', 'FLAG_OUT_OF_BAND', 'FLAG_REFERENCE',
+    'BUFFER_ALIGNMENT', 'DIGEST_ALGORITHMS', 'DIGEST_SIZE', 'HEADER',
+    'BUFFER_ENTRY', 'Frame', 'has_out_of_band', 'is_framed', 'pack_frame',
+    'unpack_frame']
+
+MAGIC = b'\x89PSF'
+FORMAT_VERSION = 2
+FLAG_OUT_OF_BAND = 0x01
+# The payload is the digest of a content-addressed blob holding the value, see
+# pickle_storage.blobs
+FLAG_REFERENCE = 0x02
+BUFFER_ALIGNMENT = 64
+DIGEST_SIZE = 32
+# Keyed digest algorithms by the id stored in version 2 headers
+DIGEST_ALGORITHMS = ('sha256', 'blake2b', 'blake2s')
+ALGORITHM_SHIFT = 4
+
+# magic, version, flags, pickle protocol, compression codec, buffer count,
+# payload length
+HEADER = struct.Struct('<4sBBBBIQ')
+# offset from start of file, length
+BUFFER_ENTRY = struct.Struct('<QQ')
+
+Frame = collections.namedtuple('Frame',
+    ['flags', 'protocol', 'codec', 'digest', 'signed', 'payload', 'buffers',
+    'algorithm'])
+
+def is_framed(view):
+    return len(view) >= HEADER.size + DIGEST_SIZE and view[:4] == MAGIC
+
+def has_out_of_band(header):
+    """ Whether the first HEADER.size bytes of a file announce out-of-band
+    buffers. """
+
+    return (len(header) == HEADER.size and header[:4] == MAGIC
+        and bool(header[5] & FLAG_OUT_OF_BAND))
+
+def pack_frame(payload, buffers=(), flags=0, protocol=pickle.DEFAULT_PROTOCOL,
+    codec=0, algorithm='sha256'):
+    """ Lay out a framed file around payload and its out-of-band buffers.
+    Returns (header, body), the chunks that go before and after the digest;
+    the digest, made with algorithm, must be computed over both. """
+
+    body = []
+    table = bytearray()
+    position = HEADER.size + DIGEST_SIZE + BUFFER_ENTRY.size * len(buffers) \
+        + len(payload)
+    for buffer in buffers:
+        padding = -position % BUFFER_ALIGNMENT
+        table += BUFFER_ENTRY.pack(position + padding, len(buffer))
+        if padding:
+            body.append(bytes(padding))
+        body.append(buffer)
+        position += padding + len(buffer)
+
+    algorithm_id = DIGEST_ALGORITHMS.index(algorithm)
+    version = FORMAT_VERSION if algorithm_id else 1
+    header = HEADER.pack(MAGIC, version,
+        flags | algorithm_id << ALGORITHM_SHIFT, protocol, codec,
+        len(buffers), len(payload))
+    return header, [table, payload] + body
+
+def unpack_frame(view):
+    """ Split a framed file into its parts, without verifying the digest.
+    Raises IntegrityError if the file is not a valid frame, or
+    TruncatedFileError if it ends early. """
+
+    if len(view) < HEADER.size + DIGEST_SIZE:
+        raise TruncatedFileError('File is truncated.')
+    magic, version, flags, protocol, codec, buffer_count, payload_length = \
+        HEADER.unpack_from(view)
+    algorithm_id = flags >> ALGORITHM_SHIFT
+    if (magic != MAGIC or version not in (1, FORMAT_VERSION)
+        or algorithm_id >= len(DIGEST_ALGORITHMS)
+        or (version == 1 and algorithm_id)):
+        raise IntegrityError('Unrecognised file header.')
+    flags &= (1 << ALGORITHM_SHIFT) - 1
+
+    digest = view[HEADER.size:HEADER.size + DIGEST_SIZE]
+    position = HEADER.size + DIGEST_SIZE
+    table_end = position + BUFFER_ENTRY.size * buffer_count
+    payload_end = table_end + payload_length
+    if payload_end > len(view):
+        raise TruncatedFileError('File is truncated.')
+
+    buffers = []
+    for offset, length in BUFFER_ENTRY.iter_unpack(view[position:table_end]):
+        if offset < payload_end or offset + length > len(view):
+            raise TruncatedFileError('File is truncated.')
+        buffers.append(view[offset:offset + length])
+
+    signed = [view[:HEADER.size], view[position:]]
+    return Frame(flags, protocol, codec, digest, signed,
+        view[table_end:payload_end], buffers, DIGEST_ALGORITHMS[algorithm_id])
@@ -0,0 +1,137 @@
+import contextlib
+import hashlib
+import os
+import pathlib
+import time
+
+try:
+    import fcntl
+except ImportError: # Not available on Windows
+    fcntl = None
+
+from pickle_storage.errors import ConfigError, LockTimeout
+from pickle_storage.metrics import (LOCK_CONTENDED, LOCK_TIMEOUTS,
+    LOCK_WAIT_SECONDS, get_sink)
+from pickle_storage.utils import db_relative_path
+from pickle_storage.config.tools import get_settings_config
+storage_settings = get_settings_config()
+
+__all__ = ['LOCK_DIRECTORY', 'LockManager']
+
+LOCK_DIRECTORY = '.locks'
+STORE_LOCK = 'store.lock'
+
+# Polling interval bounds while waiting for a contended lock, in seconds
+MIN_BACKOFF = 0.0005
+MAX_BACKOFF = 0.05
+
+class LockManager():
+    """ Advisory fcntl locks coordinating processes that share a working
+    directory.
+
+    Keys are hashed onto a fixed number of lock files (stripes) under
+    .locks/, so unrelated keys may occasionally wait on each other but the
+    number of lock files stays bounded. Readers take a key's stripe shared
+    and writers exclusive. Every key operation also holds the store lock
+    shared, which clear(), archive() and friends take exclusive to keep
+    everything else out.
+
+    Each acquisition opens its own file description, so threads of one
+    process exclude each other too; a thread must not take a lock it
+    already holds. Locks are taken store first, then stripes in order, so
+    multi-key operations cannot deadlock. """
+
+    def __init__(self, working_dir_path, stripes=None, timeout=None):
+        if fcntl is None:
+            raise ConfigError('File locking requires the fcntl module.')
+        if stripes is None:
+            stripes = storage_settings.PICKLE_STORAGE_LOCK_STRIPES
+        if timeout is None:
+            timeout = storage_settings.PICKLE_STORAGE_LOCK_TIMEOUT
+        self.working_dir_path = pathlib.Path(working_dir_path)
+        self.lock_dir_path = self.working_dir_path.joinpath(LOCK_DIRECTORY)
+        self.stripes = stripes
+        self.timeout = timeout
+
+    def acquire(self, name, exclusive=False, timeout=None):
+        """ Lock the lock file name, waiting at most timeout seconds (the
+        manager's timeout by default, None for no limit). Returns the file
+        descriptor to pass to release(). Raises LockTimeout. """
+
+        if timeout is None:
+            timeout = self.timeout
+        mode = 'exclusive' if exclusive else 'shared'
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        fd = self._open(name)
+        start = time.perf_counter()
+        backoff = MIN_BACKOFF
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    pass
+                waited = time.perf_counter() - start
+                if backoff == MIN_BACKOFF:
+                    get_sink().increment(LOCK_CONTENDED, labels=(('mode', mode),))
+                if timeout is not None and waited >= timeout:
+                    get_sink().increment(LOCK_TIMEOUTS, labels=(('mode', mode),))
+                    raise LockTimeout(f'Timed out waiting for {mode} lock '
+                        f'"{name}" after {waited:.3f} seconds.')
+                time.sleep(backoff if timeout is None
+                    else min(backoff, timeout - waited))
+                backoff = min(backoff * 2, MAX_BACKOFF)
+        except:
+            os.close(fd)
+            raise
+        get_sink().observe(LOCK_WAIT_SECONDS, time.perf_counter() - start,
+            (('mode', mode),))
+        return fd
+
+    @contextlib.contextmanager
+    def keys(self, paths, exclusive=False, store=True):
+        """ Hold the locks of every key in paths, and the store lock shared
+        unless store is False. """
+
+        held = []
+        try:
+            if store:
+                held.append(self.acquire(STORE_LOCK))
+            for name in sorted({self.stripe_name(path) for path in paths}):
+                held.append(self.acquire(name, exclusive))
+            yield
+        finally:
+            for fd in reversed(held):
+                self.release(fd)
+
+    def release(self, fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    @contextlib.contextmanager
+    def store(self, exclusive=True):
+        """ Hold the store lock, by default exclusively. """
+
+        fd = self.acquire(STORE_LOCK, exclusive)
+        try:
+            yield
+        finally:
+            self.release(fd)
+
+    def stripe_name(self, path):
+        """ Name of the lock file guarding the key at path. """
+
+        digest = hashlib.blake2b(db_relative_path(path).name.encode(),
+            digest_size=8).digest()
+        return f"{int.from_bytes(digest, 'big') % self.stripes:04x}.lock"
+
+    def _open(self, name):
+        path = self.lock_dir_path.joinpath(name)
+        try:
+            return os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        except FileNotFoundError:
+            self.lock_dir_path.mkdir(parents=True, exist_ok=True)
+            return os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
@@ -0,0 +1,244 @@
+import atexit
+import bisect
+import collections
+import os
+import pathlib
+import pickle
+import threading
+import time
+import weakref
+
+from pickle_storage.fileformat import DIGEST_SIZE, HEADER, MAGIC
+from pickle_storage.mixins import HMACMixin, signing_key_filenames
+from pickle_storage.utils import atomic_write, key_files, write_to_log
+from pickle_storage.config.tools import get_settings_config
+storage_settings = get_settings_config()
+
+__all__ = ['Manifest', 'ManifestEntry', 'paginate']
+
+META_DIRECTORY = '_meta'
+
+# Directories beside the shard directories that do not hold keys
+UNSHARDED_DIRECTORIES = {META_DIRECTORY, '_archive', '_blobs', '_image',
+    '.locks'}
+
+# Directory mtimes only advance once per kernel clock tick, so a directory
+# mtime is only trusted once this long has passed since it was set.
+MTIME_SETTLE_NS = 50_000_000
+
+# Manifests in use, saved at interpreter exit if they changed
+_manifests = weakref.WeakSet()
+
+@atexit.register
+def _save_manifests():
+    dirty = [manifest for manifest in list(_manifests) if manifest.dirty]
+    if dirty:
+        # One settle wait for all of them, rather than one each in save()
+        time.sleep(MTIME_SETTLE_NS / 1e9)
+    for manifest in dirty:
+        manifest.save_if_dirty()
+
+# digest and codec are None for files without a framed header
+ManifestEntry = collections.namedtuple('ManifestEntry',
+    ['size', 'mtime_ns', 'digest', 'codec'])
+
+def entry_for(stat, head):
+    """ Build a ManifestEntry from a file's stat and its first
+    HEADER.size + DIGEST_SIZE bytes. """
+
+    if len(head) >= HEADER.size + DIGEST_SIZE and head[:4] == MAGIC:
+        codec = HEADER.unpack_from(head)[4]
+        digest = bytes(head[HEADER.size:HEADER.size + DIGEST_SIZE])
+    else:
+        codec = digest = None
+    return ManifestEntry(stat.st_size, stat.st_mtime_ns, digest, codec)
+
+def paginate(names, prefix='', start_after=None, limit=None):
+    """ Names from the sorted list names that start with prefix and sort
+    after start_after, at most limit of them. """
+
+    position = bisect.bisect_left(names, prefix)
+    if start_after is not None:
+        position = max(position, bisect.bisect_right(names, start_after))
+
+    page = []
+    for name in names[position:]:
+        if not name.startswith(prefix) or (limit is not None
+            and len(page) >= limit):
+            break
+        page.append(name)
+    return page
+
+class Manifest(HMACMixin):
+    """ Sorted in-memory map of file name -> ManifestEntry for every key in
+    a working directory, kept up to date by the container's writes.
+
+    It is saved to a signed file under _meta/ together with the working
+    directory's mtime at the time, or the latest of its shard directories'.
+    Adding or replacing a file changes that mtime, so a saved manifest is
+    only reused when nothing has been written since; otherwise it is rebuilt
+    from the directory on first use. Writes
+    made by other processes are not seen until rebuild() is called. """
+
+    def __init__(self, working_dir_path):
+        self.working_dir_path = pathlib.Path(working_dir_path)
+        self.path = self.working_dir_path.joinpath(META_DIRECTORY,
+            'manifest.psm')
+        self.dirty = False
+        self._pending = 0
+        self._entries = {}
+        self._names = []
+        self._loaded = False
+        self._lock = threading.RLock()
+        _manifests.add(self)
+
+    def __contains__(self, name):
+        self.ensure_loaded()
+        return name in self._entries
+
+    def __len__(self):
+        self.ensure_loaded()
+        return len(self._entries)
+
+    def begin_write(self):
+        """ Note a write that has been started but not yet recorded with
+        end_write(). """
+
+        with self._lock:
+            self._pending += 1
+
+    def end_write(self, entries=None):
+        """ Record the name -> ManifestEntry pairs written by a write started
+        with begin_write(). """
+
+        with self._lock:
+            self._pending -= 1
+            for name, entry in (entries or {}).items():
+                self.update(name, entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._names = []
+            self._loaded = True
+            self.dirty = True
+
+    def directory_mtime(self):
+        """ Latest mtime of the directories keys are written to. """
+
+        mtime = self.working_dir_path.stat().st_mtime_ns
+        for depth in range(storage_settings.PICKLE_STORAGE_SHARD_DEPTH):
+            for shard in self.working_dir_path.glob("*/" * (depth + 1)):
+                relative = shard.relative_to(self.working_dir_path)
+                if relative.parts[0] not in UNSHARDED_DIRECTORIES:
+                    mtime = max(mtime, shard.stat().st_mtime_ns)
+        return mtime
+
+    def discard(self, name):
+        self.ensure_loaded()
+        with self._lock:
+            if self._entries.pop(name, None) is not None:
+                del self._names[bisect.bisect_left(self._names, name)]
+                self.dirty = True
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if not self._loaded:
+                if not self.load():
+                    self.rebuild()
+                self._loaded = True
+
+    def get(self, name, default=None):
+        self.ensure_loaded()
+        return self._entries.get(name, default)
+
+    def load(self):
+        """ Load the saved manifest if it is still current. Returns whether
+        it was. """
+
+        try:
+            raw = self.path.read_bytes()
+            directory_mtime = self.directory_mtime()
+        except FileNotFoundError:
+            return False
+
+        digest, payload = raw[:DIGEST_SIZE], raw[DIGEST_SIZE:]
+        if not self.is_safe(digest, payload):
+            write_to_log('Ignoring manifest, digest did not match content.',
+                level='warning')
+            return False
+
+        saved = pickle.loads(payload)
+        if saved['directory_mtime'] != directory_mtime:
+            return False
+        with self._lock:
+            self._entries = saved['entries']
+            self._names = sorted(self._entries)
+            self.dirty = False
+        return True
+
+    def names(self, prefix='', start_after=None, limit=None):
+        self.ensure_loaded()
+        with self._lock:
+            return paginate(self._names, prefix, start_after, limit)
+
+    def rebuild(self):
+        """ Recreate the manifest by scanning the working directory. """
+
+        key_filenames = signing_key_filenames()
+        entries = {}
+        for path in key_files(self.working_dir_path,
+            storage_settings.PICKLE_STORAGE_SUFFIX,
+            storage_settings.PICKLE_STORAGE_SHARD_DEPTH):
+            if path.name in key_filenames:
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    head = f.read(HEADER.size + DIGEST_SIZE)
+                    entries[path.name] = entry_for(os.fstat(f.fileno()), head)
+            except FileNotFoundError:
+                continue
+
+        with self._lock:
+            self._entries = entries
+            self._names = sorted(entries)
+            self._loaded = True
+            self.dirty = True
+
+    def save(self):
+        """ Save the manifest, unless it is unchanged since it was loaded or
+        saved. A directory written in the last MTIME_SETTLE_NS is waited on,
+        so that the recorded mtime covers writes still landing in it. """
+
+        with self._lock:
+            if not self.dirty and self.path.exists():
+                return
+            self.path.parent.mkdir(exist_ok=True)
+            directory_mtime = self.directory_mtime()
+            settle = MTIME_SETTLE_NS - (time.time_ns() - directory_mtime)
+            if settle > 0:
+                time.sleep(settle / 1e9)
+                if self.directory_mtime() != directory_mtime:
+                    directory_mtime = None
+            if self._pending:
+                # Files may already be renamed into place but not recorded
+                directory_mtime = None
+
+            payload = pickle.dumps({'directory_mtime': directory_mtime,
+                'entries': self._entries})
+            atomic_write(self.path, [self.hmac_digest(payload), payload])
+            self.dirty = False
+
+    def save_if_dirty(self):
+        if self.dirty and self.working_dir_path.exists():
+            self.save()
+
+    def update(self, name, entry):
+        self.ensure_loaded()
+        with self._lock:
+            if name not in self._entries:
+                bisect.insort(self._names, name)
+            self._entries[name] = entry
+            self.dirty = True
@@ -0,0 +1,207 @@
+import collections.abc
+import hashlib
+import math
+import pickle
+import threading
+
+from pickle_storage.errors import ConfigError, DBOperationError
+from pickle_storage.config.tools import get_settings_config
+storage_settings = get_settings_config()
+
+__all__ = ['PersistentDict']
+
+# Stable pickle protocol used to hash keys, so every process agrees on which
+# bucket holds a key.
+KEY_PROTOCOL = 4
+
+class PersistentDict(collections.abc.MutableMapping):
+    """ A dict whose fields are spread over separately stored and signed
+    buckets, so reading or changing one field only loads or rewrites the
+    bucket holding it rather than the whole collection.
+
+    Fields are assigned to one of ``buckets`` buckets by a hash of their
+    pickled key; keys should be str, bytes or int, since equal keys of other
+    types may pickle differently. Buckets are stored as the keys
+    ``<name>__<bucket>`` and loaded the first time one of their fields is
+    used. The bucket count is saved with the collection under
+    ``<name>__meta`` and cannot change afterwards: buckets are never split,
+    so each one keeps growing with the collection, and every change rewrites
+    a whole bucket. Size a new collection for its expected number of fields
+    with ``expected_size``, which picks enough buckets to hold about
+    PICKLE_STORAGE_PERSISTENT_DICT_BUCKET_SIZE fields each; without it (or
+    ``buckets``) PICKLE_STORAGE_PERSISTENT_DICT_BUCKETS are used. Outgrowing
+    that means copying the fields into a new, larger collection.
+
+    With autoflush (the default) each change is written as it is made;
+    otherwise changed buckets are written by flush(), or on leaving a
+    ``with`` block. As with shelve, values changed in place (d[k].append())
+    are not noticed; assign them again to store them.
+
+    Only buckets that are not stored are taken to be empty. A bucket that
+    cannot be read, or written, raises instead, and buckets that fail to be
+    written stay changed.
+
+    There must be exactly one writer per name: a single instance, in a
+    single process. A loaded bucket is never read again, and flushing writes
+    the whole cached bucket back, so two writers changing fields of the same
+    bucket silently overwrite each other's changes. Other instances may only
+    read, and do not see changes made after they loaded a bucket; open a new
+    instance to see them. """
+
+    def __init__(self, name, container=None, buckets=None, autoflush=True,
+        expected_size=None):
+        if buckets is not None and expected_size is not None:
+            raise ConfigError('Pass either buckets or expected_size.')
+        if container is None:
+            container = storage_settings.active_storage
+        self.name = name
+        self.container = container
+        self.autoflush = autoflush
+        self._loaded = {}
+        self._dirty = set()
+        self._lock = threading.RLock()
+
+        meta = self._read([self.meta_key]).get(self.meta_key)
+        if meta:
+            if buckets is not None and buckets != meta['buckets']:
+                raise ConfigError(f'"{name}" already has {meta["buckets"]}'
+                    ' buckets.')
+            self.buckets = meta['buckets']
+        else:
+            if expected_size is not None:
+                buckets = max(1, math.ceil(expected_size / storage_settings
+                    .PICKLE_STORAGE_PERSISTENT_DICT_BUCKET_SIZE))
+            self.buckets = buckets or \
+                storage_settings.PICKLE_STORAGE_PERSISTENT_DICT_BUCKETS
+            container.write(self.meta_key, {'buckets': self.buckets},
+                wait=True)
+
+    def __contains__(self, key):
+        return key in self._bucket(self.bucket_for(key))
+
+    def __delitem__(self, key):
+        bucket = self.bucket_for(key)
+        with self._lock:
+            del self._bucket(bucket)[key]
+            self._changed(bucket)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def __getitem__(self, key):
+        return self._bucket(self.bucket_for(key))[key]
+
+    def __iter__(self):
+        self.load()
+        for bucket in range(self.buckets):
+            yield from list(self._loaded[bucket])
+
+    def __len__(self):
+        self.load()
+        return sum(len(fields) for fields in self._loaded.values())
+
+    def __setitem__(self, key, value):
+        bucket = self.bucket_for(key)
+        with self._lock:
+            self._bucket(bucket)[key] = value
+            self._changed(bucket)
+
+    @property
+    def meta_key(self):
+        return f"{self.name}__meta"
+
+    def bucket_for(self, key):
+        digest = hashlib.blake2b(pickle.dumps(key, KEY_PROTOCOL),
+            digest_size=8).digest()
+        return int.from_bytes(digest, 'big') % self.buckets
+
+    def bucket_key(self, bucket):
+        return f"{self.name}__{bucket:04x}"
+
+    def clear(self):
+        """ Remove every field, rewriting every bucket. """
+
+        with self._lock:
+            self._loaded = {bucket: {} for bucket in range(self.buckets)}
+            self._dirty = set(self._loaded)
+            if self.autoflush:
+                self.flush()
+
+    def discard_changes(self):
+        """ Forget unflushed changes; their buckets are reloaded on next
+        use. """
+
+        with self._lock:
+            for bucket in self._dirty:
+                self._loaded.pop(bucket, None)
+            self._dirty = set()
+
+    def flush(self):
+        """ Write every changed bucket in one batch. Returns the number of
+        buckets written. """
+
+        with self._lock:
+            if not self._dirty:
+                return 0
+            # Stored inside a dict so that empty buckets are still written
+            batch = {self.bucket_key(bucket): {'fields': self._loaded[bucket]}
+                for bucket in self._dirty}
+            result = self.container.write_many(batch, wait=True)
+            if result is False:
+                raise DBOperationError(f'Failed to write "{self.name}".')
+            self._dirty = {bucket for bucket in self._dirty
+                if self.bucket_key(bucket) in result.errors}
+            if self._dirty:
+                raise DBOperationError(f'Failed to write {len(self._dirty)} '
+                    f'buckets of "{self.name}".') from next(
+                    iter(result.errors.values()))
+        return len(result)
+
+    def load(self):
+        """ Load every bucket not loaded yet. """
+
+        with self._lock:
+            missing = [bucket for bucket in range(self.buckets)
+                if bucket not in self._loaded]
+            if not missing:
+                return
+            stored = self._read([self.bucket_key(bucket)
+                for bucket in missing])
+            for bucket in missing:
+                self._loaded[bucket] = self._fields(
+                    stored.get(self.bucket_key(bucket)))
+
+    def _bucket(self, bucket):
+        fields = self._loaded.get(bucket)
+        if fields is None:
+            with self._lock:
+                fields = self._loaded.get(bucket)
+                if fields is None:
+                    key = self.bucket_key(bucket)
+                    fields = self._loaded[bucket] = self._fields(
+                        self._read([key]).get(key))
+        return fields
+
+    def _changed(self, bucket):
+        self._dirty.add(bucket)
+        if self.autoflush:
+            self.flush()
+
+    def _read(self, keys):
+        """ Read keys, leaving out the ones that are not stored. Any other
+        failure is raised: taking a bucket that could not be read for an
+        empty one would overwrite its fields on the next write. """
+
+        stored = self.container.read_many(keys)
+        if stored is False:
+            raise DBOperationError(f'Failed to read "{self.name}".')
+        for error in stored.errors.values():
+            if not isinstance(error, FileNotFoundError):
+                raise error
+        return stored
+
+    def _fields(self, stored):
+        return dict(stored['fields']) if stored else {}
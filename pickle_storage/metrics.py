@@ -0,0 +1,216 @@
+""" Operation metrics.
+
+Storage operations report to the process-wide sink returned by get_sink():
+per-phase latencies (path resolution, pickle, HMAC, file I/O and unpickle),
+whole-operation latencies, bytes read and written, retries, HMAC failures,
+the number of operations in flight and lock waits. The sink is built from
+PICKLE_STORAGE_METRICS_SINK; MemorySink keeps everything in memory for
+prometheus_text() to export. """
+
+import bisect
+import importlib
+import pathlib
+import threading
+import time
+
+__all__ = ['BYTES_READ', 'BYTES_WRITTEN', 'DEFAULT_BUCKETS', 'EVICTIONS',
+    'FUNCTION_SECONDS', 'HMAC_FAILURES', 'Histogram', 'IN_FLIGHT',
+    'LOCK_CONTENDED', 'LOCK_TIMEOUTS', 'LOCK_WAIT_SECONDS', 'MemorySink',
+    'MetricsSink', 'OPERATION_SECONDS', 'PHASES', 'PHASE_SECONDS', 'Phase',
+    'RETRIES', 'get_sink', 'prometheus_text', 'set_sink', 'write_prometheus']
+
+PHASES = ('resolve', 'pickle', 'hmac', 'io', 'unpickle')
+
+OPERATION_SECONDS = 'pickle_storage_operation_seconds'
+PHASE_SECONDS = 'pickle_storage_phase_seconds'
+FUNCTION_SECONDS = 'pickle_storage_function_seconds'
+BYTES_READ = 'pickle_storage_bytes_read_total'
+BYTES_WRITTEN = 'pickle_storage_bytes_written_total'
+RETRIES = 'pickle_storage_retries_total'
+HMAC_FAILURES = 'pickle_storage_hmac_failures_total'
+IN_FLIGHT = 'pickle_storage_operations_in_flight'
+LOCK_WAIT_SECONDS = 'pickle_storage_lock_wait_seconds'
+LOCK_CONTENDED = 'pickle_storage_lock_contended_total'
+LOCK_TIMEOUTS = 'pickle_storage_lock_timeouts_total'
+EVICTIONS = 'pickle_storage_evictions_total'
+
+# Upper bounds in seconds
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram():
+    """ Counts of observed values per bucket, plus their total and sum. """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # Last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """ (upper bound, count of values at or below it) pairs, ending
+        with +Inf. """
+
+        total = 0
+        pairs = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+class MetricsSink():
+    """ Receives measurements and discards them. Subclass to send them
+    somewhere; labels are tuples of (name, value) pairs. """
+
+    def adjust(self, name, amount, labels=()):
+        """ Move the gauge name by amount. """
+
+    def increment(self, name, amount=1, labels=()):
+        """ Add amount to the counter name. """
+
+    def observe(self, name, value, labels=()):
+        """ Record value, in seconds, in the histogram name. """
+
+class MemorySink(MetricsSink):
+    """ Keeps every counter, gauge and histogram in memory. """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def adjust(self, name, amount, labels=()):
+        with self._lock:
+            key = (name, labels)
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def increment(self, name, amount=1, labels=()):
+        with self._lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        with self._lock:
+            key = (name, labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def value(self, name, labels=()):
+        """ Current value of a counter or gauge, 0 if never reported. """
+
+        with self._lock:
+            key = (name, labels)
+            return self.counters.get(key, self.gauges.get(key, 0))
+
+class Phase():
+    """ Context manager recording how long one phase of an operation
+    takes. """
+
+    __slots__ = ('labels', 'start')
+
+    def __init__(self, operation, phase):
+        self.labels = (('operation', operation), ('phase', phase))
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        get_sink().observe(PHASE_SECONDS, time.perf_counter() - self.start,
+            self.labels)
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+def get_sink():
+    """ Return the process-wide sink, building it from
+    PICKLE_STORAGE_METRICS_SINK on first use. """
+
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                from pickle_storage.config.tools import get_settings_config
+                import_string = get_settings_config(
+                    ).PICKLE_STORAGE_METRICS_SINK
+                if import_string:
+                    module_name, class_name = import_string.rsplit('.', 1)
+                    _sink = getattr(importlib.import_module(module_name),
+                        class_name)()
+                else:
+                    _sink = MetricsSink()
+    return _sink
+
+def set_sink(sink):
+    """ Replace the process-wide sink. Returns the previous one. """
+
+    global _sink
+    with _sink_lock:
+        previous, _sink = _sink, sink
+    return previous
+
+def prometheus_text(sink=None):
+    """ Render a MemorySink in the Prometheus text exposition format. """
+
+    if sink is None:
+        sink = get_sink()
+    with sink._lock:
+        counters = dict(sink.counters)
+        gauges = dict(sink.gauges)
+        histograms = {key: (histogram.cumulative_counts(), histogram.sum,
+            histogram.count) for key, histogram in sink.histograms.items()}
+
+    lines = []
+    for kind, values in (('counter', counters), ('gauge', gauges)):
+        for name in sorted({name for name, labels in values}):
+            lines.append(f'# TYPE {name} {kind}')
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+
+    for name in sorted({name for name, labels in histograms}):
+        lines.append(f'# TYPE {name} histogram')
+        for (metric, labels), (buckets, total, count) in sorted(
+            histograms.items()):
+            if metric != name:
+                continue
+            for bound, cumulative in buckets:
+                bound = '+Inf' if bound == float('inf') else repr(bound)
+                bucket_labels = _format_labels(labels + (('le', bound),))
+                lines.append(f'{name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+def write_prometheus(path, sink=None):
+    """ Write prometheus_text() to path atomically, for collectors that read
+    metrics from files (e.g. node_exporter's textfile collector). """
+
+    from pickle_storage.utils import atomic_write
+    atomic_write(pathlib.Path(path), [prometheus_text(sink).encode()])
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"'
+            ).replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
@@ -1,23 +1,123 @@
+import collections
 import hmac
+import os
 import pathlib
 import hashlib
+import threading
 import uuid
 import pickle
 
 
-from pickle_storage.utils import write_to_log, db_relative_path
+from pickle_storage.utils import atomic_write, db_relative_path, write_to_log
 from pickle_storage.config.tools import get_settings_config
 storage_settings = get_settings_config()
 
+# Large payloads are hashed in slices of this many bytes
+HMAC_CHUNK_SIZE = 1024 * 1024
+
+# Algorithms with a keyed mode of their own, used instead of HMAC
+KEYED_ALGORITHMS = {'blake2b', 'blake2s'}
+
+# Signed list of the keys retired by rotation, relative to the working
+# directory, so every process keeps accepting them
+RETIRED_KEYS_PATH = pathlib.PurePath('_meta', 'retired_keys.psm')
+
+SigningKey = collections.namedtuple('SigningKey',
+    ['key_id', 'signature', 'key', 'mac'])
+
+_signing_key_cache = {}
+_signing_key_lock = threading.Lock()
+_retired_keys_cache = {}
+
+def new_mac(key, hashing_algorithm):
+    """ Keyed hash object for key. hashing_algorithm is a hashlib name or
+    constructor; blake2b and blake2s use their native keyed mode, with 32
+    byte digests, and everything else HMAC. """
+
+    if hashing_algorithm in KEYED_ALGORITHMS:
+        return getattr(hashlib, hashing_algorithm)(key=key, digest_size=32)
+    return hmac.new(key, digestmod=hashing_algorithm)
+
+def load_signing_key(key_id, hashing_algorithm='sha256'):
+    """ Return the SigningKey stored under key_id, loading it only if the key
+    file changed since it was last read by this process. The ``mac`` field is
+    a hash object primed with the key, see new_mac(), to be copied rather
+    than reused. """
+
+    # Signing keys always live directly in the working directory
+    key_file = pathlib.Path(storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY,
+        f"{key_id}{storage_settings.PICKLE_STORAGE_SUFFIX}")
+    stat = os.stat(key_file)
+    signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    cache_key = (key_file, hashing_algorithm)
+
+    cached = _signing_key_cache.get(cache_key)
+    if cached and cached.signature == signature:
+        return cached
+
+    with _signing_key_lock:
+        with key_file.open('rb') as f:
+            key = pickle.loads(f.read())
+        cached = SigningKey(key_id, signature, key,
+            new_mac(key, hashing_algorithm))
+        _signing_key_cache[cache_key] = cached
+    return cached
+
+def clear_signing_key_cache():
+    with _signing_key_lock:
+        _signing_key_cache.clear()
+
+def retired_key_ids():
+    """ Names of the retired signing keys: those listed in
+    PICKLE_STORAGE_RETIRED_SIGNING_KEY_FILENAMES, followed by those retired
+    by rotation and recorded in the store. """
+
+    names = list(storage_settings.PICKLE_STORAGE_RETIRED_SIGNING_KEY_FILENAMES)
+    path = pathlib.Path(storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY,
+        RETIRED_KEYS_PATH)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return names
+    signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    cached = _retired_keys_cache.get(path)
+    if cached is None or cached[0] != signature:
+        raw = path.read_bytes()
+        # Checked against the active key only, which signed it
+        signer = HMACMixin()
+        size = signer.signing_key.mac.digest_size
+        recorded = []
+        if hmac.compare_digest(raw[:size], signer.hmac_digest(raw[size:])):
+            recorded = pickle.loads(raw[size:])
+        else:
+            write_to_log('Ignoring the list of retired signing keys, digest '
+                'did not match content.', level='warning')
+        cached = _retired_keys_cache[path] = (signature, recorded)
+    names.extend(name for name in cached[1] if name not in names)
+    return names
+
+def save_retired_key_ids(names):
+    """ Record names as the keys retired by rotation, signed with the
+    active key. """
+
+    path = pathlib.Path(storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY,
+        RETIRED_KEYS_PATH)
+    path.parent.mkdir(exist_ok=True)
+    payload = pickle.dumps(list(names))
+    atomic_write(path, [HMACMixin().hmac_digest(payload), payload])
+
+def signing_key_filenames():
+    """ File names of the active and retired signing keys. """
+
+    names = [storage_settings.PICKLE_STORAGE_SIGNING_KEY_FILENAME]
+    names.extend(retired_key_ids())
+    return {f"{name}{storage_settings.PICKLE_STORAGE_SUFFIX}" for name in names}
+
 class HMACMixin():
     """ Provides methods used to more securely pickle binary data using the
     pathlib and hmac libraries """
-    hashing_algorithm = hashlib.sha256
+    hashing_algorithm = 'sha256'
 
-    def __init__(self, *args, **kwargs):
-        self.__cached_key = None
-        super().__init__(*args, **kwargs)
-        
     @property
     def data_dir(self):
         return pathlib.Path(storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY)
@@ -27,24 +127,53 @@ class HMACMixin():
         return db_relative_path(
             storage_settings.PICKLE_STORAGE_SIGNING_KEY_FILENAME)
 
+    @property
+    def signing_key(self):
+        """ The active SigningKey, used for new digests. """
+
+        return load_signing_key(
+            storage_settings.PICKLE_STORAGE_SIGNING_KEY_FILENAME,
+            self.hashing_algorithm)
+
+    def verification_keys(self, hashing_algorithm=None):
+        """ Yield the active key, followed by any retired keys still on disk,
+        for hashing_algorithm (by default the instance's). """
+
+        hashing_algorithm = hashing_algorithm or self.hashing_algorithm
+        yield load_signing_key(
+            storage_settings.PICKLE_STORAGE_SIGNING_KEY_FILENAME,
+            hashing_algorithm)
+        for key_id in retired_key_ids():
+            try:
+                yield load_signing_key(key_id, hashing_algorithm)
+            except FileNotFoundError:
+                continue
+
     @property
     def _signing_key(self):
         """ Secret key used to create digests """
+        return self.signing_key.key
 
-        if not self.__cached_key:
-            with self.key_file.open('rb') as f:
-                self.__cached_key = pickle.loads(f.read())
-            return self.__cached_key
-        else:
-            return self.__cached_key
+    def hmac_digest(self, content, signing_key=None):
+        """ Create digest of binary data. content may also be a list of
+        bytes-like parts, digested in order. """
 
-    def hmac_digest(self, content):
-        """ Create digest of binary data """
-        
-        return hmac.new(self._signing_key, content,
-                        self.hashing_algorithm).digest()
+        mac = (signing_key or self.signing_key).mac.copy()
+        parts = content if isinstance(content, list) else [content]
+        for part in parts:
+            if len(part) <= HMAC_CHUNK_SIZE:
+                mac.update(part)
+                continue
+            with memoryview(part) as view:
+                for offset in range(0, len(view), HMAC_CHUNK_SIZE):
+                    mac.update(view[offset:offset + HMAC_CHUNK_SIZE])
+        return mac.digest()
 
-    def is_safe(self, digest, content):
+    def is_safe(self, digest, content, hashing_algorithm=None):
         """ Verify that content is as expected. """
-        
-        return hmac.compare_digest(digest, self.hmac_digest(content))
+
+        for signing_key in self.verification_keys(hashing_algorithm):
+            if hmac.compare_digest(digest,
+                self.hmac_digest(content, signing_key)):
+                return True
+        return False
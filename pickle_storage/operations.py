@@ -1,27 +1,56 @@
+import collections
+import contextlib
+import functools
 import itertools
+import mmap
+import os
 import threading
 import pickle
 import re
+import time
+from concurrent.futures import wait
 
-from pickle_storage.errors import ForbiddenFileError
-from pickle_storage.utils import write_to_log, db_relative_path, log_errors
-from pickle_storage.mixins import HMACMixin
+from pickle_storage.errors import (ConfigError, DBOperationError,
+    ForbiddenFileError, IntegrityError)
+from pickle_storage.utils import (write_to_log, db_relative_path, log_errors,
+    atomic_write, fsync_directories, write_temporary)
+from pickle_storage.mixins import HMACMixin, signing_key_filenames
+from pickle_storage.blobs import (blob_path, pack_reference, verify_blob,
+    write_blob)
+from pickle_storage.compression import compress, decompress
+from pickle_storage.manifest import entry_for
+from pickle_storage.metrics import (BYTES_READ, BYTES_WRITTEN, HMAC_FAILURES,
+    IN_FLIGHT, OPERATION_SECONDS, Phase, get_sink)
+from pickle_storage.fileformat import (DIGEST_ALGORITHMS, FLAG_OUT_OF_BAND,
+    FLAG_REFERENCE, HEADER, has_out_of_band, is_framed, pack_frame,
+    unpack_frame)
+from pickle_storage.executor import get_executor
 from pickle_storage.config.tools import get_settings_config
 storage_settings = get_settings_config()
 
-class BaseStorageOperation(threading.Thread):
+class BaseStorageOperation():
+    """ A single storage operation, run on the shared executor as soon as it
+    is created. Instances act as handles on the pending result. """
     id_iterator = itertools.count()
 
     def __init__(self, *args, **kwargs):
         self._return = False
         self.thread_id = next(self.id_iterator)
-        kwargs['name'] = f"{self.__class__.__name__}-{self.thread_id}"
-        kwargs['daemon'] = True
+        self.name = f"{self.__class__.__name__}-{self.thread_id}"
         self.on_complete = kwargs.pop('on_complete', None)
+        self.locks = kwargs.pop('locks', None)
         self.__kwargs = kwargs
         self.__args = args
-        super().__init__(*args, **kwargs)
-        self.start()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+        self._finished = False
+        get_sink().adjust(IN_FLIGHT, 1)
+        try:
+            self.future = get_executor().submit(self._execute)
+        except:
+            get_sink().adjust(IN_FLIGHT, -1)
+            raise
+        self.future.add_done_callback(self._future_done)
 
     def pre_operation(self, *args, **kwargs):
         return True
@@ -32,12 +61,74 @@ class BaseStorageOperation(threading.Thread):
     def post_operation(self, *args, **kwargs):
         pass
 
-    def join(self, *args, **kwargs):
-        super().join(*args, **kwargs)
+    def locked(self, paths, exclusive=False):
+        """ Context manager holding the cross-process locks of paths while
+        locking is enabled (see pickle_storage.locks). """
+
+        if self.locks is None:
+            return contextlib.nullcontext()
+        return self.locks.keys(paths, exclusive)
+
+    def add_done_callback(self, fn):
+        """ Call fn(operation) once the operation finishes, before join()
+        returns. Runs immediately if the operation is already finished. """
+
+        with self._callbacks_lock:
+            if not self._finished:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def cancel(self):
+        """ Stop the operation if it has not started running yet. Done
+        callbacks still run for a cancelled operation. Returns whether it was
+        cancelled. """
+
+        return self.future.cancel()
+
+    def cancelled(self):
+        return self.future.cancelled()
+
+    def done(self):
+        return self.future.done()
+
+    def is_alive(self):
+        return not self.future.done()
+
+    def join(self, timeout=None):
+        wait([self.future], timeout=timeout)
         if self.on_complete:
             self.on_complete(self._return)
         return self._return
 
+    def _execute(self):
+        start = time.perf_counter()
+        try:
+            self.run()
+        finally:
+            get_sink().observe(OPERATION_SECONDS, time.perf_counter() - start,
+                (('operation', type(self).__name__),))
+            self._finish()
+
+    def _finish(self):
+        with self._callbacks_lock:
+            if self._finished:
+                return
+            self._finished = True
+            callbacks, self._callbacks = self._callbacks, []
+        get_sink().adjust(IN_FLIGHT, -1)
+        for fn in callbacks:
+            self._run_callback(fn)
+
+    def _future_done(self, future):
+        # A cancelled operation never reaches _execute()
+        if future.cancelled():
+            self._finish()
+
+    @log_errors
+    def _run_callback(self, fn):
+        fn(self)
+
     @log_errors
     def run(self):
         if not self.pre_operation():
@@ -47,87 +138,448 @@ class BaseStorageOperation(threading.Thread):
         self.post_operation(self._return, **self.__kwargs)
 
 
+class CallableOperation(BaseStorageOperation):
+    """ Runs fn(*args) on the shared executor. """
+
+    def __init__(self, fn, *args, **kwargs):
+        self.fn = fn
+        self.fn_args = args
+        super().__init__(**kwargs)
+
+    def do_operation(self, *args, **kwargs):
+        return self.fn(*self.fn_args)
+
+
 class Write(HMACMixin, BaseStorageOperation):
     
-    def __init__(self, path='', content=None, *args, secure=True, **kwargs):
+    def __init__(self, path='', content=None, *args, secure=True,
+        durability=None, out_of_band=None, compression=None, protocol=None,
+        dedup=None, digest_algorithm=None, ttl=None, expiry=None, **kwargs):
+        """
+        Kwargs:
+            - out_of_band (bool): Pickle with protocol 5 and store large
+            buffers (bytearray, NumPy arrays, PickleBuffer) after the payload
+            so reads can map them without copying. Defaults to
+            PICKLE_STORAGE_OUT_OF_BAND.
+            - compression (str): Codec for the pickle payload ('zlib', 'bz2'
+            or 'lzma'), or False to store it raw. Defaults to
+            PICKLE_STORAGE_COMPRESSION.
+            - protocol (int): Pickle protocol. Defaults to
+            PICKLE_STORAGE_PICKLE_PROTOCOL.
+            - dedup (bool): Store the pickled value as a content-addressed
+            blob shared by every key holding the same value, and only a
+            reference to it in the key's file; see pickle_storage.blobs.
+            Defaults to PICKLE_STORAGE_DEDUP.
+            - digest_algorithm (str): Keyed digest signing the file, one of
+            pickle_storage.fileformat.DIGEST_ALGORITHMS. It is recorded in
+            the file, so files signed with any of them stay readable.
+            Defaults to PICKLE_STORAGE_DIGEST_ALGORITHM.
+            - ttl (float): Seconds until the written keys expire, recorded in
+            expiry (a pickle_storage.eviction.ExpiryIndex) before each file
+            is renamed into place. Keys written without one lose any expiry
+            time they had.
+
+        Insecure writes store a bare pickle and ignore these options.
+        """
 
         self.content = content
         if path:
-            self.path = db_relative_path(path)
+            with Phase(type(self).__name__, 'resolve'):
+                self.path = db_relative_path(path)
         else:
             self.path = None
         self.secure = secure
+        self.durability = durability or storage_settings.PICKLE_STORAGE_DURABILITY
+        if out_of_band is None:
+            out_of_band = storage_settings.PICKLE_STORAGE_OUT_OF_BAND
+        self.out_of_band = out_of_band
+        if compression is None:
+            compression = storage_settings.PICKLE_STORAGE_COMPRESSION
+        self.compression = compression
+        if protocol is None:
+            protocol = storage_settings.PICKLE_STORAGE_PICKLE_PROTOCOL
+        self.protocol = protocol
+        if dedup is None:
+            dedup = storage_settings.PICKLE_STORAGE_DEDUP
+        self.dedup = dedup
+        self.hashing_algorithm = digest_algorithm or \
+            storage_settings.PICKLE_STORAGE_DIGEST_ALGORITHM
+        if self.hashing_algorithm not in DIGEST_ALGORITHMS:
+            raise ConfigError('Unknown digest algorithm '
+                f'"{self.hashing_algorithm}".')
+        if ttl is not None and expiry is None:
+            raise ConfigError('A TTL needs an expiry index to record it in.')
+        self.ttl = ttl
+        self.expiry = expiry
+        self._replaced_expiries = {}
+        self.manifest_entries = {}
         super().__init__(*args, **kwargs)
 
 
     def do_operation(self, *args, **kwargs):
-        binary_content = pickle.dumps(self.content)
-        if self.secure:
-            if self.path.name == self.signing_key_filename:
-                raise ForbiddenFileError('Permission denied.')
-
-            digest = self.hmac_digest(binary_content)
-            with open(self.path, "wb") as f:
-                f.write(digest)
-                f.write(bytearray(1))
-                f.write(binary_content)
-        else:
-            with open(self.path, "wb") as f:
-                f.write(binary_content)
+        if self.secure and self.path.name in signing_key_filenames():
+            raise ForbiddenFileError('Permission denied.')
 
+        chunks = self.encode(self.content)
+        with self.locked([self.path], exclusive=True), Phase('Write', 'io'):
+            try:
+                stat = atomic_write(self.path, chunks, self.durability,
+                    functools.partial(self.record_expiry, [self.path.name]))
+            except:
+                self.revert_expiry()
+                raise
+        get_sink().increment(BYTES_WRITTEN, stat.st_size)
+        self.manifest_entries[self.path.name] = entry_for(stat,
+            b''.join(chunks[:2]) if self.secure else b'')
         return True
 
+    def encode(self, content, signing_key=None):
+        """ Pickle content, returning the chunks that make up its file. """
+
+        operation = type(self).__name__
+        if not self.secure:
+            with Phase(operation, 'pickle'):
+                return [pickle.dumps(content, self.protocol)]
+
+        with Phase(operation, 'pickle'):
+            header, body = self.frame(content)
+        if self.dedup:
+            header, body = self.store_blob(header, body)
+        with Phase(operation, 'hmac'):
+            digest = self.hmac_digest([header] + body, signing_key)
+        return [header, digest] + body
+
+    def frame(self, content):
+        """ Pickle and compress content, returning the header and body of
+        its framed file. """
+
+        flags = 0
+        buffers = []
+        if self.out_of_band:
+            flags |= FLAG_OUT_OF_BAND
+            protocol = 5
+            payload = pickle.dumps(content, protocol,
+                buffer_callback=functools.partial(self.collect_buffer, buffers))
+        else:
+            protocol = self.protocol
+            payload = pickle.dumps(content, protocol)
+
+        codec, payload = compress(self.compression, payload,
+            storage_settings.PICKLE_STORAGE_COMPRESSION_THRESHOLD)
+        return pack_frame(payload, buffers, flags, protocol, codec,
+            self.hashing_algorithm)
+
+    def store_blob(self, header, body):
+        """ Store a framed file as a content-addressed blob, unless an
+        identical one exists already, and return the header and body of a
+        reference to it. Blobs never change; the store lock is held shared
+        only so that garbage collection cannot remove a blob while it is
+        being reused. """
+
+        locked = contextlib.nullcontext()
+        if self.locks is not None:
+            locked = self.locks.store(exclusive=False)
+        with locked, Phase(type(self).__name__, 'io'):
+            digest, written = write_blob(header, body, self.durability)
+        get_sink().increment(BYTES_WRITTEN, written)
+        return pack_reference(digest, self.hashing_algorithm)
+
+    def collect_buffer(self, buffers, pickle_buffer):
+        """ buffer_callback for pickle.dumps. Moves buffers of at least
+        PICKLE_STORAGE_OUT_OF_BAND_THRESHOLD bytes out of the pickle stream
+        and into aligned segments after it. """
+
+        try:
+            raw = pickle_buffer.raw()
+        except BufferError: # Not contiguous, keep it in the stream
+            return True
+        if raw.nbytes < storage_settings.PICKLE_STORAGE_OUT_OF_BAND_THRESHOLD:
+            return True
+        buffers.append(raw)
+        return False
+
     def pre_operation(self, *args, **kwargs):
         if not self.path or not self.content:
             return False
         return super().pre_operation(*args, **kwargs)
 
-    @property
-    def signing_key_filename(self):
+    def record_expiry(self, names):
+        """ Record the expiry time of the files names, written but not yet
+        renamed into place, remembering the ones they replace. """
+
+        if self.expiry is None:
+            return
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        for name in names:
+            self._replaced_expiries[name] = self.expiry.expires_at(name)
+        self.expiry.set_many(dict.fromkeys(names, expires_at))
 
-        name = storage_settings.PICKLE_STORAGE_SIGNING_KEY_FILENAME
-        name += storage_settings.PICKLE_STORAGE_SUFFIX
-        return name
+    def revert_expiry(self, names=None):
+        """ Restore the expiry times of names (by default every file
+        recorded) whose files were not renamed into place after all. """
+
+        if names is None:
+            names = list(self._replaced_expiries)
+        replaced = {name: self._replaced_expiries.pop(name) for name in names
+            if name in self._replaced_expiries}
+        if replaced:
+            self.expiry.set_many(replaced)
+
+    def target_paths(self):
+        """ Paths this operation may replace. """
+        return [self.path] if self.path else []
 
 class Read(HMACMixin, BaseStorageOperation):
     
-    def __init__(self, path='', *args, **kwargs):
+    def __init__(self, path='', *args, mmap=None, **kwargs):
+        """
+        Kwargs:
+            - mmap (bool): Memory-map the file rather than reading it into
+            memory. Defaults to mapping files of at least
+            PICKLE_STORAGE_MMAP_THRESHOLD bytes.
+        """
         if path:
-            self.path = db_relative_path(path)
+            with Phase(type(self).__name__, 'resolve'):
+                self.path = db_relative_path(path)
         else:
             self.path = None
+        self.mmap = mmap
         super().__init__(*args, **kwargs)
 
 
     def do_operation(self, *args, **kwargs):
-        attempts = 0
-        while attempts < 3:
+        # Writes replace files atomically, so a mismatch is never a partial
+        # write in progress and retrying would not help.
+        try:
+            return self.read_file(self.path)
+        except FileNotFoundError:
+            return None
+        except IntegrityError:
+            get_sink().increment(HMAC_FAILURES)
+            write_to_log(f'Failed to read "{self.path}"'
+                    ' digest did not match content.', level='warning')
+            return None
 
-            unsafe_content = False
-            try:
-            
-                with open(self.path, 'rb') as f:
-                    digest = f.read(32) 
-                    f.seek(33) # One null byte separates the digest from content
-                    content = f.read()
-
-                if self.is_safe(digest, content):
-                    return pickle.loads(content)
-                else:
-                    unsafe_content = True
-                time.sleep(0.05)
+    def decode(self, raw):
+        """ Verify and unpickle the contents of a storage file. """
 
-            except:
-                pass
+        with memoryview(raw) as view:
+            if is_framed(view):
+                try:
+                    return self.decode_framed(view)
+                except IntegrityError:
+                    # A headerless file whose digest happens to start with
+                    # the magic bytes; try it as one.
+                    pass
+            return self.decode_headerless(view)
 
-            attempts +=1
+    def decode_framed(self, view):
+        operation = type(self).__name__
+        frame = unpack_frame(view)
+        with Phase(operation, 'hmac'):
+            if not self.is_safe(frame.digest, frame.signed, frame.algorithm):
+                raise IntegrityError('Digest did not match content.')
+        if frame.flags & FLAG_REFERENCE:
+            return self.read_blob(bytes(frame.payload))
+        with Phase(operation, 'unpickle'):
+            return pickle.loads(decompress(frame.codec, frame.payload),
+                buffers=frame.buffers)
 
-        if unsafe_content:
-            write_to_log(f'Failed to read "{self.path}"'
-                    ' digest did not match content.', level='warning')
-        return None
+    def decode_headerless(self, view):
+        # One null byte separates the digest from content. Views are released
+        # explicitly so that a memory-mapped source can be closed as soon as
+        # this returns, even if it raised.
+        operation = type(self).__name__
+        with view[:32] as digest, view[33:] as content:
+            with Phase(operation, 'hmac'):
+                if not self.is_safe(digest, content):
+                    raise IntegrityError('Digest did not match content.')
+            with Phase(operation, 'unpickle'):
+                return pickle.loads(content)
+
+    def decode_blob(self, digest, raw):
+        """ Verify the blob raw against digest and unpickle it. """
+
+        operation = type(self).__name__
+        with memoryview(raw) as view:
+            with Phase(operation, 'hmac'):
+                frame = verify_blob(view, digest)
+            with Phase(operation, 'unpickle'):
+                return pickle.loads(decompress(frame.codec, frame.payload),
+                    buffers=frame.buffers)
+
+    def read_blob(self, digest):
+        """ Read the value held by the blob a verified reference points
+        at. """
+
+        try:
+            return self.read_file(blob_path(digest),
+                functools.partial(self.decode_blob, digest))
+        except FileNotFoundError:
+            raise IntegrityError(f'Blob "{digest.hex()}" is missing.')
+
+    def read_file(self, path, decode=None):
+        """ Read, verify and unpickle path, with decode (self.decode by
+        default). Mapped files are verified and unpickled in place, without
+        copying them into memory first. Files with out-of-band buffers are
+        always mapped, and their buffers are returned as views of the
+        mapping. """
+
+        if decode is None:
+            decode = self.decode
+
+        raw = None
+        with self.locked([path]), Phase(type(self).__name__, 'io'), \
+            open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            get_sink().increment(BYTES_READ, size)
+            if not size:
+                raw = b''
+            elif not self.use_mmap(size) and not has_out_of_band(
+                f.read(HEADER.size)):
+                f.seek(0)
+                raw = f.read()
+            else:
+                # Pages are read as they are first touched, while hashing
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if raw is not None:
+            return decode(raw)
+
+        try:
+            return decode(mapped)
+        finally:
+            try:
+                mapped.close()
+            except BufferError:
+                # Out-of-band buffers in the result still use the mapping,
+                # which is unmapped once they are garbage collected.
+                pass
+
+    def use_mmap(self, size):
+        if self.mmap is not None:
+            return self.mmap
+        threshold = storage_settings.PICKLE_STORAGE_MMAP_THRESHOLD
+        return threshold is not None and size >= threshold
 
     def pre_operation(self, *args, **kwargs):
         if not self.path:
             return False
-        return super().pre_operation(*args, **kwargs)
\ No newline at end of file
+        return super().pre_operation(*args, **kwargs)
+
+
+class BatchResult(dict):
+    """ Per-key results of a batch operation. Keys that failed are left out
+    and their exceptions collected in ``errors`` instead. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.errors = {}
+
+
+class WriteMany(Write):
+    """ Write several keys as one operation. Everything is pickled and signed
+    up front, then each file is staged beside its target and renamed into
+    place. If fsync is set, every staged file is flushed before any rename
+    and directories are flushed once at the end. """
+
+    def __init__(self, mapping=None, *args, fsync=False, **kwargs):
+        self.mapping = dict(mapping or {})
+        self.fsync = fsync
+        super().__init__(*args, **kwargs)
+
+    def do_operation(self, *args, **kwargs):
+        result = BatchResult()
+        signing_key = self.signing_key if self.secure else None
+        key_filenames = signing_key_filenames()
+
+        encoded = []
+        for key, content in self.mapping.items():
+            try:
+                with Phase('WriteMany', 'resolve'):
+                    path = db_relative_path(key)
+                if not content:
+                    raise DBOperationError('Nothing to write.')
+                if self.secure and path.name in key_filenames:
+                    raise ForbiddenFileError('Permission denied.')
+                encoded.append((path, key, self.encode(content, signing_key)))
+            except Exception as e:
+                result.errors[key] = e
+
+        encoded.sort(key=lambda item: item[0])
+        durability = 'directory' if self.fsync else self.durability
+        staged = collections.deque()
+        written = 0
+        with self.locked([path for path, key, chunks in encoded],
+            exclusive=True), Phase('WriteMany', 'io'):
+            try:
+                for path, key, chunks in encoded:
+                    try:
+                        temp_path, stat = write_temporary(path, chunks,
+                            fsync=durability != 'none')
+                        staged.append((temp_path, path, key))
+                        written += stat.st_size
+                        self.manifest_entries[path.name] = entry_for(stat,
+                            b''.join(chunks[:2]) if self.secure else b'')
+                    except Exception as e:
+                        result.errors[key] = e
+
+                self.record_expiry([path.name
+                    for temp_path, path, key in staged])
+                while staged:
+                    temp_path, path, key = staged.popleft()
+                    try:
+                        os.replace(temp_path, path)
+                        result[key] = True
+                    except Exception as e:
+                        os.unlink(temp_path)
+                        del self.manifest_entries[path.name]
+                        self.revert_expiry([path.name])
+                        result.errors[key] = e
+            finally:
+                for temp_path, path, key in staged:
+                    os.unlink(temp_path)
+                    self.manifest_entries.pop(path.name, None)
+                self.revert_expiry([path.name
+                    for temp_path, path, key in staged])
+
+            if durability == 'directory' and result:
+                fsync_directories({path.parent
+                    for path, key, chunks in encoded})
+        get_sink().increment(BYTES_WRITTEN, written)
+        return result
+
+    def pre_operation(self, *args, **kwargs):
+        return BaseStorageOperation.pre_operation(self, *args, **kwargs)
+
+    def target_paths(self):
+        return list(self.mapping)
+
+
+class ReadMany(Read):
+    """ Read several keys as one operation, returning a BatchResult. """
+
+    def __init__(self, keys=None, *args, **kwargs):
+        self.keys = list(keys or [])
+        super().__init__(*args, **kwargs)
+
+    def do_operation(self, *args, **kwargs):
+        result = BatchResult()
+        paths = []
+        for key in self.keys:
+            try:
+                with Phase('ReadMany', 'resolve'):
+                    paths.append((db_relative_path(key), key))
+            except Exception as e:
+                result.errors[key] = e
+
+        for path, key in sorted(paths, key=lambda item: item[0]):
+            try:
+                result[key] = self.read_file(path)
+            except Exception as e:
+                if isinstance(e, IntegrityError):
+                    get_sink().increment(HMAC_FAILURES)
+                result.errors[key] = e
+        return result
+
+    def pre_operation(self, *args, **kwargs):
+        return BaseStorageOperation.pre_operation(self, *args, **kwargs)
@@ -0,0 +1,554 @@
+import atexit
+import collections
+import os
+import pickle
+import shutil
+import struct
+import threading
+import weakref
+
+from pickle_storage.compression import compress, decompress
+from pickle_storage.container import BaseStorageContainer
+from pickle_storage.manifest import paginate
+from pickle_storage.metrics import (BYTES_READ, BYTES_WRITTEN, HMAC_FAILURES,
+    Phase, get_sink)
+from pickle_storage.errors import (DBOperationError, ForbiddenFileError,
+    IntegrityError)
+from pickle_storage.mixins import HMACMixin, signing_key_filenames
+from pickle_storage.operations import BatchResult, CallableOperation
+from pickle_storage.utils import (atomic_write, db_relative_path,
+    fsync_directories, write_to_log)
+from pickle_storage.config.tools import get_settings_config
+storage_settings = get_settings_config()
+
+__all__ = ['SegmentStorageContainer']
+
+SEGMENT_SUFFIX = '.pslog'
+HINT_FILENAME = 'segments.pshint'
+RECORD_MAGIC = b'PR'
+DIGEST_SIZE = 32
+
+# magic, flags, compression codec, key length, value length
+RECORD = struct.Struct('<2sBBIQ')
+
+# Where the latest record for a key lives
+Location = collections.namedtuple('Location', ['segment', 'offset', 'length'])
+
+# Containers still open, closed at interpreter exit
+_open_containers = weakref.WeakSet()
+
+@atexit.register
+def _close_open_containers():
+    for container in list(_open_containers):
+        container.close()
+
+def _compact_periodically(container_ref, closed, interval):
+    """ Compaction loop, holding the container only while compacting so
+    that it can still be garbage collected. """
+
+    while not closed.wait(interval):
+        container = container_ref()
+        if container is None:
+            return
+        try:
+            container.compact()
+        except Exception:
+            write_to_log('Segment compaction failed.', level='error')
+        del container
+
+class SegmentStorageContainer(HMACMixin, BaseStorageContainer):
+    """ Stores every key in a few append-only segment files rather than one
+    file per key.
+
+    Each write appends a signed record to the active segment and points an
+    in-memory index at it. The index is saved to a signed hint file on
+    close() and after compaction, and rebuilt at startup from the hint file
+    plus whatever was appended after it was written. Compaction copies live
+    records out of sealed segments whose records have mostly been
+    overwritten, then deletes them.
+
+    Only signed records are stored, so insecure writes are refused. Keys
+    cannot be deleted, and snapshots cannot be restored into a segment store.
+    A store must only be opened by one process at a time. """
+
+    def __init__(self, *args, **kwargs):
+        self.segment_max_bytes = kwargs.get("segment_max_bytes",
+            storage_settings.PICKLE_STORAGE_SEGMENT_MAX_BYTES)
+        self.compaction_ratio = kwargs.get("compaction_ratio",
+            storage_settings.PICKLE_STORAGE_SEGMENT_COMPACTION_RATIO)
+        self._lock = threading.RLock()
+        self._index = {}
+        self._fds = {}
+        # Reads in progress per segment, and descriptors of compacted
+        # segments left open until those reads finish
+        self._readers = collections.Counter()
+        self._retired_fds = {}
+        self._segment_sizes = {}
+        self._live_bytes = collections.Counter()
+        self._active_segment = None
+        self._active_file = None
+        self._closed = threading.Event()
+        super().__init__(*args, **kwargs)
+        _open_containers.add(self)
+
+        interval = kwargs.get("compaction_interval",
+            storage_settings.PICKLE_STORAGE_SEGMENT_COMPACTION_INTERVAL)
+        if interval:
+            threading.Thread(target=_compact_periodically,
+                args=(weakref.ref(self), self._closed, interval),
+                name='PickleStorageCompaction', daemon=True).start()
+
+    @property
+    def hint_path(self):
+        return self.working_dir_path.joinpath(HINT_FILENAME)
+
+    def cache_lookup(self, path):
+        # The read cache is not used, records are read from the segments
+        return False, None, None
+
+    def check_options(self, kwargs):
+        """ Refuse write options segment containers do not support. """
+
+        if kwargs.get('ttl') is not None:
+            raise DBOperationError('Segment containers do not support TTLs.')
+        if not kwargs.get('secure', True):
+            raise DBOperationError('Segment containers only store signed '
+                'records.')
+
+    def clear(self):
+        with self._lock:
+            self._close_files()
+            self._index.clear()
+            self._segment_sizes.clear()
+            self._live_bytes.clear()
+            if self.read_cache is not None:
+                self.read_cache.clear()
+            shutil.rmtree(self.working_dir_path)
+            self.setup()
+        return True
+
+    def close(self):
+        """ Save the index to the hint file and close all segments. """
+
+        super().close()
+        _open_containers.discard(self)
+        self._closed.set()
+        with self._lock:
+            if self._active_file is None:
+                return
+            self.save_hint()
+            self._close_files()
+
+    def compact(self):
+        """ Rewrite sealed segments whose live records make up less than
+        compaction_ratio of their size. Returns the number of segments
+        removed. """
+
+        with self._lock:
+            candidates = [segment for segment, size in self._segment_sizes.items()
+                if segment != self._active_segment
+                and self._live_bytes[segment] < size * self.compaction_ratio]
+        if not candidates:
+            return 0
+
+        for segment in candidates:
+            with self._lock:
+                live = [(key, location) for key, location in self._index.items()
+                    if location.segment == segment]
+            for key, location in live:
+                # Sealed segments never change, so reading needs no lock
+                record = os.pread(self._segment_fd(segment), location.length,
+                    location.offset)
+                with self._lock:
+                    if self._index.get(key) == location:
+                        self._append([(key, record)])
+
+        with self._lock:
+            for segment in candidates:
+                if any(location.segment == segment
+                    for location in self._index.values()):
+                    continue
+                fd = self._fds.pop(segment, None)
+                if fd is not None and self._readers[segment]:
+                    self._retired_fds[segment] = fd
+                elif fd is not None:
+                    os.close(fd)
+                self._segment_path(segment).unlink()
+                del self._segment_sizes[segment]
+                self._live_bytes.pop(segment, None)
+            self._sync(self._active_file)
+            self.save_hint()
+        return len(candidates)
+
+    def contents(self, prefix='', start_after=None, limit=None):
+        if start_after is not None:
+            start_after = self.key_for(start_after)
+        with self._lock:
+            names = sorted(self._index)
+        return [db_relative_path(name)
+            for name in paginate(names, prefix, start_after, limit)]
+
+    def create_locks(self):
+        # A segment store belongs to a single process
+        return None
+
+    def create_manifest(self):
+        # The segment index already lists every key
+        return None
+
+    def create_expiry(self):
+        # Records are only ever superseded, TTLs are not supported
+        return None
+
+    def create_usage_tracker(self):
+        return None
+
+    def create_write_buffer(self):
+        # Appends are already cheap and superseded records are compacted away
+        return None
+
+    def delete(self, path):
+        raise DBOperationError('Segment containers do not support deleting '
+            'keys.')
+
+    def exists(self, file_name):
+        return self.key_for(file_name) in self._index
+
+    def key_for(self, path):
+        return db_relative_path(path).name
+
+    def migrate_layout(self, *args, **kwargs):
+        raise DBOperationError('Segment containers keep every key in their '
+            'segments and have no layout to migrate.')
+
+    def read(self, path='', *args, **kwargs):
+        if not path:
+            return False
+        try:
+            return self.read_record(self.key_for(path))
+        except KeyError:
+            return None
+        except IntegrityError:
+            get_sink().increment(HMAC_FAILURES)
+            write_to_log(f'Failed to read "{path}"'
+                ' digest did not match content.', level='warning')
+            return None
+
+    def read_many(self, keys, **kwargs):
+        result = BatchResult()
+        for key in keys:
+            try:
+                result[key] = self.read_record(self.key_for(key))
+            except KeyError:
+                result.errors[key] = FileNotFoundError(key)
+            except Exception as e:
+                if isinstance(e, IntegrityError):
+                    get_sink().increment(HMAC_FAILURES)
+                result.errors[key] = e
+        return result
+
+    def read_many_operation(self, keys, **kwargs):
+        return CallableOperation(self.read_many, keys)
+
+    def read_operation(self, path='', *args, **kwargs):
+        return CallableOperation(self.read, path)
+
+    def read_record(self, key):
+        """ Return the current value stored under key. Raises KeyError if
+        there is none. """
+
+        with self._lock:
+            location = self._index[key]
+            fd = self._segment_fd(location.segment)
+            # Compaction leaves fd open, and its number unused, until then
+            self._readers[location.segment] += 1
+        try:
+            with Phase('SegmentRead', 'io'):
+                record = os.pread(fd, location.length, location.offset)
+        finally:
+            with self._lock:
+                self._end_read(location.segment)
+        get_sink().increment(BYTES_READ, len(record))
+        record_key, value = self.decode_record(record)
+        if record_key != key:
+            raise IntegrityError(f'Found the record of "{record_key}" where '
+                f'"{key}" was expected.')
+        return value
+
+    def restore(self, *args, **kwargs):
+        # Replacing files would pull them from under the open segments, the
+        # index and the hint file
+        raise DBOperationError('Segment containers do not support restoring '
+            'snapshots.')
+
+    def save_hint(self):
+        """ Write the index, and how far each segment it covers extends, to
+        the hint file. """
+
+        with self._lock:
+            payload = pickle.dumps({'index': dict(self._index),
+                'segments': dict(self._segment_sizes)})
+        atomic_write(self.hint_path, [self.hmac_digest(payload), payload])
+
+    def setup(self):
+        super().setup()
+        with self._lock:
+            self._load_index()
+            self._open_active_segment()
+
+    def write(self, path='', content=None, *args, wait=False, **kwargs):
+        self.check_options(kwargs)
+        on_complete = kwargs.pop('on_complete', None)
+        compression = kwargs.get('compression', self.compression)
+        op = CallableOperation(self.write_records, {path: content},
+            compression, kwargs.get('durability'), True,
+            on_complete=on_complete)
+        if wait:
+            return op.join()
+        return op
+
+    def write_many(self, mapping, *args, wait=False, fsync=False, **kwargs):
+        self.check_options(kwargs)
+        on_complete = kwargs.pop('on_complete', None)
+        compression = kwargs.get('compression', self.compression)
+        durability = 'file' if fsync else kwargs.get('durability')
+        op = CallableOperation(self.write_records, dict(mapping), compression,
+            durability, False, on_complete=on_complete)
+        if wait:
+            return op.join()
+        return op
+
+    def write_records(self, mapping, compression=None, durability=None,
+        single=False):
+        """ Encode and append every key/value pair in mapping. Returns a
+        BatchResult, or for a single write True/False like Write. """
+
+        result = BatchResult()
+        key_filenames = signing_key_filenames()
+        records = []
+        signing_key = self.signing_key
+        for path, content in mapping.items():
+            try:
+                if not path or not content:
+                    raise DBOperationError('Nothing to write.')
+                key = self.key_for(path)
+                if key in key_filenames:
+                    raise ForbiddenFileError('Permission denied.')
+                records.append((key, self.encode_record(key, content,
+                    compression, signing_key)))
+                result[path] = True
+            except Exception as e:
+                result.errors[path] = e
+
+        if records:
+            with self._lock:
+                self._append(records)
+                if (durability or storage_settings.PICKLE_STORAGE_DURABILITY) != 'none':
+                    self._sync(self._active_file)
+
+        if single:
+            return bool(result)
+        return result
+
+    def encode_record(self, key, content, compression=None, signing_key=None):
+        key_bytes = key.encode('utf-8')
+        with Phase('SegmentWrite', 'pickle'):
+            codec, value = compress(compression, pickle.dumps(content,
+                storage_settings.PICKLE_STORAGE_PICKLE_PROTOCOL),
+                storage_settings.PICKLE_STORAGE_COMPRESSION_THRESHOLD)
+        header = RECORD.pack(RECORD_MAGIC, 0, codec, len(key_bytes), len(value))
+        with Phase('SegmentWrite', 'hmac'):
+            digest = self.hmac_digest([header, key_bytes, value], signing_key)
+        return b''.join([header, digest, key_bytes, value])
+
+    def decode_record(self, record, load=True):
+        """ Verify a record, returning (key, value). The value is left
+        undecoded when load is False. """
+
+        if len(record) < RECORD.size + DIGEST_SIZE:
+            raise IntegrityError('Record is truncated.')
+        magic, flags, codec, key_length, value_length = \
+            RECORD.unpack_from(record)
+        if magic != RECORD_MAGIC:
+            raise IntegrityError('Unrecognised record header.')
+
+        with memoryview(record) as view:
+            key_start = RECORD.size + DIGEST_SIZE
+            value_start = key_start + key_length
+            if value_start + value_length != len(view):
+                raise IntegrityError('Record is truncated.')
+            with Phase('SegmentRead', 'hmac'):
+                if not self.is_safe(view[RECORD.size:key_start],
+                    [view[:RECORD.size], view[key_start:]]):
+                    raise IntegrityError('Digest did not match content.')
+            key = bytes(view[key_start:value_start]).decode('utf-8')
+            if not load:
+                return key, None
+            with Phase('SegmentRead', 'unpickle'):
+                return key, pickle.loads(decompress(codec,
+                    view[value_start:]))
+
+    def _append(self, records):
+        """ Append (key, encoded record) pairs to the active segment. Must be
+        called with the lock held. """
+
+        if self._active_file is None:
+            raise DBOperationError('Storage container is closed.')
+        if self._segment_sizes[self._active_segment] >= self.segment_max_bytes:
+            self._rotate_segment()
+
+        segment = self._active_segment
+        offset = self._segment_sizes[segment]
+        data = b''.join(record for key, record in records)
+        try:
+            with Phase('SegmentWrite', 'io'):
+                self._active_file.write(data)
+                self._active_file.flush()
+        except:
+            self._discard_tail(segment, offset)
+            raise
+        get_sink().increment(BYTES_WRITTEN, len(data))
+
+        for key, record in records:
+            previous = self._index.get(key)
+            if previous:
+                self._live_bytes[previous.segment] -= previous.length
+            self._index[key] = Location(segment, offset, len(record))
+            self._live_bytes[segment] += len(record)
+            offset += len(record)
+        self._segment_sizes[segment] = offset
+
+    def _close_files(self):
+        if self._active_file is not None:
+            self._active_file.close()
+            self._active_file = None
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
+
+    def _end_read(self, segment):
+        self._readers[segment] -= 1
+        if not self._readers[segment]:
+            del self._readers[segment]
+            fd = self._retired_fds.pop(segment, None)
+            if fd is not None:
+                os.close(fd)
+
+    def _discard_tail(self, segment, offset):
+        """ Cut a failed append off the active segment, so that the next
+        record is written where the index expects it. """
+
+        path = self._segment_path(segment)
+        try:
+            # Drops whatever is still buffered, closing the file regardless
+            self._active_file.close()
+        except OSError:
+            pass
+        self._active_file = None
+        os.truncate(path, offset)
+        self._active_file = open(path, 'ab')
+
+    def _load_index(self):
+        """ Rebuild the index from the hint file and the segments on disk. """
+
+        self._index.clear()
+        self._segment_sizes.clear()
+        self._live_bytes.clear()
+        on_disk = sorted(int(path.stem) for path in
+            self.working_dir_path.glob(f"*{SEGMENT_SUFFIX}"))
+
+        covered = {}
+        hint = self._read_hint()
+        if hint:
+            covered = {segment: size for segment, size
+                in hint['segments'].items() if segment in on_disk}
+            self._index.update({key: location for key, location
+                in hint['index'].items() if location.segment in covered})
+
+        for segment in on_disk:
+            self._segment_sizes[segment] = self._scan_segment(segment,
+                covered.get(segment, 0), is_last=segment == on_disk[-1])
+
+        for location in self._index.values():
+            self._live_bytes[location.segment] += location.length
+
+    def _open_active_segment(self):
+        if self._segment_sizes:
+            self._active_segment = max(self._segment_sizes)
+            self._active_file = open(
+                self._segment_path(self._active_segment), 'ab')
+        else:
+            self._rotate_segment()
+
+    def _read_hint(self):
+        try:
+            raw = self.hint_path.read_bytes()
+        except FileNotFoundError:
+            return None
+        digest, payload = raw[:DIGEST_SIZE], raw[DIGEST_SIZE:]
+        if not self.is_safe(digest, payload):
+            write_to_log('Ignoring segment hint file, digest did not match'
+                ' content.', level='warning')
+            return None
+        return pickle.loads(payload)
+
+    def _rotate_segment(self):
+        """ Seal the active segment and start a new, empty one. """
+
+        if self._active_file is not None:
+            self._sync(self._active_file)
+            self._active_file.close()
+        segment = max(self._segment_sizes, default=0) + 1
+        self._active_segment = segment
+        self._active_file = open(self._segment_path(segment), 'ab')
+        self._segment_sizes[segment] = 0
+        if storage_settings.PICKLE_STORAGE_DURABILITY == 'directory':
+            fsync_directories([self.working_dir_path])
+
+    def _scan_segment(self, segment, offset, is_last=False):
+        """ Index the records in segment from offset onwards. Returns where
+        the last intact record ends. A torn or corrupt tail is cut off the
+        last segment, where it is left by an interrupted append. """
+
+        path = self._segment_path(segment)
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                magic, flags, codec, key_length, value_length = \
+                    RECORD.unpack(header)
+                # Lengths are not verified yet, never read past the end
+                if (offset + RECORD.size + DIGEST_SIZE + key_length
+                    + value_length > size):
+                    break
+                record = header + f.read(DIGEST_SIZE + key_length + value_length)
+                try:
+                    key = self.decode_record(record, load=False)[0]
+                except IntegrityError:
+                    break
+                self._index[key] = Location(segment, offset, len(record))
+                offset += len(record)
+
+        if offset != path.stat().st_size:
+            write_to_log(f'Segment "{path}" has a corrupt tail after byte'
+                f' {offset}.', level='warning')
+            if is_last:
+                os.truncate(path, offset)
+        return offset
+
+    def _segment_fd(self, segment):
+        fd = self._fds.get(segment)
+        if fd is None:
+            fd = self._fds[segment] = os.open(self._segment_path(segment),
+                os.O_RDONLY)
+        return fd
+
+    def _segment_path(self, segment):
+        return self.working_dir_path.joinpath(f"{segment:08d}{SEGMENT_SUFFIX}")
+
+    def _sync(self, f):
+        f.flush()
+        os.fsync(f.fileno())
@@ -0,0 +1,450 @@
+""" Read-only snapshot images of a store.
+
+build_image() freezes every key of a store into one file, verifying each
+key's digest as it is copied:
+
+    header | seal | padding | entry | padding | entry | ... | index | names
+
+Entries are the stored files, copied unchanged, each starting on a
+BUFFER_ALIGNMENT boundary so out-of-band buffers stay aligned. The index
+holds one fixed-size record per key, sorted by name, pointing at its name
+and entry, so a key is found by binary search straight from the mapped
+file. The seal is a keyed digest of the header, index and names, and the
+header holds a sha256 of the entries.
+
+SnapshotStorageContainer memory-maps the image, checks its seal when it is
+opened and then serves reads from the mapping without any further hashing.
+Entries were verified by build_image(), so the sha256 of the entries is only
+checked when asked to. Every process reading the same image shares its pages
+through the page cache. Images are published by renaming them over the
+previous one, and readers pick up the new image on refresh(). """
+
+import bisect
+import collections.abc
+import hashlib
+import mmap
+import os
+import pathlib
+import pickle
+import struct
+import threading
+import time
+import uuid
+
+from pickle_storage.blobs import blob_path, verify_blob
+from pickle_storage.compression import decompress
+from pickle_storage.container import BaseStorageContainer
+from pickle_storage.errors import ForbiddenFileError, IntegrityError
+from pickle_storage.fileformat import (BUFFER_ALIGNMENT, DIGEST_ALGORITHMS,
+    DIGEST_SIZE, FLAG_REFERENCE, is_framed, unpack_frame)
+from pickle_storage.metrics import BYTES_READ, HMAC_FAILURES, Phase, get_sink
+from pickle_storage.mixins import HMACMixin, signing_key_filenames
+from pickle_storage.operations import BatchResult, CallableOperation
+from pickle_storage.utils import (db_relative_path, fsync_directories,
+    key_files, log_errors, write_to_log)
+from pickle_storage.config.tools import get_settings_config
+storage_settings = get_settings_config()
+
+__all__ = ['IMAGE_DIRECTORY', 'SnapshotImage', 'SnapshotStorageContainer',
+    'build_image', 'default_image_path']
+
+IMAGE_DIRECTORY = '_image'
+IMAGE_FILENAME = 'store.psi'
+IMAGE_MAGIC = b'\x89PSI'
+IMAGE_VERSION = 1
+
+# magic, version, digest algorithm id, entry count, index offset, names
+# offset, names length, sha256 of the entries
+IMAGE_HEADER = struct.Struct('<4sBB2xQQQQ32s')
+# name offset, entry offset, entry length, name length, entry kind
+INDEX_ENTRY = struct.Struct('<QQQHH4x')
+
+# How an entry is laid out: a framed file (or blob), or a headerless one
+KIND_FRAMED = 0
+KIND_HEADERLESS = 1
+
+def default_image_path(working_dir_path):
+    return pathlib.Path(working_dir_path, IMAGE_DIRECTORY, IMAGE_FILENAME)
+
+def build_image(working_dir_path, target=None, algorithm=None):
+    """ Write an image of every key in working_dir_path to target (by
+    default default_image_path()), replacing any previous image atomically.
+    Keys that fail verification are left out and logged. Returns the
+    image's path. """
+
+    working_dir_path = pathlib.Path(working_dir_path)
+    if target is None:
+        target = default_image_path(working_dir_path)
+    target = pathlib.Path(target)
+    algorithm = algorithm or storage_settings.PICKLE_STORAGE_DIGEST_ALGORITHM
+    signer = HMACMixin()
+    signer.hashing_algorithm = algorithm
+
+    key_filenames = signing_key_filenames()
+    paths = sorted((path.name.encode('utf-8'), path) for path in key_files(
+        working_dir_path, storage_settings.PICKLE_STORAGE_SUFFIX,
+        storage_settings.PICKLE_STORAGE_SHARD_DEPTH)
+        if path.name not in key_filenames)
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = target.with_name(f".{target.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(temp_path, 'wb') as f:
+            start = _aligned(IMAGE_HEADER.size + DIGEST_SIZE)
+            f.write(bytes(start))
+            position = start
+            data_digest = hashlib.sha256()
+            index = bytearray()
+            names = bytearray()
+            for name, path in paths:
+                try:
+                    kind, content = _verified_entry(signer, path,
+                        working_dir_path)
+                except FileNotFoundError:
+                    continue # Removed since it was listed
+                except IntegrityError as e:
+                    get_sink().increment(HMAC_FAILURES)
+                    write_to_log(f'Leaving "{path}" out of the image: {e}',
+                        level='warning')
+                    continue
+
+                padding = bytes(-position % BUFFER_ALIGNMENT)
+                for chunk in (padding, content):
+                    f.write(chunk)
+                    data_digest.update(chunk)
+                position += len(padding)
+                index += INDEX_ENTRY.pack(len(names), position, len(content),
+                    len(name), kind)
+                names += name
+                position += len(content)
+
+            header = IMAGE_HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION,
+                DIGEST_ALGORITHMS.index(algorithm),
+                len(index) // INDEX_ENTRY.size, position,
+                position + len(index), len(names), data_digest.digest())
+            f.write(index)
+            f.write(names)
+            f.seek(0)
+            f.write(header)
+            f.write(signer.hmac_digest([header, bytes(index), bytes(names)]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, 0o444) # Never modified once published
+        os.replace(temp_path, target)
+    except:
+        try:
+            os.unlink(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    fsync_directories([target.parent])
+    return target
+
+def _aligned(position):
+    return position + -position % BUFFER_ALIGNMENT
+
+def _verified_entry(signer, path, working_dir_path):
+    """ Kind and contents of the key file at path, with references replaced
+    by the blob they point at. Raises IntegrityError. """
+
+    content = path.read_bytes()
+    with memoryview(content) as view:
+        if is_framed(view):
+            try:
+                frame = unpack_frame(view)
+            except IntegrityError:
+                frame = None
+            if frame is not None and signer.is_safe(frame.digest, frame.signed,
+                frame.algorithm):
+                if not frame.flags & FLAG_REFERENCE:
+                    return KIND_FRAMED, content
+                digest = bytes(frame.payload)
+                try:
+                    blob = blob_path(digest, working_dir_path).read_bytes()
+                except FileNotFoundError:
+                    raise IntegrityError(f'Blob "{digest.hex()}" is missing.')
+                with memoryview(blob) as blob_view:
+                    verify_blob(blob_view, digest)
+                return KIND_FRAMED, blob
+
+        if len(view) > 33 and view[32] == 0 and signer.is_safe(view[:32],
+            view[33:], 'sha256'):
+            return KIND_HEADERLESS, content
+    raise IntegrityError('Digest did not match content.')
+
+class ImageNames(collections.abc.Sequence):
+    """ The sorted key names of an image, as bytes, read from its mapping on
+    demand. """
+
+    def __init__(self, image):
+        self.image = image
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.image.name(i)
+
+    def __len__(self):
+        return self.image.count
+
+class SnapshotImage():
+    """ An image written by build_image(), memory-mapped read-only.
+
+    The seal is checked when the image is opened, and with verify (default
+    PICKLE_STORAGE_SNAPSHOT_VERIFY) so is the sha256 of every entry, in one
+    pass over the file. Values are then decoded straight from the mapping;
+    out-of-band buffers are returned as views of it. Raises IntegrityError
+    for an image that fails either check. """
+
+    def __init__(self, path, verify=None):
+        if verify is None:
+            verify = storage_settings.PICKLE_STORAGE_SNAPSHOT_VERIFY
+        self.path = pathlib.Path(path)
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size < IMAGE_HEADER.size + DIGEST_SIZE:
+                raise IntegrityError('Image is truncated.')
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (stat.st_dev, stat.st_ino)
+        self._view = memoryview(self._mmap)
+
+        (magic, version, algorithm_id, self.count, self.index_offset,
+            self.names_offset, names_length, data_digest) = \
+            IMAGE_HEADER.unpack_from(self._mmap)
+        if (magic != IMAGE_MAGIC or version != IMAGE_VERSION
+            or algorithm_id >= len(DIGEST_ALGORITHMS)):
+            raise IntegrityError('Unrecognised image header.')
+        names_end = self.names_offset + names_length
+        if (names_end > len(self._mmap) or self.names_offset !=
+            self.index_offset + self.count * INDEX_ENTRY.size):
+            raise IntegrityError('Image is truncated.')
+
+        seal_end = IMAGE_HEADER.size + DIGEST_SIZE
+        signed = [self._view[:IMAGE_HEADER.size],
+            self._view[self.index_offset:names_end]]
+        if not HMACMixin().is_safe(self._view[IMAGE_HEADER.size:seal_end],
+            signed, DIGEST_ALGORITHMS[algorithm_id]):
+            raise IntegrityError('Image seal did not match its index.')
+        if verify:
+            data = self._view[_aligned(seal_end):self.index_offset]
+            if hashlib.sha256(data).digest() != data_digest:
+                raise IntegrityError('Image entries do not match their '
+                    'digest.')
+        self.names = ImageNames(self)
+
+    def __contains__(self, name):
+        return self.find(name) is not None
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, i):
+        """ (name offset, entry offset, entry length, name length, kind) of
+        the i-th key. """
+
+        return INDEX_ENTRY.unpack_from(self._mmap,
+            self.index_offset + i * INDEX_ENTRY.size)
+
+    def find(self, name):
+        """ Position of the key file name in the index, None if absent. """
+
+        key = name.encode('utf-8')
+        i = bisect.bisect_left(self.names, key)
+        if i < self.count and self.name(i) == key:
+            return i
+        return None
+
+    def get(self, name):
+        """ Value of the key file name. Raises KeyError if absent. """
+
+        i = self.find(name)
+        if i is None:
+            raise KeyError(name)
+        name_offset, offset, length, name_length, kind = self.entry(i)
+        get_sink().increment(BYTES_READ, length)
+        view = self._view[offset:offset + length]
+        with Phase('SnapshotRead', 'unpickle'):
+            if kind == KIND_HEADERLESS:
+                return pickle.loads(view[33:])
+            frame = unpack_frame(view)
+            return pickle.loads(decompress(frame.codec, frame.payload),
+                buffers=frame.buffers)
+
+    def name(self, i):
+        name_offset, offset, length, name_length, kind = self.entry(i)
+        start = self.names_offset + name_offset
+        return self._mmap[start:start + name_length]
+
+class SnapshotStorageContainer(BaseStorageContainer):
+    """ Serves reads from the store's latest image, built with
+    BaseStorageContainer.build_image(), and refuses writes.
+
+    The image is swapped for a newer one on refresh(), which reads also call
+    every refresh_interval seconds (PICKLE_STORAGE_SNAPSHOT_REFRESH_INTERVAL,
+    None to only refresh when asked). Reads already decoding from the old
+    image finish from it; it is unmapped once nothing uses it. With
+    verify_image (default PICKLE_STORAGE_SNAPSHOT_VERIFY), a new image found
+    by a read is verified on a background thread, and reads keep using the
+    current one until it passes. Open the container before forking workers
+    so they share the opened image. """
+
+    def __init__(self, *args, **kwargs):
+        self.image = None
+        self.refresh_interval = kwargs.get("refresh_interval",
+            storage_settings.PICKLE_STORAGE_SNAPSHOT_REFRESH_INTERVAL)
+        self.verify_image = kwargs.get("verify_image", None)
+        self._refreshed = 0
+        self._refresh_lock = threading.Lock()
+        self._verifying = False
+        super().__init__(*args, **kwargs)
+        self.image_path = pathlib.Path(kwargs.get("image_path",
+            default_image_path(self.working_dir_path)))
+        if not self.refresh():
+            write_to_log(f'No snapshot image at "{self.image_path}" yet.',
+                level='warning')
+
+    def cache_lookup(self, path):
+        # Reads are served from the image, decoded values are not cached
+        return False, None, None
+
+    def clear(self):
+        raise ForbiddenFileError('Snapshot containers are read-only.')
+
+    def contents(self, prefix='', start_after=None, limit=None):
+        image = self.current_image()
+        if image is None:
+            return []
+        i = bisect.bisect_left(image.names, prefix.encode('utf-8'))
+        if start_after is not None:
+            i = max(i, bisect.bisect_right(image.names,
+                db_relative_path(start_after).name.encode('utf-8')))
+        paths = []
+        for j in range(i, image.count):
+            name = image.name(j).decode('utf-8')
+            if not name.startswith(prefix) or (limit is not None
+                and len(paths) >= limit):
+                break
+            paths.append(db_relative_path(name))
+        return paths
+
+    def create_expiry(self):
+        # TTLs are applied when the image is built
+        return None
+
+    def create_locks(self):
+        # Images are never modified in place
+        return None
+
+    def create_manifest(self):
+        # The image index already lists every key
+        return None
+
+    def create_usage_tracker(self):
+        return None
+
+    def create_write_buffer(self):
+        return None
+
+    def current_image(self):
+        """ The image reads are served from, after refreshing it if
+        refresh_interval has passed. """
+
+        if (self.refresh_interval is not None and time.monotonic()
+            - self._refreshed >= self.refresh_interval):
+            self.refresh(wait=False)
+        return self.image
+
+    def delete(self, path):
+        raise ForbiddenFileError('Snapshot containers are read-only.')
+
+    def exists(self, file_name):
+        image = self.current_image()
+        return image is not None and db_relative_path(file_name).name in image
+
+    def read(self, path='', *args, **kwargs):
+        if not path:
+            return False
+        image = self.current_image()
+        if image is None:
+            return None
+        try:
+            return image.get(db_relative_path(path).name)
+        except KeyError:
+            return None
+
+    def read_many(self, keys, **kwargs):
+        result = BatchResult()
+        image = self.current_image()
+        for key in keys:
+            try:
+                if image is None:
+                    raise KeyError(key)
+                result[key] = image.get(db_relative_path(key).name)
+            except KeyError:
+                result.errors[key] = FileNotFoundError(key)
+            except Exception as e:
+                result.errors[key] = e
+        return result
+
+    def read_many_operation(self, keys, **kwargs):
+        return CallableOperation(self.read_many, keys)
+
+    def read_operation(self, path='', *args, **kwargs):
+        return CallableOperation(self.read, path)
+
+    def open_image(self):
+        """ Serve reads from the image at image_path, unless it fails
+        verification and there is a current image to keep. """
+
+        try:
+            image = SnapshotImage(self.image_path, self.verify_image)
+        except IntegrityError as e:
+            if self.image is None:
+                raise
+            write_to_log(f'Keeping the current snapshot image, '
+                f'"{self.image_path}" failed verification: {e}',
+                level='warning')
+        else:
+            self.image = image
+        finally:
+            self._verifying = False
+
+    def refresh(self, wait=True):
+        """ Switch to the image at image_path if it was replaced since the
+        current one was opened. Returns whether an image is open. Unless
+        wait, a new image that needs verifying is opened on a background
+        thread and the current one stays in use meanwhile. """
+
+        with self._refresh_lock:
+            self._refreshed = time.monotonic()
+            try:
+                stat = os.stat(self.image_path)
+            except FileNotFoundError:
+                return self.image is not None
+            if self._verifying or (self.image is not None
+                and self.image.identity == (stat.st_dev, stat.st_ino)):
+                return self.image is not None
+            verify = self.verify_image
+            if verify is None:
+                verify = storage_settings.PICKLE_STORAGE_SNAPSHOT_VERIFY
+            if wait or not verify or self.image is None:
+                self.open_image()
+            else:
+                self._verifying = True
+                threading.Thread(target=self._open_image_quietly,
+                    name='PickleStorageSnapshotVerify', daemon=True).start()
+            return True
+
+    def write(self, *args, **kwargs):
+        raise ForbiddenFileError('Snapshot containers are read-only.')
+
+    @log_errors
+    def _open_image_quietly(self):
+        self.open_image()
+
+    def write_many(self, *args, **kwargs):
+        raise ForbiddenFileError('Snapshot containers are read-only.')
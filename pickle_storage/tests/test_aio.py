@@ -0,0 +1,98 @@
+import unittest
+import asyncio
+import threading
+from unittest import mock
+
+from pickle_storage.aio import AsyncStorageContainer
+from pickle_storage.container import BaseStorageContainer
+from pickle_storage.executor import get_executor
+from pickle_storage.manifest import Manifest
+from pickle_storage.operations import CallableOperation
+from pickle_storage.segments import SegmentStorageContainer
+from pickle_storage.config import storage_settings
+
+__all__ = ['AsyncStorageTestCase']
+
+class AsyncStorageTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        BaseStorageContainer().clear()
+
+    def test_read_and_write(self):
+        storage = AsyncStorageContainer(concurrency=4)
+
+        async def run():
+            threads = threading.active_count()
+            written = await asyncio.gather(*(storage.awrite(f'async_{i}', i + 1)
+                for i in range(200)))
+            self.assertTrue(all(written))
+            values = await asyncio.gather(*(storage.aread(f'async_{i}')
+                for i in range(200)))
+            self.assertEqual(values, list(range(1, 201)))
+            self.assertLessEqual(threading.active_count(),
+                threads + get_executor().max_workers)
+
+            written = await storage.awrite_many({'a': 1, 'b': 2})
+            self.assertEqual(set(written), {'a', 'b'})
+            self.assertEqual(dict(await storage.aread_many(['a', 'b'])),
+                {'a': 1, 'b': 2})
+            self.assertIsNone(await storage.aread('async_missing'))
+            self.assertTrue(storage.exists('a'))
+
+        asyncio.run(run())
+
+    def test_lookup_without_cache(self):
+        container = BaseStorageContainer(read_cache=None, expiry=None)
+        storage = AsyncStorageContainer(container)
+        container.write('uncached', 1, wait=True)
+
+        async def run():
+            # Only the read itself goes through the executor
+            with mock.patch.object(storage, '_run',
+                wraps=storage._run) as scheduled:
+                self.assertEqual(await storage.aread('uncached'), 1)
+            self.assertEqual(scheduled.call_count, 1)
+
+        asyncio.run(run())
+
+    def test_segment_container(self):
+        segments = SegmentStorageContainer(compaction_interval=None)
+        storage = AsyncStorageContainer(segments)
+
+        async def run():
+            self.assertTrue(await storage.awrite('segment_async', [1, 2]))
+            self.assertEqual(await storage.aread('segment_async'), [1, 2])
+            self.assertEqual(dict(await storage.aread_many(['segment_async'])),
+                {'segment_async': [1, 2]})
+
+        try:
+            asyncio.run(run())
+        finally:
+            segments.clear()
+            segments.close()
+
+    def test_cancellation(self):
+        container = BaseStorageContainer(manifest=Manifest(
+            storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY))
+        storage = AsyncStorageContainer(container)
+        release = threading.Event()
+
+        async def run():
+            # Occupy every worker so the write stays queued
+            blockers = [CallableOperation(release.wait)
+                for i in range(get_executor().max_workers)]
+            task = asyncio.create_task(storage.awrite('cancelled', 1))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            release.set()
+            for op in blockers:
+                op.join()
+
+        try:
+            asyncio.run(run())
+        finally:
+            release.set()
+        self.assertFalse(container.exists('cancelled'))
+        self.assertEqual(container.manifest._pending, 0)
@@ -0,0 +1,27 @@
+import unittest
+
+from pickle_storage.benchmarks import compare, run_benchmarks
+from pickle_storage.config import storage_settings
+
+__all__ = ['BenchmarkTestCase']
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def test_run_and_compare(self):
+        working_dir = storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY
+        results = run_benchmarks(['write_small_async', 'read_small',
+            'contents'], iterations=5, keys=10)
+        self.assertEqual(storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY,
+            working_dir)
+
+        read = results['scenarios']['read_small']
+        self.assertEqual(read['ops'], 5)
+        self.assertLessEqual(read['p50_ms'], read['p99_ms'])
+        self.assertGreater(read['peak_memory_bytes'], 0)
+
+        baseline = {'scenarios': {'read_small': dict(read,
+            ops_per_sec=read['ops_per_sec'] * 2)}}
+        changes = compare(results, baseline, tolerance=0.2)
+        self.assertEqual(list(changes), ['read_small'])
+        self.assertTrue(changes['read_small']['regression'])
+        self.assertFalse(compare(results, results)['read_small']['regression'])
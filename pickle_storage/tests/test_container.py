@@ -1,10 +1,30 @@
+import gc
 import unittest
 import os
 import time
 import pathlib
+import pickle
+import shutil
+import subprocess
+import sys
+import weakref
+from unittest import mock
+import zipfile
 
-from pickle_storage.errors import ConfigError, ForbiddenFileError
+from pickle_storage.errors import (ConfigError, DBOperationError,
+    ForbiddenFileError)
 from pickle_storage.config import ConfigObject
+from pickle_storage.cache import ReadCache
+from pickle_storage.container import BaseStorageContainer
+from pickle_storage.compression import CODEC_RAW
+from pickle_storage.fileformat import HEADER, has_out_of_band, unpack_frame
+from pickle_storage.archive import load_snapshot_manifest
+from pickle_storage.blobs import BLOB_DIRECTORY, read_reference, blob_path
+from pickle_storage.eviction import ExpiryIndex, UsageTracker
+from pickle_storage.manifest import Manifest
+from pickle_storage.operations import Write
+from pickle_storage.mixins import HMACMixin, retired_key_ids
+from pickle_storage.writebehind import WriteBehindBuffer
 
 from pickle_storage.utils import write_to_log, db_relative_path
 from pickle_storage.config import storage_settings
@@ -48,3 +68,527 @@ class StorageContainerTestCase(unittest.TestCase):
         self.assertTrue(test_storage.clear())
         self.assertEqual(list(test_storage.contents()), [])
 
+
+    def test_signing_key_rotation(self):
+        test_storage = storage_settings.active_storage
+        test_data = {'Rotated': True}
+        self.assertTrue(test_storage.write('rotation_test', test_data, wait=True))
+
+        retired_name = test_storage.rotate_signing_key()
+        self.assertEqual(test_storage.read('rotation_test'), test_data)
+        self.assertNotIn(retired_name,
+            [p.stem for p in test_storage.contents()])
+        second_name = test_storage.rotate_signing_key()
+        self.assertEqual(retired_key_ids()[-2:], [second_name, retired_name])
+
+        # Other processes know about the retired keys too
+        script = ('from pickle_storage.container import BaseStorageContainer\n'
+            'print(BaseStorageContainer().read("rotation_test"))\n')
+        output = subprocess.run([sys.executable, '-c', script], check=True,
+            capture_output=True, text=True, env=dict(os.environ,
+                PICKLE_STORAGE_SETTINGS='pickle_storage.tests.settings'))
+        self.assertEqual(output.stdout.strip(), repr(test_data))
+
+        # Without the retired key, old data no longer verifies
+        db_relative_path(retired_name).unlink()
+        self.assertIsNone(test_storage.read('rotation_test'))
+
+    def test_batch_read_and_write(self):
+        test_storage = storage_settings.active_storage
+        test_data = {f'batch_{i}': {'Index': i} for i in range(20)}
+        test_data['batch_empty'] = None
+
+        written = test_storage.write_many(test_data, wait=True, fsync=True)
+        self.assertEqual(len(written), 20)
+        self.assertIn('batch_empty', written.errors)
+
+        read = test_storage.read_many(list(test_data) + ['batch_missing'])
+        self.assertEqual(read['batch_3'], {'Index': 3})
+        self.assertEqual(len(read), 20)
+        self.assertIsInstance(read.errors['batch_missing'], FileNotFoundError)
+        self.assertIsInstance(read.errors['batch_empty'], FileNotFoundError)
+
+    def test_read_cache(self):
+        test_storage = BaseStorageContainer(read_cache=ReadCache(max_entries=2))
+        cache = test_storage.read_cache
+        test_storage.write('cache_test', {'Version': 1}, wait=True)
+
+        self.assertEqual(test_storage.read('cache_test'), {'Version': 1})
+        self.assertEqual(test_storage.read('cache_test'), {'Version': 1})
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        # Writes through the container invalidate the cached value
+        test_storage.write('cache_test', {'Version': 2}, wait=True)
+        self.assertEqual(test_storage.read('cache_test'), {'Version': 2})
+
+        for key in ['cache_a', 'cache_b']:
+            test_storage.write(key, key, wait=True)
+            test_storage.read(key)
+        self.assertEqual(len(cache), 2)
+        self.assertGreater(cache.stats()['evictions'], 0)
+
+    def test_mapped_read(self):
+        test_storage = storage_settings.active_storage
+        test_data = {'Payload': os.urandom(3 * 1024 * 1024)}
+        test_storage.write('mapped_test', test_data, wait=True)
+        self.assertEqual(test_storage.read('mapped_test', mmap=True), test_data)
+        self.assertEqual(test_storage.read('mapped_test', mmap=False), test_data)
+
+        # Corrupt the payload in place
+        path = db_relative_path('mapped_test')
+        with open(path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'\x00')
+        self.assertIsNone(test_storage.read('mapped_test', mmap=True))
+
+    def test_out_of_band_buffers(self):
+        test_storage = storage_settings.active_storage
+        large_buffer = os.urandom(256 * 1024)
+        test_data = {'Small': bytearray(b'inline'),
+            'Large': bytearray(large_buffer),
+            'Raw': pickle.PickleBuffer(large_buffer)}
+        self.assertTrue(test_storage.write('oob_test', test_data, wait=True,
+            out_of_band=True))
+
+        with open(db_relative_path('oob_test'), 'rb') as f:
+            header = f.read(HEADER.size)
+        self.assertTrue(has_out_of_band(header))
+
+        read_data = test_storage.read('oob_test')
+        self.assertEqual(read_data['Small'], test_data['Small'])
+        self.assertEqual(read_data['Large'], test_data['Large'])
+        self.assertEqual(bytes(read_data['Raw']), large_buffer)
+        self.assertTrue(read_data['Raw'].readonly) # A view of the mapped file
+
+        # Corrupting a buffer is caught by the digest
+        path = db_relative_path('oob_test')
+        with open(path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            last_byte = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last_byte[0] ^ 0xFF]))
+        self.assertIsNone(test_storage.read('oob_test'))
+
+    def test_compression(self):
+        test_storage = BaseStorageContainer(compression='zlib')
+        test_data = {'Repeated': ['Highly compressible'] * 1000}
+        test_storage.write('compression_default', test_data, wait=True)
+        for codec in ['bz2', 'lzma']:
+            test_storage.write(f'compression_{codec}', test_data, wait=True,
+                compression=codec)
+
+        raw_size = len(pickle.dumps(test_data))
+        for codec in ['default', 'bz2', 'lzma']:
+            path = db_relative_path(f'compression_{codec}')
+            self.assertLess(path.stat().st_size, raw_size)
+            self.assertEqual(test_storage.read(f'compression_{codec}'), test_data)
+
+        # Small payloads are stored raw
+        test_storage.write('compression_small', 'tiny', wait=True)
+        with open(db_relative_path('compression_small'), 'rb') as f:
+            self.assertEqual(HEADER.unpack(f.read(HEADER.size))[4], CODEC_RAW)
+
+        # Explicit falsy options are not replaced by the defaults
+        test_storage.write('compression_off', test_data, wait=True,
+            compression=False, protocol=0)
+        with open(db_relative_path('compression_off'), 'rb') as f:
+            header = HEADER.unpack(f.read(HEADER.size))
+        self.assertEqual(header[3:5], (0, CODEC_RAW))
+        self.assertEqual(test_storage.read('compression_off'), test_data)
+
+    def test_headerless_read(self):
+        test_storage = storage_settings.active_storage
+        test_data = {'Legacy': True}
+        payload = pickle.dumps(test_data)
+        digest = HMACMixin().hmac_digest(payload)
+        db_relative_path('headerless_test').write_bytes(
+            digest + bytearray(1) + payload)
+        self.assertEqual(test_storage.read('headerless_test'), test_data)
+
+    def test_manifest(self):
+        test_storage = BaseStorageContainer(
+            manifest=Manifest(storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY))
+        test_storage.clear()
+        test_storage.write_many({f'user_{i:03d}': i for i in range(1, 11)},
+            wait=True)
+        test_storage.write('other', True, wait=True)
+
+        self.assertTrue(test_storage.exists('user_005'))
+        self.assertFalse(test_storage.exists('user_011'))
+        self.assertEqual(len(test_storage.contents(prefix='user_')), 10)
+        page = test_storage.contents(prefix='user_', start_after='user_004',
+            limit=3)
+        self.assertEqual([p.stem for p in page],
+            ['user_005', 'user_006', 'user_007'])
+        entry = test_storage.manifest.get('other.psf')
+        self.assertEqual(entry.size, db_relative_path('other').stat().st_size)
+
+        # A saved manifest is reused while the directory is unchanged, and
+        # rebuilt from disk once it has changed.
+        test_storage.manifest.save()
+        reloaded = Manifest(storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY)
+        self.assertTrue(reloaded.load())
+        self.assertEqual(len(reloaded), 11)
+        # Saving an unchanged manifest does not rewrite it
+        saved_at = reloaded.path.stat().st_mtime_ns
+        reloaded.save()
+        self.assertEqual(reloaded.path.stat().st_mtime_ns, saved_at)
+        storage_settings.active_storage.write('unlisted', True, wait=True)
+        stale = Manifest(storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY)
+        self.assertFalse(stale.load())
+        self.assertIn('unlisted.psf', stale)
+
+    def test_given_components(self):
+        manifest = Manifest(storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY)
+        # Defaults are not built for components that are passed in
+        with mock.patch.object(BaseStorageContainer, 'create_manifest') as \
+            create_manifest, mock.patch.object(BaseStorageContainer,
+            'create_write_buffer') as create_write_buffer:
+            test_storage = BaseStorageContainer(manifest=manifest,
+                write_buffer=None)
+        create_manifest.assert_not_called()
+        create_write_buffer.assert_not_called()
+        self.assertIs(test_storage.manifest, manifest)
+
+        # Nothing registered for exit keeps them alive
+        buffer_ref = weakref.ref(WriteBehindBuffer(test_storage))
+        manifest_ref = weakref.ref(manifest)
+        del manifest, test_storage
+        gc.collect()
+        self.assertIsNone(manifest_ref())
+        self.assertIsNone(buffer_ref())
+
+    def test_incremental_archive(self):
+        test_storage = BaseStorageContainer()
+        test_storage.clear()
+        test_storage.write_many({'first': 1, 'second': 2}, wait=True)
+        base = test_storage.archive(incremental=True)
+
+        test_storage.write('second', 'changed', wait=True)
+        test_storage.write('third', 3, wait=True)
+        increment = test_storage.archive(incremental=True,
+            compression_format='xztar')
+        # Unchanged files are not stored again
+        blobs = [p for p in increment.iterdir() if p.name != 'snapshot.json']
+        self.assertEqual(len(blobs), 2)
+
+        test_storage.write('fourth', 4, wait=True)
+        self.assertEqual(test_storage.restore(increment), 4) # Includes the key
+        self.assertEqual(test_storage.read('first'), 1)
+        self.assertEqual(test_storage.read('second'), 'changed')
+        self.assertFalse(test_storage.exists('fourth'))
+
+        test_storage.restore(base)
+        self.assertEqual(test_storage.read('second'), 2)
+        self.assertFalse(test_storage.exists('third'))
+
+        # A changed file matching a blob held by an earlier snapshot
+        # refers to it instead of storing it again
+        test_storage.write('third', 1, wait=True)
+        reused = test_storage.archive(incremental=True)
+        entry = load_snapshot_manifest(reused)['files']['third.psf']
+        self.assertEqual(entry['snapshot'], base.name)
+        self.assertFalse(reused.joinpath(entry['blob']).exists())
+        test_storage.write('third', 'removed', wait=True)
+        test_storage.restore()
+        self.assertEqual(test_storage.read('third'), 1)
+
+        full_archive = test_storage.archive(compression_format='zip')
+        with zipfile.ZipFile(f"{full_archive}.zip") as archive:
+            self.assertNotIn('_archive', ''.join(archive.namelist()))
+
+    def test_restore_without_snapshot(self):
+        test_storage = BaseStorageContainer()
+        test_storage.clear()
+        test_storage.write('kept', True, wait=True)
+        with self.assertRaises(DBOperationError):
+            test_storage.restore()
+        self.assertTrue(test_storage.read('kept'))
+
+    def test_dedup(self):
+        test_storage = BaseStorageContainer()
+        test_storage.clear()
+        config = {'retries': 3, 'hosts': ['a', 'b'] * 100}
+        result = test_storage.write_many({'config_1': config,
+            'config_2': config}, dedup=True, wait=True)
+        self.assertEqual(len(result), 2)
+        self.assertTrue(test_storage.write('config_3', config, dedup=True,
+            wait=True))
+        self.assertTrue(test_storage.write('other', 'other', dedup=True,
+            wait=True))
+
+        blobs = test_storage.working_dir_path.joinpath(BLOB_DIRECTORY)
+        self.assertEqual(len(list(blobs.glob('*/*'))), 2)
+        digest = read_reference(db_relative_path('config_1'))
+        self.assertEqual(read_reference(db_relative_path('config_3')), digest)
+        self.assertLess(db_relative_path('config_1').stat().st_size, 128)
+        for key in ['config_1', 'config_2', 'config_3']:
+            self.assertEqual(test_storage.read(key), config)
+        self.assertEqual(test_storage.read_many(['other'])['other'], 'other')
+
+        # Referenced and recently written blobs survive garbage collection
+        test_storage.write('other', 'replaced', wait=True)
+        self.assertEqual(test_storage.collect_garbage(), 0)
+        self.assertEqual(test_storage.collect_garbage(grace=0), 1)
+        self.assertEqual(test_storage.read('config_2'), config)
+
+        archive = test_storage.archive(compression_format='zip')
+        with zipfile.ZipFile(f"{archive}.zip") as f:
+            self.assertIn(blob_path(digest, '').as_posix(), f.namelist())
+        snapshot = test_storage.archive(incremental=True)
+        test_storage.write('config_1', 'changed', wait=True)
+        blob_path(digest).unlink()
+        self.assertIsNone(test_storage.read('config_2'))
+        test_storage.restore(snapshot)
+        self.assertEqual(test_storage.read('config_1'), config)
+
+        test_storage.clear()
+        self.assertFalse(blobs.exists())
+
+    def test_sharded_layout(self):
+        test_storage = BaseStorageContainer(
+            manifest=Manifest(storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY))
+        test_storage.clear()
+        test_storage.write_many({'flat_1': 1, 'flat_2': 2}, wait=True)
+        working_dir = test_storage.working_dir_path
+
+        storage_settings.update_setting('PICKLE_STORAGE_SHARD_DEPTH', 2)
+        storage_settings.update_setting('PICKLE_STORAGE_SHARD_FANOUT', 16)
+        try:
+            self.assertEqual(test_storage.migrate_layout(), 2)
+            path = db_relative_path('flat_1')
+            self.assertEqual(len(path.relative_to(working_dir).parts), 3)
+            self.assertTrue(path.exists())
+            self.assertEqual(db_relative_path(path), path)
+            self.assertTrue(test_storage.signing_key_path.exists())
+            self.assertEqual(test_storage.read('flat_1'), 1)
+
+            test_storage.write('sharded', 3, wait=True)
+            self.assertTrue(test_storage.exists('sharded'))
+            self.assertEqual([p.stem for p in test_storage.contents()],
+                ['flat_1', 'flat_2', 'sharded'])
+            test_storage.manifest.rebuild()
+            self.assertEqual(len(test_storage.manifest), 3)
+            archive = test_storage.archive(incremental=True)
+            self.assertIn(path.relative_to(working_dir).as_posix(),
+                load_snapshot_manifest(archive)['files'])
+        finally:
+            storage_settings.update_setting('PICKLE_STORAGE_SHARD_DEPTH', 0)
+            storage_settings.update_setting('PICKLE_STORAGE_SHARD_FANOUT', 256)
+
+        # Hex-looking directories that are not shards are left alone
+        suffix = storage_settings.PICKLE_STORAGE_SUFFIX
+        for name in ['2023', 'cafe', 'beef']:
+            working_dir.joinpath(name, 'c0de').mkdir(parents=True)
+            working_dir.joinpath(name, 'c0de', f'other{suffix}').write_bytes(
+                b'')
+        self.assertEqual(test_storage.migrate_layout(from_depth=2,
+            from_fanout=16), 3)
+        self.assertEqual(test_storage.read('sharded'), 3)
+        for name in ['2023', 'cafe', 'beef']:
+            self.assertTrue(working_dir.joinpath(name, 'c0de',
+                f'other{suffix}').exists())
+            shutil.rmtree(working_dir.joinpath(name))
+        self.assertEqual(sorted(p.name for p in working_dir.iterdir()
+            if p.is_dir() and p.name != '_meta'), ['_archive'])
+
+    def test_ttl_and_eviction(self):
+        test_storage = BaseStorageContainer()
+        test_storage.clear()
+        self.assertTrue(test_storage.write('session', 'token', ttl=0.2,
+            wait=True))
+        # Only sweep when asked to
+        test_storage.sweeper.close()
+        test_storage.write_many({'short_1': 1, 'short_2': 2}, ttl=0.2,
+            wait=True)
+        self.assertTrue(test_storage.write('kept', 'value', ttl=60,
+            wait=True))
+        test_storage.write('renewed', 1, ttl=0.2, wait=True)
+        test_storage.write('renewed', 2, wait=True)
+        self.assertEqual(test_storage.read('session'), 'token')
+
+        # Expired keys read as missing before they are swept
+        time.sleep(0.3)
+        self.assertTrue(db_relative_path('session').exists())
+        self.assertIsNone(test_storage.read('session'))
+        self.assertFalse(test_storage.exists('short_1'))
+        result = test_storage.read_many(['short_1', 'kept'])
+        self.assertEqual(dict(result), {'kept': 'value'})
+        self.assertIsInstance(result.errors['short_1'], FileNotFoundError)
+        self.assertEqual(sorted(p.stem for p in test_storage.contents()),
+            ['kept', 'renewed'])
+        other = BaseStorageContainer()
+        other.sweeper.close()
+        self.assertIsNone(other.read('short_2'))
+
+        # Replaced without its TTL being recorded, as restore() does
+        test_storage.write('replaced', 1, ttl=0.1, wait=True)
+        time.sleep(0.2)
+        self.assertTrue(Write('replaced', 2).join())
+        self.assertIsNone(test_storage.read('replaced'))
+
+        self.assertEqual(test_storage.sweep(), 3)
+        self.assertEqual(test_storage.read('replaced'), 2)
+        self.assertFalse(db_relative_path('session').exists())
+        self.assertEqual(test_storage.read('renewed'), 2)
+        self.assertEqual(test_storage.expiry.due(now=time.time() + 120),
+            [db_relative_path('kept').name])
+        self.assertTrue(test_storage.delete('kept'))
+        self.assertFalse(test_storage.delete('kept'))
+        self.assertEqual(len(test_storage.expiry), 0)
+
+        # Records appended after a rewrite of the log land in the new log
+        test_storage.write('compacted', 1, ttl=60, wait=True)
+        other_index = ExpiryIndex(test_storage.working_dir_path)
+        self.assertTrue(other_index.expires_at(
+            db_relative_path('compacted').name))
+        self.assertTrue(test_storage.expiry.compact(force=True))
+        other_index.set_many({db_relative_path('compacted').name: None})
+        self.assertIsNone(ExpiryIndex(test_storage.working_dir_path)
+            .expires_at(db_relative_path('compacted').name))
+        with self.assertRaises(ForbiddenFileError):
+            test_storage.delete(
+                storage_settings.PICKLE_STORAGE_SIGNING_KEY_FILENAME)
+
+        for policy, evicted in [('lru', 'b'), ('lfu', 'a')]:
+            test_storage = BaseStorageContainer(usage=UsageTracker(policy,
+                max_entries=3))
+            test_storage.sweeper.close()
+            test_storage.clear()
+            test_storage.write_many({'a': 1, 'b': 2, 'c': 3, 'd': 4},
+                wait=True)
+            for key in ['b', 'b', 'd', 'a', 'c', 'd']:
+                test_storage.read(key)
+            self.assertTrue(test_storage.usage.over_budget())
+            self.assertEqual(test_storage.sweep(), 1)
+            self.assertEqual(sorted(p.stem for p in test_storage.contents()),
+                sorted({'a', 'b', 'c', 'd'} - {evicted}))
+            self.assertFalse(test_storage.usage.over_budget())
+
+        # Keys written by other processes count towards the budget
+        test_storage = BaseStorageContainer(usage=UsageTracker(max_entries=2,
+            reload_interval=0))
+        test_storage.clear()
+        test_storage.write_many({'x': 1, 'y': 2}, wait=True)
+        self.assertEqual(test_storage.sweep(), 0)
+        BaseStorageContainer().write('z', 3, wait=True)
+        self.assertEqual(test_storage.sweep(), 1)
+        self.assertEqual(len(test_storage.contents()), 2)
+
+        # The background sweeper does not keep its container alive
+        container_ref = weakref.ref(test_storage)
+        del test_storage
+        gc.collect()
+        self.assertIsNone(container_ref())
+
+    def test_verify(self):
+        test_storage = BaseStorageContainer()
+        test_storage.clear()
+        test_storage.write_many({f'key_{i}': i + 1 for i in range(10)},
+            wait=True)
+        self.assertTrue(test_storage.write('fast', 'fast',
+            digest_algorithm='blake2b', wait=True))
+        with open(db_relative_path('fast'), 'rb') as f:
+            self.assertEqual(unpack_frame(f.read()).algorithm, 'blake2b')
+        self.assertEqual(test_storage.read('fast'), 'fast')
+        with self.assertRaises(ConfigError):
+            test_storage.write('slow', 1, digest_algorithm='md4', wait=True)
+        self.assertTrue(test_storage.write('shared', [1, 2], dedup=True,
+            wait=True))
+        self.assertTrue(test_storage.write('large', list(range(100)),
+            wait=True))
+
+        report = test_storage.verify(workers=2)
+        self.assertTrue(report.ok)
+        self.assertEqual(report.checked, 14)
+
+        test_storage.write('unsigned', 'bare', secure=False, wait=True)
+        corrupt = db_relative_path('key_1')
+        content = bytearray(corrupt.read_bytes())
+        content[-1] ^= 0xFF
+        corrupt.write_bytes(content)
+        truncated = db_relative_path('large')
+        truncated.write_bytes(truncated.read_bytes()[:HEADER.size + 40])
+        blob = next(test_storage.working_dir_path.joinpath(
+            BLOB_DIRECTORY).glob('*/*'))
+        blob.unlink()
+        stray = blob.parent.joinpath('notes.txt')
+        stray.write_text('Not a blob')
+
+        report = test_storage.verify(workers=1)
+        self.assertFalse(report.ok)
+        self.assertEqual(report.checked, 15)
+        self.assertEqual(sorted(report.corrupt), sorted([corrupt, stray]))
+        self.assertEqual(report.truncated, [truncated])
+        self.assertEqual(report.unsigned, [db_relative_path('unsigned')])
+        self.assertEqual(report.missing, [db_relative_path('shared')])
+
+    def test_write_behind_at_exit(self):
+        test_storage = BaseStorageContainer()
+        test_storage.clear()
+        script = ('from pickle_storage.container import BaseStorageContainer\n'
+            'from pickle_storage.writebehind import WriteBehindBuffer\n'
+            'storage = BaseStorageContainer()\n'
+            'storage.write_buffer = WriteBehindBuffer(storage)\n'
+            'storage.write("at_exit", {"pending": True})\n')
+        subprocess.run([sys.executable, '-c', script], check=True,
+            env=dict(os.environ, PICKLE_STORAGE_SETTINGS=
+                'pickle_storage.tests.settings'))
+        self.assertEqual(test_storage.read('at_exit'), {'pending': True})
+
+    def test_write_behind(self):
+        test_storage = BaseStorageContainer()
+        test_storage.clear()
+        test_storage.write_buffer = WriteBehindBuffer(test_storage,
+            max_pending=3)
+        unbuffered = BaseStorageContainer()
+
+        for count in range(1, 11):
+            self.assertTrue(test_storage.write('counter', count).join())
+        self.assertFalse(db_relative_path('counter').exists())
+        self.assertEqual(test_storage.read('counter'), 10)
+        self.assertEqual(dict(test_storage.read_many(['counter'])),
+            {'counter': 10})
+        self.assertTrue(test_storage.exists('counter'))
+        self.assertEqual([p.stem for p in test_storage.contents()],
+            ['counter'])
+
+        self.assertEqual(test_storage.flush(), 1)
+        self.assertEqual(unbuffered.read('counter'), 10)
+
+        # Waited-for writes go straight to disk, and a full buffer flushes
+        self.assertTrue(test_storage.write('direct', True, wait=True))
+        self.assertTrue(unbuffered.exists('direct'))
+        test_storage.write('a', 1)
+        test_storage.write('b', 2)
+        self.assertEqual(len(test_storage.write_buffer), 2)
+        test_storage.write('c', 3)
+        for attempt in range(100):
+            if unbuffered.exists('c'):
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(test_storage.write_buffer), 0)
+        self.assertEqual(unbuffered.read('c'), 3)
+
+        # Values that fail to be written stay buffered
+        write_many = test_storage.write_many
+        test_storage.write_many = lambda *args, **kwargs: False
+        test_storage.write('failed', 1)
+        self.assertEqual(test_storage.flush(), 0)
+        self.assertEqual(test_storage.read('failed'), 1)
+        test_storage.write_many = write_many
+        self.assertEqual(test_storage.flush(), 1)
+        self.assertEqual(unbuffered.read('failed'), 1)
+
+        interval_storage = BaseStorageContainer()
+        interval_storage.write_buffer = WriteBehindBuffer(interval_storage,
+            interval=0.01)
+        try:
+            interval_storage.write('interval', 1)
+            for attempt in range(100):
+                if unbuffered.exists('interval'):
+                    break
+                time.sleep(0.01)
+            self.assertEqual(unbuffered.read('interval'), 1)
+        finally:
+            interval_storage.write_buffer.close()
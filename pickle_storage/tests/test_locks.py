@@ -0,0 +1,82 @@
+import unittest
+import multiprocessing
+import pathlib
+import tarfile
+
+from pickle_storage.container import BaseStorageContainer
+from pickle_storage.errors import LockTimeout
+from pickle_storage.locks import LOCK_DIRECTORY, LockManager
+from pickle_storage.metrics import (LOCK_CONTENDED, LOCK_TIMEOUTS, MemorySink,
+    set_sink)
+from pickle_storage.config import storage_settings
+
+__all__ = ['LockTestCase']
+
+def hold_store_lock(working_dir, locked, release):
+    with LockManager(working_dir).store(exclusive=True):
+        locked.set()
+        release.wait(10)
+
+class LockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = pathlib.Path(
+            storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY)
+        self.locks = LockManager(self.working_dir, stripes=16, timeout=0.05)
+        self.sink = MemorySink()
+        self.previous_sink = set_sink(self.sink)
+
+    def tearDown(self):
+        set_sink(self.previous_sink)
+
+    def test_shared_and_exclusive(self):
+        with self.locks.keys(['key']):
+            with self.locks.keys(['key']):
+                pass # Readers share
+            with self.assertRaises(LockTimeout):
+                with self.locks.keys(['key'], exclusive=True):
+                    pass
+            with self.assertRaises(LockTimeout):
+                with self.locks.store(exclusive=True):
+                    pass
+        with self.locks.keys(['key', 'other'], exclusive=True):
+            pass
+
+        mode = (('mode', 'exclusive'),)
+        self.assertEqual(self.sink.value(LOCK_TIMEOUTS, mode), 2)
+        self.assertEqual(self.sink.value(LOCK_CONTENDED, mode), 2)
+
+    def test_across_processes(self):
+        context = multiprocessing.get_context('fork')
+        locked, release = context.Event(), context.Event()
+        process = context.Process(target=hold_store_lock,
+            args=(self.working_dir, locked, release))
+        process.start()
+        try:
+            self.assertTrue(locked.wait(10))
+            with self.assertRaises(LockTimeout):
+                with self.locks.keys(['key'], exclusive=True):
+                    pass
+        finally:
+            release.set()
+            process.join()
+        with self.locks.keys(['key'], exclusive=True):
+            pass
+
+    def test_locked_container(self):
+        test_storage = BaseStorageContainer(locks=self.locks)
+        test_storage.clear()
+        self.assertTrue(test_storage.write('locked', 1, wait=True))
+        self.assertEqual(set(test_storage.write_many({'a': 2, 'b': 3},
+            wait=True)), {'a', 'b'})
+        self.assertEqual(test_storage.read('locked'), 1)
+        self.assertEqual(dict(test_storage.read_many(['a', 'b'])),
+            {'a': 2, 'b': 3})
+
+        archive = test_storage.archive(compression_format='gztar')
+        with tarfile.open(f'{archive}.tar.gz') as f:
+            self.assertFalse(any(name.startswith(LOCK_DIRECTORY)
+                for name in f.getnames()))
+        test_storage.clear()
+        self.assertTrue(self.working_dir.joinpath(LOCK_DIRECTORY).exists())
+        self.assertEqual(test_storage.contents(), [])
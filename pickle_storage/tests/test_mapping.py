@@ -0,0 +1,89 @@
+import unittest
+
+from pickle_storage.container import BaseStorageContainer
+from pickle_storage.errors import (ConfigError, DBOperationError,
+    IntegrityError)
+from pickle_storage.mapping import PersistentDict
+from pickle_storage.utils import db_relative_path
+
+__all__ = ['PersistentDictTestCase']
+
+class PersistentDictTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = BaseStorageContainer()
+        self.storage.clear()
+
+    def test_fields(self):
+        state = PersistentDict('state', self.storage, buckets=8)
+        state.update({f'field_{i}': i for i in range(100)})
+        state['field_5'] = 'changed'
+        del state['field_6']
+
+        reopened = PersistentDict('state', self.storage)
+        self.assertEqual(reopened.buckets, 8)
+        self.assertEqual(reopened['field_5'], 'changed')
+        # Only the bucket holding the field was loaded
+        self.assertEqual(list(reopened._loaded),
+            [reopened.bucket_for('field_5')])
+        self.assertNotIn('field_6', reopened)
+        self.assertEqual(len(reopened), 99)
+        self.assertEqual(sorted(reopened)[:2], ['field_0', 'field_1'])
+
+        with self.assertRaises(ConfigError):
+            PersistentDict('state', self.storage, buckets=16)
+        # The expected size only sizes new collections
+        self.assertEqual(PersistentDict('state', self.storage,
+            expected_size=10 ** 6).buckets, 8)
+        self.assertEqual(PersistentDict('sized', self.storage,
+            expected_size=10 ** 6).buckets, 977)
+        self.assertEqual(PersistentDict('small', self.storage,
+            expected_size=0).buckets, 1)
+
+        reopened.clear()
+        self.assertEqual(len(PersistentDict('state', self.storage)), 0)
+
+    def test_deferred_flush(self):
+        with PersistentDict('deferred', self.storage, buckets=4,
+            autoflush=False) as state:
+            state['a'] = 1
+            state['b'] = 2
+            bucket = state.bucket_key(state.bucket_for('a'))
+            self.assertFalse(db_relative_path(bucket).exists())
+        self.assertEqual(dict(PersistentDict('deferred', self.storage)),
+            {'a': 1, 'b': 2})
+
+        # Changing one field only rewrites its bucket
+        state = PersistentDict('deferred', self.storage)
+        paths = [db_relative_path(state.bucket_key(b)) for b in range(4)]
+        before = {path: path.stat().st_mtime_ns for path in paths
+            if path.exists()}
+        state['a'] = 3
+        changed = [path for path in before
+            if path.stat().st_mtime_ns != before[path]]
+        self.assertEqual(changed, [db_relative_path(state.bucket_key(
+            state.bucket_for('a')))])
+
+    def test_failures(self):
+        state = PersistentDict('failing', self.storage, buckets=2)
+        state['a'] = 1
+        path = db_relative_path(state.bucket_key(state.bucket_for('a')))
+        content = bytearray(path.read_bytes())
+        content[-1] ^= 0xFF
+        path.write_bytes(content)
+
+        # A bucket that cannot be read is not taken for an empty one
+        reopened = PersistentDict('failing', self.storage)
+        with self.assertRaises(IntegrityError):
+            reopened['a'] = 2
+        self.assertEqual(path.read_bytes(), content)
+
+        # Buckets that fail to be written stay changed
+        self.storage.write_many = lambda *args, **kwargs: False
+        try:
+            with self.assertRaises(DBOperationError):
+                state['a'] = 3
+        finally:
+            del self.storage.write_many
+        self.assertEqual(state.flush(), 1)
+        self.assertEqual(PersistentDict('failing', self.storage)['a'], 3)
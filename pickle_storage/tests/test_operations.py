@@ -1,7 +1,10 @@
 import unittest
 import time
 import functools
+import threading
 
+from pickle_storage.errors import DBOperationError
+from pickle_storage.executor import StorageExecutor
 from pickle_storage.operations import BaseStorageOperation
 from pickle_storage.utils import write_to_log
 
@@ -24,3 +27,43 @@ class StorageContainerTestCase(unittest.TestCase):
                 return False
 
         NullOperation(on_complete=hook_fn).join()
+
+    def test_executor_backpressure(self):
+        executor = StorageExecutor(max_workers=1, max_queue_size=1,
+            submit_timeout=0.1)
+        release = threading.Event()
+        try:
+            executor.submit(release.wait)
+            executor.submit(release.wait)
+            with self.assertRaises(DBOperationError):
+                executor.submit(release.wait)
+        finally:
+            release.set()
+            executor.shutdown()
+
+    def test_executor_reservation(self):
+        executor = StorageExecutor(max_workers=1, max_queue_size=1,
+            submit_timeout=0.1)
+        release = threading.Event()
+        try:
+            self.assertTrue(executor.reserve())
+            executor.submit(release.wait)
+            self.assertTrue(executor.reserve())
+            executor.unreserve()
+            executor.submit(release.wait)
+            # Full: reserving does not wait for a slot
+            self.assertFalse(executor.reserve())
+            executor.unreserve()
+            with self.assertRaises(DBOperationError):
+                executor.submit(release.wait)
+        finally:
+            release.set()
+            executor.shutdown()
+
+    def test_operation_handle(self):
+        completed = []
+        op = BaseStorageOperation()
+        op.add_done_callback(completed.append)
+        self.assertFalse(op.join())
+        self.assertTrue(op.done())
+        self.assertEqual(completed, [op])
@@ -0,0 +1,168 @@
+import gc
+import os
+import unittest
+import pathlib
+import weakref
+from unittest import mock
+
+from pickle_storage.errors import DBOperationError
+from pickle_storage.segments import RECORD, SegmentStorageContainer
+from pickle_storage.config import storage_settings
+
+__all__ = ['SegmentStorageTestCase']
+
+class SegmentStorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = pathlib.Path(
+            storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY)
+        self.storage = SegmentStorageContainer(segment_max_bytes=4096,
+            compaction_interval=None)
+        self.storage.clear()
+
+    def tearDown(self):
+        self.storage.clear()
+        self.storage.close()
+
+    def test_read_and_write(self):
+        test_data = {'Test': 'Data', "SomeNum45": 9569596}
+        self.assertTrue(self.storage.write('segment_test', test_data, wait=True))
+        self.assertFalse(self.storage.write(
+            storage_settings.PICKLE_STORAGE_SIGNING_KEY_FILENAME,
+            test_data, wait=True))
+        self.assertFalse(self.storage.write(wait=True))
+        self.assertFalse(self.storage.read())
+
+        self.assertEqual(self.storage.read('segment_test'), test_data)
+        self.assertIsNone(self.storage.read('segment_missing'))
+        self.assertTrue(self.storage.exists('segment_test'))
+        self.assertEqual([p.stem for p in self.storage.contents()],
+            ['segment_test'])
+
+        written = self.storage.write_many({'a': 1, 'b': 2, 'c': None},
+            wait=True, fsync=True)
+        self.assertEqual(set(written), {'a', 'b'})
+        self.assertEqual(dict(self.storage.read_many(['a', 'b'])),
+            {'a': 1, 'b': 2})
+
+        self.assertTrue(isinstance(self.storage.archive(), pathlib.Path))
+
+        with self.assertRaises(DBOperationError):
+            self.storage.write('insecure', 1, secure=False, wait=True)
+
+    def test_reopen_and_compact(self):
+        for version in range(50):
+            self.storage.write('counter', {'Version': version, 'Pad': 'x' * 200},
+                wait=True)
+        self.storage.write('stable', 'value', wait=True)
+        self.assertGreater(len(self.storage._segment_sizes), 1)
+
+        self.assertGreater(self.storage.compact(), 0)
+        self.assertEqual(self.storage.read('counter')['Version'], 49)
+
+        # Index is rebuilt from the hint file plus later appends
+        self.storage.write('after_hint', True, wait=True)
+        self.storage._close_files()
+        reopened = SegmentStorageContainer(compaction_interval=None)
+        try:
+            self.assertEqual(reopened.read('counter')['Version'], 49)
+            self.assertEqual(reopened.read('stable'), 'value')
+            self.assertTrue(reopened.read('after_hint'))
+        finally:
+            reopened.close()
+        self.storage.setup()
+
+    def test_unsupported(self):
+        self.storage.write('kept', 'value', wait=True)
+        with self.assertRaises(DBOperationError):
+            self.storage.restore()
+        with self.assertRaises(DBOperationError):
+            self.storage.migrate_layout()
+        self.assertEqual(self.storage.read('kept'), 'value')
+
+    def test_read_during_compaction(self):
+        self.storage.write('stable', 'value', wait=True)
+        for version in range(50):
+            self.storage.write('counter', {'Version': version, 'Pad': 'x' * 200},
+                wait=True)
+        key = self.storage.key_for('stable')
+        location = self.storage._index[key]
+        fd = self.storage._segment_fd(location.segment)
+
+        pread = os.pread
+        def compacting_pread(*args):
+            # Compaction removes the segment while the read is under way
+            with mock.patch('os.pread', pread):
+                self.assertGreater(self.storage.compact(), 0)
+            self.assertNotIn(location.segment, self.storage._segment_sizes)
+            os.fstat(fd) # Still open
+            return pread(*args)
+
+        with mock.patch('os.pread', compacting_pread):
+            self.assertEqual(self.storage.read_record(key), 'value')
+        with self.assertRaises(OSError):
+            os.fstat(fd)
+        self.assertNotEqual(self.storage._index[key], location)
+        self.assertEqual(self.storage.read('stable'), 'value')
+
+    def test_torn_tail(self):
+        self.storage.write('intact', 'value', wait=True)
+        self.storage.write('torn', 'value', wait=True)
+        location = self.storage._index[self.storage.key_for('torn')]
+        self.storage._close_files()
+
+        segment_path = self.storage._segment_path(location.segment)
+        with open(segment_path, 'r+b') as f:
+            f.truncate(location.offset + location.length - 1)
+
+        reopened = SegmentStorageContainer(compaction_interval=None)
+        try:
+            self.assertEqual(reopened.read('intact'), 'value')
+            self.assertIsNone(reopened.read('torn'))
+            self.assertEqual(segment_path.stat().st_size, location.offset)
+        finally:
+            reopened.close()
+        self.storage.setup()
+
+    def test_failed_append(self):
+        self.storage.write('before', 'value', wait=True)
+        active_file = self.storage._active_file
+
+        class FullDisk():
+            def write(self, data):
+                active_file.write(data[:len(data) // 2])
+                active_file.flush()
+                raise OSError(28, 'No space left on device')
+
+            def close(self):
+                active_file.close()
+
+        self.storage._active_file = FullDisk()
+        with self.assertRaises(OSError):
+            self.storage.write_records({'lost': 'value'})
+        # The partial record is cut off and later records line up
+        self.assertTrue(self.storage.write('after', 'value', wait=True))
+        self.assertEqual(self.storage.read('after'), 'value')
+        self.assertIsNone(self.storage.read('lost'))
+
+    def test_bogus_length(self):
+        self.storage.write('intact', 'value', wait=True)
+        self.storage._close_files()
+        segment_path = self.storage._segment_path(
+            max(self.storage._segment_sizes))
+        with open(segment_path, 'ab') as f:
+            f.write(RECORD.pack(b'PR', 0, 0, 1, 2 ** 60))
+
+        reopened = SegmentStorageContainer(compaction_interval=None)
+        try:
+            self.assertEqual(reopened.read('intact'), 'value')
+        finally:
+            reopened.close()
+        self.storage.setup()
+
+    def test_garbage_collected(self):
+        storage = SegmentStorageContainer(compaction_interval=60)
+        storage_ref = weakref.ref(storage)
+        del storage
+        gc.collect()
+        self.assertIsNone(storage_ref())
@@ -0,0 +1,104 @@
+import unittest
+import os
+import threading
+import time
+
+from pickle_storage.container import BaseStorageContainer
+from pickle_storage.errors import ForbiddenFileError, IntegrityError
+from pickle_storage.snapshot import SnapshotImage, SnapshotStorageContainer
+from pickle_storage.utils import db_relative_path
+
+__all__ = ['SnapshotStorageTestCase']
+
+class SnapshotStorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = BaseStorageContainer()
+        self.storage.clear()
+        self.storage.write_many({f'key_{i}': {'value': i} for i in range(50)},
+            wait=True)
+        self.storage.write('shared', [1, 2, 3], dedup=True, wait=True)
+        self.storage.write('array', bytearray(range(256)) * 512,
+            out_of_band=True, wait=True)
+        self.image_path = self.storage.build_image()
+
+    def test_reads(self):
+        snapshot = SnapshotStorageContainer(refresh_interval=None)
+        self.assertEqual(len(snapshot.image), 52)
+        self.assertEqual(snapshot.read('key_7'), {'value': 7})
+        self.assertEqual(snapshot.read('shared'), [1, 2, 3])
+        self.assertEqual(snapshot.read('array'),
+            bytearray(range(256)) * 512)
+        self.assertIsNone(snapshot.read('missing'))
+        self.assertTrue(snapshot.exists('key_49'))
+        self.assertFalse(snapshot.exists('missing'))
+        result = snapshot.read_many(['key_1', 'missing'])
+        self.assertEqual(dict(result), {'key_1': {'value': 1}})
+        self.assertIn('missing', result.errors)
+        self.assertEqual(snapshot.read_operation('key_2').join(),
+            {'value': 2})
+        self.assertEqual([p.stem for p in snapshot.contents('key_1',
+            limit=3)], ['key_1', 'key_10', 'key_11'])
+        self.assertEqual([p.stem for p in snapshot.contents(
+            start_after='shared')], [])
+
+        with self.assertRaises(ForbiddenFileError):
+            snapshot.write('key_1', 1)
+        with self.assertRaises(ForbiddenFileError):
+            snapshot.clear()
+
+        # A new image is swapped in on refresh, without disturbing the old one
+        old_image = snapshot.image
+        self.storage.write('key_1', {'value': 'new'}, wait=True)
+        self.assertEqual(snapshot.read('key_1'), {'value': 1})
+        self.storage.build_image()
+        self.assertTrue(snapshot.refresh())
+        self.assertIsNot(snapshot.image, old_image)
+        self.assertEqual(snapshot.read('key_1'), {'value': 'new'})
+        self.assertEqual(old_image.get('key_1.psf'), {'value': 1})
+
+    def test_verification(self):
+        # Tampered keys are left out of the image
+        path = db_relative_path('key_3')
+        content = bytearray(path.read_bytes())
+        content[-1] ^= 0xFF
+        path.write_bytes(content)
+        self.storage.build_image()
+        image = SnapshotImage(self.image_path)
+        self.assertNotIn('key_3.psf', image)
+        self.assertIn('key_4.psf', image)
+        del image
+
+        content = bytearray(self.image_path.read_bytes())
+        content[200] ^= 0xFF
+        os.chmod(self.image_path, 0o644)
+        self.image_path.write_bytes(content)
+        with self.assertRaises(IntegrityError):
+            SnapshotImage(self.image_path, verify=True)
+        # Only the signed index is checked without verify
+        SnapshotImage(self.image_path, verify=False)
+
+        content[-1] ^= 0xFF
+        self.image_path.write_bytes(content)
+        with self.assertRaises(IntegrityError):
+            SnapshotImage(self.image_path, verify=False)
+
+    def test_background_verification(self):
+        snapshot = SnapshotStorageContainer(refresh_interval=0,
+            verify_image=True)
+        old_image = snapshot.image
+        self.storage.write('key_1', {'value': 'new'}, wait=True)
+        self.storage.build_image()
+
+        # Reads keep using the current image while the new one is checked
+        open_image = snapshot.open_image
+        checked = threading.Event()
+        snapshot.open_image = lambda: checked.wait(5) and open_image()
+        self.assertEqual(snapshot.read('key_1'), {'value': 1})
+        self.assertIs(snapshot.image, old_image)
+        checked.set()
+        for attempt in range(500):
+            if snapshot.image is not old_image:
+                break
+            time.sleep(0.01)
+        self.assertEqual(snapshot.read('key_1'), {'value': 'new'})
@@ -1,10 +1,17 @@
 import unittest
+import unittest.mock
+import logging
 import os
 import time
 import pathlib
 
-from pickle_storage.utils import db_relative_path, write_to_log, timeit, Timer, import_class
-from pickle_storage.config import storage_settings, ConfigObject
+from pickle_storage.utils import (db_relative_path, write_to_log, timeit, Timer,
+    import_class, atomic_write, DURABILITY_LEVELS)
+from pickle_storage.config import storage_settings, ConfigObject, get_settings_config
+from pickle_storage.container import BaseStorageContainer
+from pickle_storage.metrics import (BYTES_READ, BYTES_WRITTEN,
+    FUNCTION_SECONDS, HMAC_FAILURES, IN_FLIGHT, PHASE_SECONDS, MemorySink,
+    prometheus_text, set_sink)
 from pickle_storage.mixins import HMACMixin
 
 class UtilsTestCase(unittest.TestCase):        
@@ -34,6 +41,22 @@ class UtilsTestCase(unittest.TestCase):
     def test_logging(self):
         write_to_log('One', 'Two')
 
+        with self.assertLogs('pickle_storage', level='WARNING') as logs:
+            write_to_log('Three', level='warning')
+        self.assertIn(__file__, logs.output[0])
+        self.assertTrue(logs.output[0].endswith('\nThree'))
+
+        # Disabled levels are not formatted at all
+        logger = logging.getLogger('pickle_storage')
+        logger.setLevel(logging.CRITICAL)
+        try:
+            with unittest.mock.patch('pickle_storage.utils.logging.'
+                'find_caller') as find_caller:
+                write_to_log('Four', level='warning')
+            find_caller.assert_not_called()
+        finally:
+            logger.setLevel(logging.NOTSET)
+
     def test_class_import(self):
         ImportedHMACMixin = import_class("pickle_storage.mixins.HMACMixin")
         self.assertEqual(ImportedHMACMixin, HMACMixin)
@@ -52,4 +75,79 @@ class ConfigTestCase(unittest.TestCase):
 
     def test_config_class(self, *args, **kwargs):
         config_obj = ConfigObject(user_defined_settings=None)
-        config_obj.apply_from_module('pickle_storage.tests.dummy_settings')
\ No newline at end of file
+        config_obj.apply_from_module('pickle_storage.tests.dummy_settings')
+
+    def test_shared_settings(self):
+        self.assertIs(get_settings_config(), storage_settings)
+
+        # Path resolution follows setting updates
+        original_dir = storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY
+        db_relative_path('cached_path')
+        try:
+            storage_settings.update_setting(
+                'PICKLE_STORAGE_WORKING_DIRECTORY', 'other_dir')
+            self.assertEqual(db_relative_path('cached_path').parent,
+                pathlib.Path('other_dir'))
+        finally:
+            storage_settings.update_setting(
+                'PICKLE_STORAGE_WORKING_DIRECTORY', original_dir)
+
+class FilesTestCase(unittest.TestCase):
+
+    def test_atomic_write(self):
+        target = db_relative_path('atomic_test')
+        target.parent.mkdir(parents=True, exist_ok=True)
+        for durability in DURABILITY_LEVELS:
+            atomic_write(target, [b'one', b'two'], durability)
+            self.assertEqual(target.read_bytes(), b'onetwo')
+
+        # Failed writes leave the original file and no temporary files behind
+        with self.assertRaises(TypeError):
+            atomic_write(target, [b'three', None])
+        self.assertEqual(target.read_bytes(), b'onetwo')
+        self.assertEqual(list(target.parent.glob('.atomic_test*')), [])
+
+        with self.assertRaises(ValueError):
+            atomic_write(target, [b''], durability='sometimes')
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = MemorySink()
+        self.previous_sink = set_sink(self.sink)
+
+    def tearDown(self):
+        set_sink(self.previous_sink)
+
+    def test_operation_metrics(self):
+        storage = BaseStorageContainer()
+        self.assertTrue(storage.write('metrics_test', {'a': 1}, wait=True))
+        self.assertEqual(storage.read('metrics_test'), {'a': 1})
+
+        for operation, phases in (('Write', ['resolve', 'pickle', 'hmac',
+            'io']), ('Read', ['resolve', 'io', 'hmac', 'unpickle'])):
+            for phase in phases:
+                self.assertEqual(self.sink.histograms[(PHASE_SECONDS,
+                    (('operation', operation), ('phase', phase)))].count, 1)
+        size = db_relative_path('metrics_test').stat().st_size
+        self.assertEqual(self.sink.value(BYTES_WRITTEN), size)
+        self.assertEqual(self.sink.value(BYTES_READ), size)
+        self.assertEqual(self.sink.value(IN_FLIGHT), 0)
+
+        path = db_relative_path('metrics_test')
+        path.write_bytes(path.read_bytes()[:-1] + b'\x00')
+        self.assertIsNone(storage.read('metrics_test'))
+        self.assertEqual(self.sink.value(HMAC_FAILURES), 1)
+
+        text = prometheus_text(self.sink)
+        self.assertIn('# TYPE pickle_storage_phase_seconds histogram', text)
+        self.assertIn('pickle_storage_phase_seconds_count{operation="Read",'
+            'phase="io"} 2', text)
+        self.assertIn(f'pickle_storage_bytes_written_total {size}', text)
+
+    def test_timers(self):
+        with Timer('timed_block') as timer:
+            pass
+        self.assertIsNotNone(timer.elapsed_time)
+        self.assertEqual(self.sink.histograms[(FUNCTION_SECONDS,
+            (('function', 'timed_block'),))].count, 1)
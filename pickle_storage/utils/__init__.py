@@ -1 +1,2 @@
-from .logging import *
\ No newline at end of file
+from .logging import *
+from .files import *
\ No newline at end of file
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import pathlib
+import uuid
+
+__all__ = ['DURABILITY_LEVELS', 'atomic_write', 'fsync_directories',
+    'key_files', 'migrate_layout', 'shard_parts', 'write_temporary']
+
+# none: rely on the OS to flush. file: fsync file contents before they
+# replace the target. directory: additionally fsync the directory entry.
+DURABILITY_LEVELS = ('none', 'file', 'directory')
+
+def fsync_directories(directories):
+    """ Flush directory entries (creates, renames) to disk. """
+
+    for directory in directories:
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def write_temporary(path, chunks, fsync=False):
+    """ Write chunks to a new hidden file beside path. Returns its name and
+    its os.stat_result, which still applies once it is renamed. The
+    temporary file is removed again if writing fails. """
+
+    temp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+    try:
+        fd = os.open(temp_path, flags, 0o666)
+    except FileNotFoundError:
+        # First key in a shard directory
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(temp_path, flags, 0o666)
+    try:
+        with open(fd, "wb") as f:
+            f.writelines(chunks)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+            stat = os.fstat(f.fileno())
+    except:
+        try:
+            os.unlink(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return temp_path, stat
+
+def atomic_write(path, chunks, durability='none', before_replace=None):
+    """ Replace path with chunks so that readers only ever see the old or
+    the new contents in full. before_replace, if given, is called once the
+    new contents are written, just before they replace path. Returns the
+    os.stat_result of the new file. """
+
+    if durability not in DURABILITY_LEVELS:
+        raise ValueError(f'Unknown durability "{durability}".')
+
+    temp_path, stat = write_temporary(path, chunks,
+        fsync=durability != 'none')
+    try:
+        if before_replace is not None:
+            before_replace()
+        os.replace(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+    if durability == 'directory':
+        fsync_directories([path.parent])
+    return stat
+
+def shard_parts(name, depth, fanout):
+    """ Names of the nested shard directories holding the file name, one
+    per level of depth, each one of fanout hex-named directories. """
+
+    width = len(f"{fanout - 1:x}")
+    number = int.from_bytes(hashlib.blake2b(name.encode(),
+        digest_size=16).digest(), 'big')
+    parts = []
+    for level in range(depth):
+        number, shard = divmod(number, fanout)
+        parts.append(f"{shard:0{width}x}")
+    return parts
+
+def key_files(working_dir_path, suffix, depth=0):
+    """ Paths of stored key files laid out with shard depth depth. Files in
+    other subdirectories are not included. """
+
+    pattern = "*/" * depth + f"*{suffix}"
+    return pathlib.Path(working_dir_path).glob(pattern)
+
+def migrate_layout(working_dir_path, suffix, depth, fanout, keep=(),
+    from_depth=0, from_fanout=None):
+    """ Move every key file in working_dir_path laid out from_depth levels
+    deep by from_fanout (default fanout) to where a store sharded depth levels
+    deep by fanout keeps it; depth 0 flattens the store. Files named in keep,
+    such as signing keys, and files at other depths or in directories that
+    are not shards of from_fanout are left alone. Emptied shard directories
+    are removed. Returns the number of files moved. """
+
+    working_dir_path = pathlib.Path(working_dir_path)
+    width = len(f"{(from_fanout or fanout) - 1:x}")
+    moved = 0
+    emptied = set()
+    for path in list(working_dir_path.rglob(f"*{suffix}")):
+        relative = path.relative_to(working_dir_path)
+        if (path.name in keep or len(relative.parts) != from_depth + 1
+            or not all(_is_shard_name(part, width)
+                for part in relative.parts[:-1])):
+            continue
+        target = working_dir_path.joinpath(*shard_parts(path.name, depth,
+            fanout), path.name)
+        if target == path:
+            continue
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(path, target)
+        emptied.update(path.parents[i] for i in range(len(relative.parts) - 1))
+        moved += 1
+
+    # Deepest first, so parents are empty by the time they are reached
+    for directory in sorted(emptied, key=lambda d: len(d.parts), reverse=True):
+        try:
+            directory.rmdir()
+        except OSError:
+            pass
+    return moved
+
+def _is_shard_name(name, width):
+    return len(name) == width and set(name) <= set('0123456789abcdef')
@@ -1,14 +1,15 @@
 import datetime
+import functools
 import logging
-import threading
 import time 
-import traceback
-import re
 import wrapt
 import pathlib
 import importlib
 import sys
 
+from pickle_storage.metrics import FUNCTION_SECONDS, get_sink
+from .files import shard_parts
+
 logging_re_pattern = r'write_to_log[\s]*\('
 
 def import_class(import_string):
@@ -26,18 +27,45 @@ def log_errors(wrapped, instance, args, kwargs):
 
 @wrapt.decorator
 def timeit(wrapped, instance, args, kwargs):
-    ts = time.time()
-    result = wrapped(*args, **kwargs)
-    te = time.time()
-    write_to_log("Function time {} : {} sec".format(wrapped.__name__, te - ts))
-    return result
+    """ Record each call's duration in the pickle_storage_function_seconds
+    metric, labelled with the function's name. """
+
+    ts = time.perf_counter()
+    try:
+        return wrapped(*args, **kwargs)
+    finally:
+        get_sink().observe(FUNCTION_SECONDS, time.perf_counter() - ts,
+            (('function', wrapped.__name__),))
+
+_storage_settings = None
 
 def db_relative_path(target_path, is_dir=False):
-    from pickle_storage.config.tools import get_settings_config
-    storage_settings = get_settings_config()
-    
-    storage_path = pathlib.Path(
-        storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY)
+    global _storage_settings
+    if _storage_settings is None:
+        from pickle_storage.config.tools import get_settings_config
+        _storage_settings = get_settings_config()
+
+    storage_settings = _storage_settings
+    suffix = storage_settings.PICKLE_STORAGE_SUFFIX
+    shard_depth = storage_settings.PICKLE_STORAGE_SHARD_DEPTH
+    flat_names = ()
+    if shard_depth:
+        # Signing keys are looked up before any shard directory exists
+        flat_names = tuple(f"{name}{suffix}" for name in [
+            storage_settings.PICKLE_STORAGE_SIGNING_KEY_FILENAME,
+            *storage_settings.PICKLE_STORAGE_RETIRED_SIGNING_KEY_FILENAMES])
+    return _resolve_path(target_path, is_dir,
+        storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY, suffix,
+        shard_depth, storage_settings.PICKLE_STORAGE_SHARD_FANOUT, flat_names)
+
+def clear_path_cache():
+    """ Forget memoized db_relative_path results. """
+    _resolve_path.cache_clear()
+
+@functools.lru_cache(maxsize=4096)
+def _resolve_path(target_path, is_dir, working_directory, suffix,
+    shard_depth=0, shard_fanout=0, flat_names=()):
+    storage_path = pathlib.Path(working_directory)
     
     # Convert strings to path instances
     if isinstance(target_path, str):
@@ -47,11 +75,18 @@ def db_relative_path(target_path, is_dir=False):
         if not target_path.suffix:
             file_name = target_path.parts[-1]
             target_path = target_path.with_name(
-                f"{file_name}{storage_settings.PICKLE_STORAGE_SUFFIX}")
+                f"{file_name}{suffix}")
 
-    if not target_path.parents[0] == storage_path and not target_path == storage_path:
+    if storage_path not in target_path.parents and not target_path == storage_path:
         target_path = storage_path.joinpath(target_path)
 
+    # Keys stored directly in the working directory move into shard
+    # directories; paths already in one, or in a subdirectory, are kept.
+    if (shard_depth and not is_dir and target_path.parent == storage_path
+        and target_path.name not in flat_names):
+        target_path = storage_path.joinpath(*shard_parts(target_path.name,
+            shard_depth, shard_fanout), target_path.name)
+
     return target_path
 
 class Timer():
@@ -66,10 +101,11 @@ class Timer():
         self.stop()
 
     def __init__(self, name = ''):
-        if name:
-            name = f' ({name})'
-            
+        """ Times a block of code, recording it in the
+        pickle_storage_function_seconds metric under name. """
+
         self.name = name
+        self.elapsed_time = None
         self._start_time = None
 
     def start(self):
@@ -79,59 +115,82 @@ class Timer():
 
     def stop(self):
         """Stop the timer, and report the elapsed time"""
-        elapsed_time = time.perf_counter() - self._start_time
+        self.elapsed_time = time.perf_counter() - self._start_time
         self._start_time = None
-        write_to_log(f"Elapsed time{self.name}: {elapsed_time} seconds")
-
+        get_sink().observe(FUNCTION_SECONDS, self.elapsed_time,
+            (('function', self.name),))
+        return self.elapsed_time
+
+
+logger = logging.getLogger('pickle_storage')
+
+class LogMessage():
+    """ A write_to_log() message, only formatted if a handler emits it. """
+
+    __slots__ = ('msg', 'extra_msg_args', 'caller', 'created', 'log_tag')
+
+    def __init__(self, msg, extra_msg_args, caller, created, log_tag):
+        self.msg = msg
+        self.extra_msg_args = extra_msg_args
+        self.caller = caller
+        self.created = created
+        self.log_tag = log_tag
+
+    def __str__(self):
+        msg = str(self.msg)
+        for extra_arg in self.extra_msg_args:
+            msg += '\n' + str(extra_arg)
+        if self.caller is None:
+            if not msg.startswith(self.log_tag):
+                msg = f'{self.log_tag}: ' + msg
+            return msg
+
+        now = datetime.datetime.fromtimestamp(self.created).strftime(
+            '%d %b %H:%M:%S')
+        filename, lineno = self.caller
+        return f'{self.log_tag}: {filename} {lineno} ({now})\n{msg}'
+
+def find_caller(ignored_files=(), limit=20):
+    """ (filename, line number) of the nearest frame calling into this
+    module from outside it, skipping files containing any of
+    ignored_files. """
+
+    frame = sys._getframe(1)
+    for depth in range(limit):
+        if frame is None:
+            return None
+        filename = frame.f_code.co_filename
+        if filename != __file__ and not any(name in filename
+            for name in ignored_files):
+            return filename, frame.f_lineno
+        frame = frame.f_back
+    return None
+
+_test_run = None
 
 def write_to_log(msg, *extra_msg_args, level='info', limit=20,  include_traceback=False,
     log_tag="PickleStorageLog", regex_pattern=logging_re_pattern, ignored_files =[]):
+    """ Log msg, and each of extra_msg_args on its own line, to the
+    'pickle_storage' logger, noting where it was called from. Nothing is
+    formatted unless the level is enabled. regex_pattern is no longer used;
+    the caller is the nearest frame outside this module. """
 
     # Elevate the level during tests
-    try:
-        if 'test' in sys.argv[-1]:
-            if level in ['info', 'debug']:
-                level = 'warning'
-    except IndexError:
-        pass
-
-    now = datetime.datetime.now().strftime('%d %b %H:%M:%S')
-    msg = str(msg)
-    for extra_arg in extra_msg_args:
-        msg +=  '\n' + str(extra_arg)
-
-    log_call = getattr(logging, level)
-    extra_details = ''
-    use_current_line = False
-    for summary in traceback.extract_stack(limit = limit):
-
-        # if use_current_line:
-        #     extra_details = f'{log_tag}: {summary.filename} {summary.lineno} ({now})'
-        #     break
-        
-        filename_checks = ['pickle_storage/utils.py' not in summary.filename,
-            'contrib/utils.py' not in summary.filename]
-        for fn in ignored_files:
-            filename_checks.append(fn not in summary.filename)
-        outside_utils = all(filename_checks)
-
-        if re.search(regex_pattern, summary.line) and outside_utils:
-            extra_details = f'{log_tag}: {summary.filename} {summary.lineno} ({now})'
-            # if not ignore_filenames:
-            #     extra_details = f'{log_tag}: {summary.filename} {summary.lineno} ({now})'
-            # else:
-            #     use_current_line = True
-
-
-    if include_traceback or level == 'error':
-        extra_details = extra_details + '\n\n' + traceback.format_exc()
-
-    if extra_details:
-        if not re.match(f'{log_tag}:*', extra_details):
-            extra_details = f'{log_tag}: ' + extra_details
-        log_call(extra_details + '\n' + msg)
+    global _test_run
+    if _test_run is None:
+        _test_run = bool(sys.argv) and 'test' in sys.argv[-1]
+    if _test_run and level in ['info', 'debug']:
+        level = 'warning'
+
+    levelno = logging.getLevelName(level.upper())
+    if not logger.isEnabledFor(levelno):
         return
 
-    if not re.match(f'{log_tag}:*', msg):
-        msg = f'{log_tag}: ' + msg
-    log_call(msg)
+    exc_info = None
+    if include_traceback or level == 'error':
+        exc_info = sys.exc_info()
+        if exc_info[0] is None:
+            exc_info = None
+    logger.log(levelno, LogMessage(msg, extra_msg_args,
+        find_caller(ignored_files, limit), time.time(), log_tag),
+        exc_info=exc_info)
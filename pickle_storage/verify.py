@@ -0,0 +1,213 @@
+""" Integrity check of a whole store.
+
+verify_store() checks the digest of every key file and deduplicated blob in a
+working directory without unpickling anything, spreading the files over a
+pool of processes. Files are hashed straight from disk (memory-mapped when
+large), so the check is bound by I/O and hashing rather than by pickle. """
+
+import collections
+import mmap
+import os
+import pathlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from pickle_storage.blobs import BLOB_DIRECTORY, blob_path, verify_blob
+from pickle_storage.errors import IntegrityError, TruncatedFileError
+from pickle_storage.fileformat import FLAG_REFERENCE, is_framed, unpack_frame
+from pickle_storage.mixins import (HMAC_CHUNK_SIZE, HMACMixin, SigningKey,
+    new_mac)
+from pickle_storage.utils import key_files
+from pickle_storage.config.tools import get_settings_config
+storage_settings = get_settings_config()
+
+__all__ = ['CORRUPT', 'MISSING', 'TRUNCATED', 'UNSIGNED', 'VerificationReport',
+    'check_file', 'verify_files', 'verify_store']
+
+CORRUPT = 'corrupt'
+TRUNCATED = 'truncated'
+UNSIGNED = 'unsigned'
+MISSING = 'missing' # A reference to a blob that does not exist
+
+# Files handed to a worker process at a time
+BATCH_SIZE = 256
+
+class VerificationReport(collections.namedtuple('VerificationReport',
+    ['checked', CORRUPT, TRUNCATED, UNSIGNED, MISSING])):
+    """ Number of files checked, and the paths of those that failed, by
+    kind of failure. """
+
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return not (self.corrupt or self.truncated or self.unsigned
+            or self.missing)
+
+class Verifier(HMACMixin):
+    """ Checks files against a fixed list of signing keys, so that it does
+    not need to find them on disk. """
+
+    def __init__(self, keys, working_dir_path):
+        self.keys = keys
+        self.working_dir_path = working_dir_path
+        self._signing_keys = {}
+
+    def check(self, path):
+        """ Returns the kind of failure found in the file at path, or None
+        if it is intact. Files among the blobs that are not named by a
+        digest are corrupt. """
+
+        path = pathlib.Path(path)
+        digest = None
+        if path.parent.parent.name == BLOB_DIRECTORY:
+            try:
+                digest = bytes.fromhex(path.name)
+            except ValueError:
+                return CORRUPT
+        mapped = None
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return TRUNCATED
+            if size < HMAC_CHUNK_SIZE:
+                raw = f.read()
+            else:
+                raw = mapped = mmap.mmap(f.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+        try:
+            with memoryview(raw) as view:
+                if digest is not None:
+                    return self.check_blob(view, digest)
+                return self.check_key(view)
+        finally:
+            if mapped is not None:
+                mapped.close()
+
+    def check_blob(self, view, digest):
+        try:
+            verify_blob(view, digest)
+        except TruncatedFileError:
+            return TRUNCATED
+        except IntegrityError:
+            return CORRUPT
+
+    def check_key(self, view):
+        if is_framed(view):
+            try:
+                frame = unpack_frame(view)
+            except TruncatedFileError:
+                return TRUNCATED
+            except IntegrityError:
+                frame = None
+            if frame is not None and self.is_safe(frame.digest, frame.signed,
+                frame.algorithm):
+                if (frame.flags & FLAG_REFERENCE and not blob_path(
+                    bytes(frame.payload), self.working_dir_path).exists()):
+                    return MISSING
+                return None
+            # Otherwise it may be a headerless file, as Read assumes
+
+        # digest + b'\x00' + pickle
+        if len(view) > 33 and view[32] == 0 and self.is_safe(view[:32],
+            view[33:], 'sha256'):
+            return None
+        # A bare pickle: protocol 2+ opcode through to the STOP opcode
+        if view[0] == 0x80 and view[-1] == ord('.'):
+            return UNSIGNED
+        return CORRUPT
+
+    def verification_keys(self, hashing_algorithm=None):
+        hashing_algorithm = hashing_algorithm or self.hashing_algorithm
+        for key in self.keys:
+            cache_key = (key, hashing_algorithm)
+            signing_key = self._signing_keys.get(cache_key)
+            if signing_key is None:
+                signing_key = self._signing_keys[cache_key] = SigningKey(None,
+                    None, key, new_mac(key, hashing_algorithm))
+            yield signing_key
+
+def check_file(path, keys, working_dir_path=None):
+    """ Kind of failure found in the file at path when checked against the
+    raw signing keys keys, or None if it is intact. """
+
+    if working_dir_path is None:
+        working_dir_path = storage_settings.PICKLE_STORAGE_WORKING_DIRECTORY
+    return Verifier(keys, working_dir_path).check(path)
+
+def verify_files(paths, keys, working_dir_path):
+    """ Check each of paths, returning (path, failure) pairs for those that
+    are not intact. Runs in the worker processes of verify_store(). """
+
+    verifier = Verifier(keys, working_dir_path)
+    failures = []
+    for path in paths:
+        try:
+            failure = verifier.check(path)
+        except FileNotFoundError:
+            continue # Removed since it was listed
+        if failure:
+            failures.append((path, failure))
+    return failures
+
+def verify_store(working_dir_path, keys, workers=None, exclude=()):
+    """ Check every key file and blob in working_dir_path against the raw
+    signing keys keys, leaving out the file names in exclude. Files are
+    checked in batches across workers processes (default
+    PICKLE_STORAGE_VERIFY_WORKERS, or one per CPU); with workers=1 they are
+    checked in this process. Returns a VerificationReport. """
+
+    if workers is None:
+        workers = storage_settings.PICKLE_STORAGE_VERIFY_WORKERS \
+            or os.cpu_count()
+    working_dir_path = str(working_dir_path)
+    batches = _batches(_store_files(working_dir_path, exclude))
+    failures = collections.defaultdict(list)
+    checked = 0
+
+    def collect(batch, results):
+        nonlocal checked
+        checked += len(batch)
+        for path, failure in results:
+            failures[failure].append(pathlib.Path(path))
+
+    if workers <= 1:
+        for batch in batches:
+            collect(batch, verify_files(batch, keys, working_dir_path))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = {}
+            for batch in batches:
+                # Only a few batches are queued at a time, so the file list of
+                # a large store is never held in memory all at once.
+                if len(pending) >= workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(pending.pop(future), future.result())
+                future = pool.submit(verify_files, batch, keys,
+                    working_dir_path)
+                pending[future] = batch
+            for future, batch in pending.items():
+                collect(batch, future.result())
+
+    return VerificationReport(checked, *(sorted(failures[failure])
+        for failure in (CORRUPT, TRUNCATED, UNSIGNED, MISSING)))
+
+def _store_files(working_dir_path, exclude):
+    for path in key_files(working_dir_path,
+        storage_settings.PICKLE_STORAGE_SUFFIX,
+        storage_settings.PICKLE_STORAGE_SHARD_DEPTH):
+        if path.name not in exclude:
+            yield str(path)
+    for path in pathlib.Path(working_dir_path, BLOB_DIRECTORY).glob('*/*'):
+        if not path.name.startswith('.'): # Unfinished write
+            yield str(path)
+
+def _batches(paths):
+    batch = []
+    for path in paths:
+        batch.append(path)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
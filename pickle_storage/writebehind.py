@@ -0,0 +1,184 @@
+import atexit
+import threading
+import weakref
+from concurrent.futures import Future
+
+from pickle_storage.utils import db_relative_path, log_errors, write_to_log
+
+__all__ = ['PendingWrite', 'WriteBehindBuffer']
+
+# Buffers in use, flushed at interpreter exit
+_open_buffers = weakref.WeakSet()
+
+@atexit.register
+def _close_open_buffers():
+    for buffer in list(_open_buffers):
+        buffer.close()
+
+class PendingWrite():
+    """ Handle on a write held in a WriteBehindBuffer. It is complete as soon
+    as the value is buffered; the value reaches disk on the next flush. """
+
+    def __init__(self, result=True, on_complete=None):
+        self._return = result
+        self.on_complete = on_complete
+        self.future = Future()
+        self.future.set_result(None)
+
+    def add_done_callback(self, fn):
+        fn(self)
+
+    def cancel(self):
+        return False
+
+    def cancelled(self):
+        return False
+
+    def done(self):
+        return True
+
+    def is_alive(self):
+        return False
+
+    def join(self, timeout=None):
+        if self.on_complete:
+            self.on_complete(self._return)
+        return self._return
+
+class WriteBehindBuffer():
+    """ Holds the latest value written to each key in memory and writes them
+    to the container in batches, so a key rewritten many times between
+    flushes only reaches disk once.
+
+    Buffered values are flushed every ``interval`` seconds, as soon as
+    ``max_pending`` keys are waiting, on flush() and at interpreter exit.
+    Flushes other than flush() run on a background thread, so buffering a
+    write never waits for disk. Values that fail to be written stay
+    buffered, unless a newer value replaced them meanwhile. Values are lost
+    if the process dies, or the buffer is garbage collected, before they are
+    flushed. """
+
+    def __init__(self, container, interval=None, max_pending=None):
+        self.container = container
+        self.interval = interval
+        self.max_pending = max_pending
+        self._dirty = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        self._flusher = None
+        _open_buffers.add(self)
+
+        if interval:
+            self._start_flusher()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._dirty)
+
+    def clear(self):
+        """ Drop every buffered value without writing it. """
+
+        with self._lock:
+            self._dirty = {}
+
+    def close(self):
+        self._closed.set()
+        self._wake.set()
+        self.flush()
+
+    def discard(self, path):
+        """ Drop the buffered value of path without writing it. Returns
+        whether there was one. """
+
+        with self._lock:
+            return self._dirty.pop(db_relative_path(path), None) is not None
+
+    def flush(self, keys=None):
+        """ Write buffered values, only those of keys if given, to the
+        container and wait for them to land. Returns the number written. """
+
+        with self._flush_lock:
+            with self._lock:
+                if keys is None:
+                    batch, self._dirty = self._dirty, {}
+                else:
+                    batch = {}
+                    for key in keys:
+                        path = db_relative_path(key)
+                        if path in self._dirty:
+                            batch[path] = self._dirty.pop(path)
+                # Stays readable until it is on disk
+                self._flushing = batch
+            if not batch:
+                return 0
+
+            failed = batch
+            try:
+                result = self.container.write_many(batch, wait=True,
+                    buffered=False)
+                # False if the whole operation failed, and was logged
+                if result is not False:
+                    failed = {path: batch[path] for path in result.errors}
+            finally:
+                with self._lock:
+                    self._flushing = {}
+                    for path, content in failed.items():
+                        self._dirty.setdefault(path, content)
+
+        if result is False:
+            write_to_log(f'Failed to flush {len(batch)} buffered writes, '
+                'keeping them buffered.', level='warning')
+            return 0
+        for path, error in result.errors.items():
+            write_to_log(f'Failed to flush buffered write to "{path}", '
+                f'keeping it buffered: {error}', level='warning')
+        return len(result)
+
+    def get(self, path):
+        """ Returns (hit, value) for the buffered value of path. """
+
+        path = db_relative_path(path)
+        with self._lock:
+            for pending in (self._dirty, self._flushing):
+                if path in pending:
+                    return True, pending[path]
+        return False, None
+
+    def names(self):
+        with self._lock:
+            return {path.name for path in (*self._dirty, *self._flushing)}
+
+    def put(self, path, content, on_complete=None):
+        """ Buffer content as the new value of path. Returns a PendingWrite. """
+
+        with self._lock:
+            self._dirty[db_relative_path(path)] = content
+            full = self.max_pending and len(self._dirty) >= self.max_pending
+        if full:
+            if self._closed.is_set():
+                self.flush()
+            else:
+                self._start_flusher()
+                self._wake.set()
+        return PendingWrite(on_complete=on_complete)
+
+    def _start_flusher(self):
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop,
+                    name='PickleStorageWriteBehind', daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._closed.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if not self._closed.is_set():
+                self._flush_quietly()
+
+    @log_errors
+    def _flush_quietly(self):
+        self.flush()